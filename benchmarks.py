@@ -0,0 +1,401 @@
+"""
+Benchmark suite for the evaluator, server and CLI.
+
+    python3 benchmarks.py --save benchmark_baseline.json
+    python3 benchmarks.py --compare benchmark_baseline.json --threshold 0.2
+
+Every result is a timing in seconds, or for the memory suite a size in bytes,
+and lower is better. Comparing against a saved baseline flags any result over
+the baseline by more than the threshold and exits with a non-zero status.
+"""
+# built-in imports
+import argparse
+import gc
+import json
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+
+# custom imports
+import evaluator
+from calculator import Calculator
+from client import Client
+
+PACKAGE_DIR = Path(__file__).resolve().parent
+SUITES = ["engine", "memory", "server", "cli"]
+
+
+# --------------------
+# Expression Generator
+# --------------------
+
+
+def generate_expression(
+    length: int = 10,
+    depth: int = 0,
+    operators: str = "+-*/",
+    seed: int = 0,
+    negatives: float = 0.0,
+    spaces: bool = False,
+) -> str:
+    """
+    Generates a deterministic random arithmetic expression.
+
+    Args:
+        length: number of operands in the expression
+        depth: max nesting depth of parentheses, reached if length allows
+        operators: operators to pick from; repeat one to weight it, e.g. "++*"
+        seed: random seed, the same arguments always give the same expression
+        negatives: probability of an operand being negative
+        spaces: whether to put spaces around operators
+
+    Returns: expression string
+    """
+    rng = random.Random(seed)
+    joiner = " {} " if spaces else "{}"
+
+    def operand() -> str:
+        value = str(rng.randint(1, 99))
+        if rng.random() < 0.2:
+            value += f".{rng.randint(1, 99)}"
+        if rng.random() < negatives:
+            value = f"-{value}"
+        return value
+
+    def build(count: int, level: int) -> str:
+        terms = []
+        remaining = count
+        while remaining:
+            # the first term of each level opens a group so the depth is reached
+            group = level < depth and remaining >= 2
+            if group and (not terms or rng.random() < 0.3):
+                size = rng.randint(2, max(2, min(remaining, count // 2 or 2)))
+                terms.append(f"({build(size, level + 1)})")
+                remaining -= size
+            else:
+                terms.append(operand())
+                remaining -= 1
+        expression = terms[0]
+        for term in terms[1:]:
+            expression += joiner.format(rng.choice(operators)) + term
+        return expression
+
+    return build(max(1, length), 0)
+
+
+# -----------------
+# Benchmark Helpers
+# -----------------
+
+
+def best_time(func: callable, number: int, repeat: int = 3) -> float:
+    """Gets the best average time in seconds of one call to the function."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Gets the value at the given fraction of the sorted values."""
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def free_port() -> int:
+    """Gets a free local port to run a benchmark server on."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# ----------
+# Benchmarks
+# ----------
+
+
+def bench_engine(quick: bool = False) -> dict[str, float]:
+    """Times Calculator.evaluate_expression per engine on generated expressions."""
+    cases = {
+        "short": generate_expression(length=8, depth=1, seed=1),
+        "medium": generate_expression(length=100, depth=3, seed=2),
+        "long": generate_expression(length=2000, depth=4, seed=3),
+    }
+    if quick:
+        del cases["long"]
+
+    results = {}
+
+    def record(key: str, func: callable, number: int) -> None:
+        # skip engines that cannot evaluate a case rather than fail the suite
+        try:
+            func()
+        except Exception as e:
+            print(f"Skipped {key}: {e}", file=sys.stderr)
+            return
+        results[key] = best_time(func, number)
+
+    for name, expression in cases.items():
+        number = max(1, 20000 // len(expression))
+        for engine in Calculator.ENGINES:
+            calc = Calculator(engine=engine, cache_size=0)
+            record(
+                f"engine.{engine}.{name}",
+                lambda: calc.evaluate_expression(expression),
+                number,
+            )
+        calc = Calculator()
+        record(
+            f"engine.precedence-cached.{name}",
+            lambda: calc.evaluate_expression(expression),
+            number,
+        )
+        record(
+            f"engine.compile.{name}",
+            lambda: evaluator.compile_expression(expression),
+            number,
+        )
+        # one interpreted run, over packed programs and over a list of tuples
+        program = evaluator.compile_expression(expression)
+        record(f"engine.interpret.{name}", lambda: program.execute({}), number)
+        code = program.code
+        record(
+            f"engine.interpret-tuples.{name}",
+            lambda: evaluator.execute(code, {}),
+            number,
+        )
+
+    # a family of expressions sharing large parenthesized subterms
+    shared = [f"({generate_expression(length=40, depth=2, seed=s)})" for s in range(4)]
+    family = [
+        f"{shared[i % 4]} * x{i % 7} + {shared[(i + 1) % 4]} / {i + 1}"
+        for i in range(50 if quick else 200)
+    ]
+    variables = {f"x{i}": float(i + 1) for i in range(7)}
+    calc = Calculator(cache_size=0)
+    record(
+        "engine.family.each",
+        lambda: [calc.cache.get(e).evaluate(variables) for e in family],
+        5,
+    )
+    record("engine.family.batch", lambda: calc.evaluate_many(family, variables), 5)
+    return results
+
+
+def bench_memory(quick: bool = False) -> dict[str, float]:
+    """
+    Measures the bytes held per compiled expression in each representation:
+    the token strings the classic engine splits an expression into, postfix
+    instructions as a list of tuples, and packed programs before and after
+    they are compiled to Python.
+    """
+    count = 50 if quick else 200
+    cases = {
+        "short": [generate_expression(length=8, depth=1, seed=s) for s in range(count)],
+        "medium": [
+            generate_expression(length=100, depth=3, seed=s) for s in range(count)
+        ],
+    }
+
+    def compiled(expression: str) -> evaluator.Program:
+        program = evaluator.compile_expression(expression)
+        for _ in range(program.COMPILE_AFTER):
+            program.run({})
+        return program
+
+    representations = {
+        "strings": lambda e: re.split(r"([\/\*\-\+\(\)])", e),
+        "tuples": lambda e: list(evaluator.iter_instructions(e)),
+        "program": evaluator.compile_expression,
+        "compiled": compiled,
+    }
+    results = {}
+    for name, expressions in cases.items():
+        for representation, build in representations.items():
+            # a full collection empties the free lists, whose reused objects
+            # would not be traced as new allocations
+            gc.collect()
+            tracemalloc.start()
+            try:
+                kept = [build(expression) for expression in expressions]
+                size = tracemalloc.get_traced_memory()[0]
+            finally:
+                tracemalloc.stop()
+            results[f"memory.{representation}.{name}"] = size / len(kept)
+    return results
+
+
+def bench_server(
+    clients: int = 8, requests: int = 200, quick: bool = False
+) -> dict[str, float]:
+    """
+    Measures throughput and latency of a server process driven by concurrent
+    clients, each sending its requests one at a time on its own connection.
+    """
+    if quick:
+        requests = requests // 4
+    port = free_port()
+    command = [sys.executable, str(PACKAGE_DIR / "server.py")]
+    command += ["--host", "127.0.0.1", "--port", str(port)]
+    process = subprocess.Popen(
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        expressions = [
+            generate_expression(length=20, depth=2, seed=i) for i in range(requests)
+        ]
+        latencies = []
+        lock = threading.Lock()
+
+        def drive() -> None:
+            client = Client(ip="127.0.0.1", port=port)
+            client.connect_to_host()
+            timings = []
+            for expression in expressions:
+                start = time.perf_counter()
+                client.send_to_server(expression)
+                timings.append(time.perf_counter() - start)
+            client.close_connection()
+            with lock:
+                latencies.extend(timings)
+
+        threads = [threading.Thread(target=drive) for _ in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "server.time_per_request": elapsed / len(latencies),
+        "server.latency_p50": percentile(latencies, 0.5),
+        "server.latency_p99": percentile(latencies, 0.99),
+    }
+
+
+def bench_cli(runs: int = 5, quick: bool = False) -> dict[str, float]:
+    """Measures the cold-start time of a one-shot CLI evaluation."""
+    if quick:
+        runs = 2
+    command = [sys.executable, str(PACKAGE_DIR / "calculate"), "-i", "1+2"]
+    timings = []
+    # run from a temp dir so the CLI log file is not written into the repo
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(command, cwd=cwd, capture_output=True, check=True)
+            timings.append(time.perf_counter() - start)
+    return {"cli.cold_start": min(timings)}
+
+
+def run_benchmarks(suites: list[str], quick: bool = False) -> dict:
+    """Runs the given benchmark suites and collects their results."""
+    functions = {
+        "engine": bench_engine,
+        "memory": bench_memory,
+        "server": bench_server,
+        "cli": bench_cli,
+    }
+    results = {}
+    for suite in suites:
+        results.update(functions[suite](quick=quick))
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Compares results against a baseline.
+
+    Returns: descriptions of results slower than the baseline by over threshold
+    """
+    regressions = []
+    for name, value in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        ratio = value / base
+        if ratio > 1 + threshold:
+            unit = "B" if name.startswith("memory.") else "s"
+            regressions.append(
+                f"{name}: {base:.3g}{unit} -> {value:.3g}{unit} ({ratio:.2f}x)"
+            )
+    return regressions
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses command-line args to select and compare benchmarks."""
+    parser = argparse.ArgumentParser(description="Calculator benchmarks.")
+    parser.add_argument(
+        "--suite",
+        "-s",
+        choices=SUITES,
+        action="append",
+        help="Benchmark suite to run; repeat for several. Defaults to all.",
+    )
+    parser.add_argument("--quick", action="store_true", help="Run fewer iterations.")
+    parser.add_argument("--save", type=str, help="Save results to a JSON file.")
+    parser.add_argument("--compare", type=str, help="Baseline JSON to compare to.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown against the baseline, e.g. 0.2 for 20%%.",
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    current = run_benchmarks(args.suite or SUITES, quick=args.quick)
+    for name, value in current["results"].items():
+        if name.startswith("memory."):
+            print(f"{name:<40} {value:>14.0f} B")
+        else:
+            print(f"{name:<40} {value * 1e6:>14.2f} us")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+        print(f"Saved results to {args.save}")
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions against baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
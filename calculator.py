@@ -1,9 +1,12 @@
 # built-in imports
 import logging
 import re
+import time
+from contextlib import nullcontext
+from decimal import Decimal
 
-# third party imports
-from sympy import sympify
+# custom imports
+import evaluator
 
 LOG = logging.getLogger(__name__)
 
@@ -11,12 +14,82 @@ LOG = logging.getLogger(__name__)
 class Calculator(object):
     """Class to calculate arithmetic string inputs."""
 
-    def __init__(self):
+    ENGINES = ["precedence", "classic"]
+    NUMBERS = list(evaluator.NUMBER_TYPES)
+    # longer inputs are evaluated in one streaming pass instead of being cached
+    MAX_CACHED_LENGTH = 4096
+
+    def __init__(
+        self,
+        engine: str = "precedence",
+        cache_size: int = 256,
+        metrics: "metrics.Registry" = None,
+        number: str = "float",
+        precision: int = None,
+        result_cache: str = None,
+        result_cache_slots: int = 65536,
+        max_tokens: int = None,
+        max_depth: int = None,
+        max_cost: int = None,
+        profiler: "profiler.Profiler" = None,
+    ):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected {self.ENGINES}")
+        evaluator.get_number_type(number)
+        self.engine = engine
+        self.number = number
+        self.precision = precision
+        self.cache = evaluator.ProgramCache(max_size=cache_size)
+        # bounds on the work of one input, see evaluator.Limits
+        self.limits = evaluator.Limits(max_tokens, max_depth, max_cost)
+        self.result_cache = None
+        if result_cache:
+            # imported here so runs without a result cache never load mmap
+            from result_cache import ResultCache
+
+            self.result_cache = ResultCache(result_cache, slots=result_cache_slots)
         self.operator_list = ["+", "-", "*", "/"]
+        self.metrics = metrics
+        if metrics is not None:
+            self.create_metrics(metrics)
+        # samples calls of run() when given
+        self.profiler = profiler
+
+    def create_metrics(self, registry: "metrics.Registry") -> None:
+        """Creates the phase timing and cache metrics on the given registry."""
+        name = "calculator_phase_seconds"
+        help = "Time spent in each phase of Calculator.run()."
+        self.phase_timings = {
+            phase: registry.histogram(name, help, {"phase": phase})
+            for phase in ["parse", "evaluate", "serialize"]
+        }
+        for stat in ["hits", "misses", "evictions", "size"]:
+            registry.gauge(
+                f"calculator_cache_{stat}",
+                f"Compiled expression cache {stat}.",
+                func=lambda stat=stat: self.cache.stats()[stat],
+            )
+        if self.result_cache is not None:
+            for stat in ["hits", "misses"]:
+                registry.gauge(
+                    f"calculator_result_cache_{stat}",
+                    f"Persistent result cache {stat} in this process.",
+                    func=lambda stat=stat: self.result_cache.stats()[stat],
+                )
 
     def strip_parens(self, input: str) -> str:
-        """Strips the outer parentheses of the given input."""
-        return input.strip("(").strip(")")
+        """
+        Strips the parentheses enclosing the whole input.
+        Ex. input "((1+2))" -> "1+2", but "(1+2)*(3+4)" is left as it is
+        """
+        while input.startswith("(") and input.endswith(")"):
+            depth = 0
+            for char in input[:-1]:
+                depth += {"(": 1, ")": -1}.get(char, 0)
+                if not depth:
+                    return input
+            input = input[1:-1]
+        return input
 
     def expr_is_float(self, input: str) -> bool:
         """
@@ -50,37 +123,55 @@ class Calculator(object):
                 -> ['7', '/', '', '-', '4', '-', '3', '*', '', '-', '2']
                 -> ['7', '/', '-4', '-', '3', '*', '-2']
         """
-        for i, val in enumerate(expr_list):
-            if not val:
-                neg = expr_list[i + 1] + expr_list[i + 2]
-                expr_list[i] = neg
-                del expr_list[i + 1 : i + 3]
-                LOG.debug(f"Resolved negatives: {expr_list}")
-        return expr_list
+        resolved = []
+        i = 0
+        while i < len(expr_list):
+            val = expr_list[i]
+            if val:
+                resolved.append(val)
+                i += 1
+            else:
+                resolved.append(expr_list[i + 1] + expr_list[i + 2])
+                i += 3
+        LOG.debug("Resolved negatives: %s", resolved)
+        return resolved
 
     def resolve_mul_div(self, expr_list: list[str]) -> list[str]:
         """
-        Recursively solves the multiplication/division parts of an expression.
+        Solves the multiplication/division parts of an expression in one pass.
         Returns the expression list with only addition/subtraction left.
         Ex. input "7/-4-3*-2" as list:
                 -> ['7', '/', '-4', '-', '3', '*', '-2']
                 -> [-1.75, '-', -6.0]
         """
-        for i, val in enumerate(expr_list):
-            if val in ["*", "/"]:
-                l_idx = i - 1
-                r_idx = i + 2
-                sol = self.compute_expression(expr_list[l_idx:r_idx])
-                expr_list = expr_list[:l_idx] + [sol] + expr_list[r_idx:]
-                break
-        while "*" in expr_list or "/" in expr_list:
-            LOG.debug(f"Resolved mul/div: {expr_list}")
-            expr_list = self.resolve_mul_div(expr_list)
-        return expr_list
+        resolved = [expr_list[0]]
+        for i in range(1, len(expr_list) - 1, 2):
+            op = expr_list[i]
+            if op in ["*", "/"]:
+                lval, rval = float(resolved[-1]), float(expr_list[i + 1])
+                resolved[-1] = self.compute_operation(op, lval, rval)
+            else:
+                resolved.append(op)
+                resolved.append(expr_list[i + 1])
+        LOG.debug("Resolved mul/div: %s", resolved)
+        return resolved
+
+    def compute_operation(self, op: str, lval: float, rval: float) -> float:
+        """Computes a single binary operation."""
+        match op:
+            case "+":
+                return lval + rval
+            case "-":
+                return lval - rval
+            case "*":
+                return lval * rval
+            case "/":
+                return lval / rval
+        raise ValueError(f"Unknown operator '{op}'")
 
     def compute_expression(self, expr_list: list[str]) -> float:
         """
-        Recursively computes an expression from left to right.
+        Computes an expression from left to right in one pass.
         NOTE: Does not follow order of operations; use resolve_mul_div() first.
         Ex. input "7/-4-3":
                 -> ['7', '/', '-4', '-', '3']
@@ -89,58 +180,204 @@ class Calculator(object):
                 -> ['7', '/', '-4', '-', '3', '*', '-2']
                 -> 9.5
         """
-        if len(expr_list) == 1:
-            return float(expr_list[0])
-        l_expr = expr_list[:3]
-        r_expr = expr_list[3:]
-        lval, rval = float(l_expr[0]), float(l_expr[2])
-
-        op = expr_list[1]
-        if op in self.operator_list:
-            LOG.debug(f"Sub-equation: {expr_list}")
-            match op:
-                case "+":
-                    result = lval + rval
-                case "-":
-                    result = lval - rval
-                case "*":
-                    result = lval * rval
-                case "/":
-                    result = lval / rval
-            return self.compute_expression([str(result)] + r_expr)
-
-    def evaluate_expression(self, expression: str) -> float:
-        """
-        Evaluates an arithmetic equation string.
+        LOG.debug("Sub-equation: %s", expr_list)
+        result = float(expr_list[0])
+        for i in range(1, len(expr_list), 2):
+            result = self.compute_operation(
+                expr_list[i], result, float(expr_list[i + 1])
+            )
+        return result
+
+    def evaluate_expression(
+        self,
+        expression: str,
+        engine: str = None,
+        number: str = None,
+        precision: int = None,
+    ) -> float:
+        """
+        Evaluates an arithmetic equation string with the given engine.
+        Defaults to the engine the calculator was created with.
+            - "precedence": compiled once with shunting-yard, cached per expression
+            - "classic": string-rewrite loop over innermost parentheses
+
+        Number selects the arithmetic, defaulting to the calculator's:
+            - "float": IEEE-754 doubles
+            - "fraction": exact rationals, e.g. "1/3*3" is exactly 1
+            - "decimal": decimal digits rounded to the given precision
+
+        The precedence engine raises evaluator.LimitError for an input over the
+        calculator's token, nesting or cost limits, before evaluating it.
+        """
+        engine = engine or self.engine
+        number = number or self.number
+        precision = precision or self.precision
+        if engine == "precedence":
+            if len(expression) > self.MAX_CACHED_LENGTH:
+                return evaluator.evaluate(
+                    expression, None, number, precision, self.limits
+                )
+            program = self.cache.get(expression, number, self.limits)
+            return program.evaluate(None, precision)
+        if number != "float":
+            raise ValueError(f"The classic engine does not support {number} numbers")
+        return self.evaluate_classic(expression)
+
+    def evaluate_classic(self, expression: str) -> float:
+        """
+        Evaluates an arithmetic equation string by repeatedly rewriting
+        its innermost parentheses with their result.
         Assumes equation is provided in a valid format, i.e.
         no unmatched/empty parentheses or hanging operators.
         """
-        expression = self.strip_parens(expression)
+        expression = self.strip_parens("".join(expression.split()))
+        if self.expr_is_float(expression):
+            return float(expression)
         while any(op in expression for op in self.operator_list):
             base_expr = self.get_base_expression(expression)
             base_stripped = self.strip_parens(base_expr)
-            base_list = re.split("([\/\*\-\+])", base_stripped)
+            base_list = re.split(r"([\/\*\-\+])", base_stripped)
             base_list = self.resolve_negatives(base_list)
             base_list = self.resolve_mul_div(base_list)
             result = self.compute_expression(base_list)
-            expression = expression.replace(base_expr, str(result))
+            # written without an exponent, whose sign would read as an operator
+            expression = expression.replace(base_expr, f"{Decimal(repr(result)):f}")
             if self.expr_is_float(expression):
                 break
         return result
 
-    def run(self, input: str) -> None:
+    def evaluate_batch(self, expression: str, variables: dict) -> "numpy.ndarray":
+        """
+        Evaluates an expression over whole columns of values at once.
+        The expression is compiled once and run with vectorized NumPy operations.
+        Ex. evaluate_batch("x * 2 + y", {"x": [1, 2], "y": [3, 4]})
+                -> array([5., 8.])
+
+        Args:
+            expression: arithmetic string, may reference the given variable names
+            variables: mapping of variable name to scalar or array-like column
+
+        Returns: array of results, broadcast to the shape of the columns
+        """
+        # imported here so scalar use of the calculator never loads NumPy
+        try:
+            import numpy as np
+        except ImportError as e:
+            raise ImportError("NumPy is required for evaluate_batch()") from e
+
+        columns = {
+            name: np.asarray(values, dtype=float) for name, values in variables.items()
+        }
+        shape = np.broadcast_shapes(*(column.shape for column in columns.values()))
+        program = self.cache.get(expression, "float", self.limits)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            result = program.evaluate(columns)
+        return np.broadcast_to(np.asarray(result, dtype=float), shape).copy()
+
+    def evaluate_many(
+        self,
+        expressions: list[str],
+        variables: dict = None,
+        number: str = None,
+        precision: int = None,
+    ) -> list:
+        """
+        Evaluates many expressions together, in order.
+        With the precedence engine the expressions are compiled into one graph,
+        so a subexpression shared between them is evaluated only once and
+        constant subexpressions are folded at compile time.
+        Ex. evaluate_many(["(2+3)*x", "(2+3)*x - 1"], {"x": 2})
+                -> [10.0, 9.0]
+
+        Returns: result of each expression, or the exception it failed with
+        """
+        number = number or self.number
+        if self.engine == "classic":
+            results = []
+            for expression in expressions:
+                try:
+                    results.append(self.evaluate_expression(expression, None, number))
+                except Exception as e:
+                    results.append(e)
+            return results
+        batch = evaluator.compile_batch(expressions, number, self.limits)
+        return batch.evaluate(variables, precision or self.precision)
+
+    def run_many(
+        self, inputs: list[str], number: str = None, precision: int = None
+    ) -> list[str]:
+        """Runs the calculator on many inputs, sharing common subexpressions."""
+        LOG.info("Inputs: %d", len(inputs))
+        results = []
+        for value in self.evaluate_many(inputs, None, number, precision):
+            if not isinstance(value, Exception):
+                try:
+                    results.append(str(value))
+                    continue
+                except ValueError as error:
+                    value = error
+            e = evaluator.error_message(value).replace("\n", " ")
+            results.append(f"Error: {e}")
+        return results
+
+    def run_timed(self, input: str, number: str = None, precision: int = None) -> str:
+        """Evaluates an input while timing its parse/evaluate/serialize phases."""
+        start = time.perf_counter()
+        program = None
+        if self.engine == "precedence" and len(input) <= self.MAX_CACHED_LENGTH:
+            program = self.cache.get(input, number or self.number, self.limits)
+        parsed = time.perf_counter()
+        if program is not None:
+            value = program.evaluate(None, precision or self.precision)
+        else:
+            value = self.evaluate_expression(input, None, number, precision)
+        evaluated = time.perf_counter()
+        result = str(value)
+        serialized = time.perf_counter()
+
+        self.phase_timings["parse"].observe(parsed - start)
+        self.phase_timings["evaluate"].observe(evaluated - parsed)
+        self.phase_timings["serialize"].observe(serialized - evaluated)
+        return result
+
+    def result_key(self, input: str, number: str = None, precision: int = None) -> str:
+        """
+        Gets the persistent result cache key of an input.
+        Ex. "1 +  2" -> "precedence|float||1 + 2"
+        """
+        number = number or self.number
+        precision = precision or self.precision or ""
+        return f"{self.engine}|{number}|{precision}|{evaluator.normalize(input)}"
+
+    def run(self, input: str, number: str = None, precision: int = None) -> None:
         """Runs the calculator."""
-        LOG.info(f"Input: {input}")
+        LOG.info("Input: %s", input)
+        if self.result_cache is not None:
+            key = self.result_key(input, number, precision)
+            result = self.result_cache.get(key)
+            if result is not None:
+                LOG.info("Output [cached]: %s", result)
+                return result
+        sampled = nullcontext() if self.profiler is None else self.profiler.sample()
         try:
-            result = str(self.evaluate_expression(input))
-            LOG.info(f"Output [irene]: {result}")
+            with sampled:
+                if self.metrics is None:
+                    value = self.evaluate_expression(input, None, number, precision)
+                    result = str(value)
+                else:
+                    result = self.run_timed(input, number, precision)
+            LOG.info("Output [irene]: %s", result)
             # check solution against library
+            # from sympy import sympify
             # result = str(float(sympify(input)))
-            # LOG.info(f"Output [sympy]: {result}")
+            # LOG.info("Output [sympy]: %s", result)
         except Exception as e:
-            e = str(e).replace("\n", " ")
+            e = evaluator.error_message(e).replace("\n", " ")
             result = f"Error: {e}"
             LOG.error(e)
+        else:
+            if self.result_cache is not None:
+                self.result_cache.put(key, result)
         return result
 
 
@@ -1,7 +1,9 @@
 # built-in imports
+import itertools
 import logging
 import socket
 import sys
+import time
 from collections import OrderedDict
 from functools import partial
 from pathlib import Path
@@ -10,6 +12,8 @@ from pathlib import Path
 from PySide6 import QtCore, QtGui, QtWidgets
 
 # custom imports
+import evaluator
+import protocol
 from calculator import Calculator
 from client import Client
 
@@ -22,37 +26,161 @@ except socket.gaierror:
 LOG = logging.getLogger(__name__)
 
 
-class CalculatorUI(QtWidgets.QMainWindow, Client):
+class RemoteCalculator(QtCore.QObject):
+    """
+    Sends requests to the server from a worker thread, so the UI never waits
+    on the network. Requests canceled before they are sent are skipped, and a
+    reply slower than the timeout drops the connection and reconnects.
+    """
+
+    connected = QtCore.Signal(bool)
+    # request id, result, whether it succeeded, round-trip seconds
+    finished = QtCore.Signal(int, str, bool, float)
+    failed = QtCore.Signal(int, str)
+    requested = QtCore.Signal(int, str)
+
+    def __init__(self, ip: str = "0.0.0.0", port: int = 8000, timeout: float = 5.0):
+        super(RemoteCalculator, self).__init__()
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.client = None
+        # id of the only request still wanted; set from the UI thread
+        self.latest = None
+
+        self.thread = QtCore.QThread()
+        self.moveToThread(self.thread)
+        self.thread.started.connect(self.connect_to_host)
+        self.requested.connect(self.evaluate)
+
+    def start(self) -> None:
+        """Starts the worker thread, which connects first; hook up signals before."""
+        self.thread.start()
+
+    def submit(self, request_id: int, message: str) -> None:
+        """Queues a request on the worker thread, replacing any earlier one."""
+        self.latest = request_id
+        self.requested.emit(request_id, message)
+
+    def cancel(self) -> None:
+        """Cancels the current request; a reply already in flight is ignored."""
+        self.latest = None
+
+    def stop(self) -> None:
+        """Closes the connection and stops the worker thread."""
+        self.cancel()
+        client = self.client
+        if client is not None:
+            # wakes the worker thread if it is waiting on a reply
+            try:
+                client.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.thread.quit()
+        self.thread.wait()
+        self.disconnect_from_host()
+
+    @QtCore.Slot()
+    def connect_to_host(self) -> bool:
+        """Connects to the server, giving up after the timeout."""
+        client = Client(ip=self.ip, port=self.port)
+        client.socket.settimeout(self.timeout)
+        try:
+            success = client.connect_to_host()
+        except OSError as e:
+            LOG.error(e)
+            success = False
+        if success:
+            self.client = client
+        else:
+            client.close_connection()
+        self.connected.emit(success)
+        return success
+
+    @QtCore.Slot()
+    def disconnect_from_host(self) -> None:
+        """Closes the connection, if any."""
+        if self.client is not None:
+            self.client.close_connection()
+            self.client = None
+
+    @QtCore.Slot(int, str)
+    def evaluate(self, request_id: int, message: str) -> None:
+        """Sends one request and waits for its reply on the worker thread."""
+        if request_id != self.latest:
+            # canceled or replaced while queued
+            return
+        if self.client is None and not self.connect_to_host():
+            self.failed.emit(request_id, "Not connected to server")
+            return
+        start = time.perf_counter()
+        try:
+            result = self.client.evaluate(message)
+        except OSError as e:
+            # the reply may still arrive, so the stream can not be reused
+            LOG.error(f"Request failed: {e}")
+            self.disconnect_from_host()
+            self.failed.emit(request_id, str(e) or type(e).__name__)
+            return
+        latency = time.perf_counter() - start
+        self.finished.emit(request_id, str(result.value), result.ok, latency)
+
+
+class CalculatorUI(QtWidgets.QMainWindow):
     """Class to build the UI for calculating arithmetic strings."""
 
     WIN_WIDTH, WIN_HEIGHT = (200, 300)
-    VALID_INPUT_REGEX = "^([-+]? ?(\d+|\(\g<1>\))( ?[-+*\/] ?\g<1>)?)$"
+    # wait for typing to pause this long before a live evaluation on the server
+    LIVE_DELAY_MS = 150
+    # answer locally when the server takes longer than this
+    LATENCY_THRESHOLD_MS = 300
+    # give up on a server reply after this many seconds
+    REQUEST_TIMEOUT = 5.0
+    # characters of the grammar, including function names such as "sqrt";
+    # malformed input is reported when it is evaluated
+    VALID_INPUT_REGEX = r"^[\w\s.+\-*/()]*$"
 
     def __init__(
         self,
         use_server: bool = True,
         ip: str = "0.0.0.0",
         window_title: str = "Calculator",
+        port: int = 8000,
     ):
-        super(CalculatorUI, self).__init__(ip=ip)
+        super(CalculatorUI, self).__init__()
         self.use_server = use_server
 
         self.right_align = False
         self.reverse_order = False
+        self.live_result = False
         self.input_string = ""
         self.button_list = []
         self.calculator = Calculator()
+        self.live_parser = evaluator.IncrementalParser()
+        self.live_timer = self.create_timer(self.LIVE_DELAY_MS, self.send_live_request)
+        self.fallback_timer = self.create_timer(
+            self.LATENCY_THRESHOLD_MS, self.fallback_to_local
+        )
+        self.request_ids = itertools.count(1)
+        # (request id, input, live) of the request awaiting a server reply
+        self.pending_request = None
 
         self.create_main_window(window_title)
         self.create_menu_bar()
         self.create_layout()
         self.create_connections()
 
+        self.remote = None
         if self.use_server:
-            success = self.connect_to_host()
-            if not success:
-                self.use_server = False
-                LOG.info("Using built-in calculator")
+            # connects in the background; the built-in calculator answers until then
+            self.remote = RemoteCalculator(
+                ip=ip, port=port, timeout=self.REQUEST_TIMEOUT
+            )
+            self.remote.connected.connect(self.server_connected)
+            self.remote.finished.connect(self.remote_finished)
+            self.remote.failed.connect(self.remote_failed)
+            self.use_server = False
+            self.remote.start()
 
     # -----------------
     # UI Main Functions
@@ -76,8 +204,10 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
         prefs_menu = menu_bar.addMenu("Preferences")
         self.create_menu_action("Right Align", "actn_prefs_alignment", prefs_menu)
         self.create_menu_action("Reverse Order", "actn_prefs_order", prefs_menu)
+        self.create_menu_action("Live Result", "actn_prefs_live", prefs_menu)
         self.actn_prefs_alignment.triggered.connect(self.alignment_pref_action_clicked)
         self.actn_prefs_order.triggered.connect(self.order_pref_action_clicked)
+        self.actn_prefs_live.triggered.connect(self.live_pref_action_clicked)
 
         # theme options
         self.theme_list = [
@@ -302,6 +432,14 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
                 getattr(self, numpad_row_name),
             )
 
+    def create_timer(self, interval: int, slot: callable) -> QtCore.QTimer:
+        """Creates a single-shot timer calling the slot after interval ms."""
+        timer = QtCore.QTimer(self)
+        timer.setSingleShot(True)
+        timer.setInterval(interval)
+        timer.timeout.connect(slot)
+        return timer
+
     def create_error_popup(self, message: str) -> None:
         """Creates a popup to display errors in the UI."""
         popup = QtWidgets.QErrorMessage(self)
@@ -314,6 +452,8 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
     def input_changed(self) -> None:
         """Updates input string based on keyboard input via line edit widget."""
         self.input_string = self.input_lineedit.text()
+        if self.live_result:
+            self.update_live_result()
 
     def clear_button_clicked(self) -> None:
         """Clears the input string and UI."""
@@ -325,14 +465,21 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
         """Sends input string to be calculated."""
         if not self.input_string:
             return
+        self.evaluate_input(live=False)
 
-        result = None
-        if self.use_server:
-            result = self.send_to_server(self.input_string)
-        else:
-            result = self.calculator.run(self.input_string)
+    def show_result(self, result: str, ok: bool, live: bool) -> None:
+        """
+        Shows a result; a final one replaces the input, a live one does not.
+        A failed result holds the error message.
+        """
+        if live:
+            if ok:
+                self.result_lineedit.setText(result)
+            else:
+                self.result_lineedit.clear()
+            return
 
-        if "Error" in result:
+        if not ok:
             self.create_error_popup(result)
             self.clear_input_string()
             self.result_lineedit.clear()
@@ -352,6 +499,15 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
         self.rebuild_widget()
         LOG.debug(f"Set numpad reverse order to {self.reverse_order}")
 
+    def live_pref_action_clicked(self) -> None:
+        """Toggles showing the result while typing."""
+        self.live_result = not self.live_result
+        if self.live_result:
+            self.update_live_result()
+        else:
+            self.cancel_request()
+        LOG.debug(f"Set live result to {self.live_result}")
+
     def theme_action_clicked(self, theme_name: str) -> None:
         """Sets the selected theme."""
         theme_action = getattr(self, f"actn_theme_{theme_name}")
@@ -372,6 +528,100 @@ class CalculatorUI(QtWidgets.QMainWindow, Client):
         self.input_string += x
         self.input_lineedit.setText(self.input_string)
 
+    def update_live_result(self) -> None:
+        """
+        Shows the result of the input so far.
+        The input is parsed incrementally, so each keystroke only re-parses
+        the edited end of it. With a server, complete inputs are sent once
+        typing pauses, and any request still in flight is canceled.
+        """
+        self.cancel_request()
+        self.live_parser.update(self.input_string)
+        try:
+            result = str(self.live_parser.result())
+        except (ValueError, ArithmeticError):
+            # incomplete input, e.g. "2*(", keeps the result field empty
+            self.result_lineedit.clear()
+            return
+        if self.use_server:
+            self.live_timer.start()
+        else:
+            self.result_lineedit.setText(result)
+
+    def send_live_request(self) -> None:
+        """Evaluates the input for a live result once typing has paused."""
+        self.evaluate_input(live=True)
+
+    def evaluate_input(self, live: bool) -> None:
+        """
+        Evaluates the input on the server without blocking the UI, or with the
+        built-in calculator if not connected. The result is shown when the
+        reply arrives; a reply slower than the latency threshold is replaced
+        by a local result.
+        """
+        self.cancel_request()
+        if not self.use_server:
+            self.show_local_result(self.input_string, live)
+            return
+        request_id = next(self.request_ids)
+        self.pending_request = (request_id, self.input_string, live)
+        self.remote.submit(request_id, self.input_string)
+        self.fallback_timer.start()
+
+    def show_local_result(self, input_string: str, live: bool) -> None:
+        """Evaluates an input with the built-in calculator and shows the result."""
+        result = self.calculator.run(input_string)
+        ok = protocol.result_status(result) == protocol.STATUS_OK
+        self.show_result(result, ok, live)
+
+    def remote_finished(
+        self, request_id: int, result: str, ok: bool, latency: float
+    ) -> None:
+        """Shows a server result if it is for the request still pending."""
+        if self.pending_request is None or self.pending_request[0] != request_id:
+            LOG.debug(f"Dropped reply to canceled request {request_id}")
+            return
+        LOG.debug(f"Server replied in {latency * 1000:.1f}ms")
+        _, _, live = self.pending_request
+        self.pending_request = None
+        self.fallback_timer.stop()
+        self.show_result(result, ok, live)
+
+    def remote_failed(self, request_id: int, error: str) -> None:
+        """Answers a failed server request locally."""
+        LOG.warning(f"Server request failed: {error}")
+        if self.pending_request is not None and self.pending_request[0] == request_id:
+            self.fallback_to_local()
+
+    def fallback_to_local(self) -> None:
+        """Answers the pending request with the built-in calculator."""
+        if self.pending_request is None:
+            return
+        _, input_string, live = self.pending_request
+        LOG.info("Server is slow or unavailable, using built-in calculator")
+        self.cancel_request()
+        self.show_local_result(input_string, live)
+
+    def cancel_request(self) -> None:
+        """Cancels any pending request; a reply already in flight is ignored."""
+        self.live_timer.stop()
+        self.fallback_timer.stop()
+        self.pending_request = None
+        if self.remote is not None:
+            self.remote.cancel()
+
+    def server_connected(self, success: bool) -> None:
+        """Switches to the server once connected, or stays on the built-in one."""
+        self.use_server = success
+        if not success:
+            LOG.info("Using built-in calculator")
+
+    def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        """Stops the server connection thread with the window."""
+        if self.remote is not None:
+            self.remote.stop()
+        super(CalculatorUI, self).closeEvent(event)
+
     def clear_input_string(self) -> None:
         """Clears the input string."""
         self.input_string = ""
@@ -1,5 +1,14 @@
+import bisect
+import hashlib
+import itertools
 import logging
+import queue
 import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+from evaluator import normalize
 
 
 LOG = logging.getLogger(__name__)
@@ -8,16 +17,23 @@ LOG = logging.getLogger(__name__)
 class Client(object):
     """Simple client class."""
 
+    # requests sent before reading responses, as the server stops reading a
+    # connection with too many requests in flight; beyond the socket buffers
+    # both ends would wait on each other
+    PIPELINE_WINDOW = 1024
+
     def __init__(
-        self, ip: str = "0.0.0.0", port: int = 8000, buffer: int = 1024
+        self, ip: str = "0.0.0.0", port: int = 8000, buffer: int = 65536
     ):
         self.host = ip
         self.port = port
         self.buffer = buffer
         self.server = (ip, port)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.request_ids = itertools.count(1)
+        self.responses = {}
 
-    def connect_to_host(self) -> None:
+    def connect_to_host(self) -> bool:
         """Attempts a connection to the server."""
         try:
             LOG.info("Connecting to server...")
@@ -28,20 +44,607 @@ class Client(object):
             LOG.error(e)
             return False
 
-    def send_to_server(self, message: str) -> str:
-        """Sends the given message to the server and receives a return message."""
-        result = None
+    def reconnect(self) -> bool:
+        """Replaces the socket with a new connection to the same server."""
+        timeout = self.socket.gettimeout()
+        self.socket.close()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.settimeout(timeout)
+        # responses still owed on the old connection will never arrive
+        self.responses.clear()
+        return self.connect_to_host()
+
+    def submit(self, message: str, flags: int = 0) -> int:
+        """Sends a request without waiting for its response; returns its id."""
+        return self.submit_many([message], flags)[0]
 
-        while True:
-            LOG.info(f"Sending: {message}")
-            self.socket.sendall(message.encode())
-            result = self.socket.recv(self.buffer).decode()
-            break
+    def submit_many(self, messages: list[str], flags: int = 0) -> list[int]:
+        """Sends several requests in a single write; returns their ids."""
+        request_ids = []
+        frames = []
+        for message in messages:
+            request_id = next(self.request_ids) % protocol.MAX_REQUEST_ID
+            request_ids.append(request_id)
+            frames.append(protocol.encode_frame(request_id, message.encode(), flags))
+        self.socket.sendall(b"".join(frames))
+        return request_ids
 
-        LOG.info(f"Received: {result}")
+    def receive(self, request_id: int) -> protocol.Frame:
+        """
+        Receives the response to the given request.
+        Responses to other pipelined requests that arrive first are kept
+        until they are asked for.
+        """
+        while request_id not in self.responses:
+            frame = protocol.read_frame(self.socket, self.buffer)
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            self.responses[frame.request_id] = frame
+        return self.responses.pop(request_id)
+
+    def send_to_server(
+        self, message: str, number: str = "float", precision: int = None
+    ) -> str:
+        """
+        Sends the given message to the server and receives a return message.
+        The number type and precision select exact arithmetic for this request.
+        """
+        LOG.info("Sending: %s", message)
+        request_id = self.submit(message, protocol.encode_options(number, precision))
+        result = self.receive(request_id).payload.decode()
+        LOG.info("Received: %s", result)
         return result
 
+    def send_many(
+        self, messages: list[str], number: str = "float", precision: int = None
+    ) -> list[str]:
+        """
+        Pipelines the given messages on one connection.
+        Up to PIPELINE_WINDOW requests are sent before their responses are
+        read, and results are returned in the order of the messages.
+        """
+        flags = protocol.encode_options(number, precision)
+        results = []
+        for start in range(0, len(messages), self.PIPELINE_WINDOW):
+            window = messages[start : start + self.PIPELINE_WINDOW]
+            request_ids = self.submit_many(window, flags)
+            results += [self.receive(i).payload.decode() for i in request_ids]
+        return results
+
+    def evaluate(
+        self, message: str, number: str = "float", precision: int = None
+    ) -> protocol.Result:
+        """
+        Sends the given message asking for a binary result, so a float comes
+        back exact and without parsing. Exact number types come back as text.
+        Ex. "1/4" -> Result(status=0, value=0.25)
+            "1/0" -> Result(status=1, value="Error: float division by zero")
+        """
+        flags = protocol.encode_options(number, precision) | protocol.FLAG_BINARY
+        return protocol.decode_results(self.receive(self.submit(message, flags)))[0]
+
+    def request_batch(
+        self,
+        messages: list[str],
+        number: str = "float",
+        precision: int = None,
+        binary: bool = True,
+    ) -> protocol.Frame:
+        """Sends the given messages as one batch request and receives its response."""
+        if any("\n" in message for message in messages):
+            raise ValueError("Batched messages can not contain newlines")
+        flags = protocol.encode_options(number, precision) | protocol.FLAG_BATCH
+        if binary:
+            flags |= protocol.FLAG_BINARY
+        return self.receive(self.submit("\n".join(messages), flags))
+
+    def evaluate_many(
+        self, messages: list[str], number: str = "float", precision: int = None
+    ) -> list[protocol.Result]:
+        """
+        Sends the given messages in a single request and gets every result in
+        one response frame, in message order.
+        """
+        return protocol.decode_results(
+            self.request_batch(messages, number, precision)
+        )
+
+    def evaluate_array(
+        self, messages: list[str]
+    ) -> tuple["numpy.ndarray", "numpy.ndarray"]:
+        """
+        Sends the given messages in a single request and gets the float results
+        as arrays of values and statuses; failed results have a NaN value.
+        """
+        return protocol.decode_arrays(self.request_batch(messages))
+
     def close_connection(self) -> None:
         """Closes the socket connection."""
         self.socket.close()
         LOG.info("Closed connection")
+
+
+class ClientPool(object):
+    """
+    Thread-safe pool of warm connections to one or more servers.
+    Each request takes the longest-idle connection, so requests rotate across
+    all connections and servers. A broken connection is reconnected, or
+    replaced by one to another server, and the request is sent again;
+    evaluations have no side effects, so a retry is always safe.
+    Ex. with ClientPool([("10.0.0.1", 8000), ("10.0.0.2", 8000)]) as pool:
+            pool.send_to_server("1+2") -> "3.0"
+    """
+
+    def __init__(
+        self,
+        servers: list[tuple[str, int]] = None,
+        size: int = 2,
+        buffer: int = 65536,
+        timeout: float = None,
+        retries: int = 1,
+    ):
+        """
+        Args:
+            servers: (ip, port) of each server to spread requests across
+            size: number of connections to keep to each server
+            buffer: max bytes to read from a socket at once
+            timeout: seconds to wait on a connection before treating it as broken
+            retries: times to resend a request after its connection breaks
+        """
+        self.servers = list(servers or [("0.0.0.0", 8000)])
+        self.size = size
+        self.buffer = buffer
+        self.timeout = timeout
+        self.retries = retries
+        self.idle = queue.Queue()
+        self.count = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._next_server = itertools.cycle(range(len(self.servers)))
+
+    def __enter__(self) -> "ClientPool":
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def connect(self) -> int:
+        """
+        Opens every connection up front so no request pays for TCP setup.
+        Returns the number of connections open.
+        """
+        while self.count < self.size * len(self.servers):
+            try:
+                client = self.create_client()
+            except ConnectionError:
+                break
+            if client is None:
+                break
+            self.idle.put(client)
+        return self.count
+
+    def create_client(self) -> Client:
+        """
+        Connects to the next server in turn, trying the others if it is down.
+        Returns None if the pool is full; raises ConnectionError if no server
+        accepts the connection.
+        """
+        with self._lock:
+            if self.count >= self.size * len(self.servers):
+                return None
+            self.count += 1
+        for _ in self.servers:
+            ip, port = self.servers[next(self._next_server)]
+            client = Client(ip=ip, port=port, buffer=self.buffer)
+            client.socket.settimeout(self.timeout)
+            try:
+                if client.connect_to_host():
+                    return client
+            except OSError as e:
+                LOG.error(e)
+            client.socket.close()
+        with self._lock:
+            self.count -= 1
+        raise ConnectionError(f"Could not connect to any of {self.servers}")
+
+    def acquire(self) -> Client:
+        """
+        Takes an idle connection, opening a new one while below the limit,
+        or waits for one to be released.
+        """
+        client = self.try_acquire()
+        if client is not None:
+            return client
+        return self.idle.get(timeout=self.timeout)
+
+    def try_acquire(self) -> Client:
+        """Takes an idle or new connection without waiting; None if there is none."""
+        if self.closed:
+            raise ConnectionError("Client pool is closed")
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.create_client()
+
+    def release(self, client: Client) -> None:
+        """Returns a connection to the pool for the next request."""
+        if self.closed:
+            client.close_connection()
+        else:
+            self.idle.put(client)
+
+    def discard(self, client: Client) -> None:
+        """Closes a broken connection and frees its place in the pool."""
+        client.socket.close()
+        with self._lock:
+            self.count -= 1
+
+    def request(self, send: callable) -> object:
+        """
+        Runs send(client) on a pooled connection. A connection that breaks is
+        reconnected to the same server and the request sent again, so a
+        restarted server is picked up transparently; if the server is down,
+        the request moves to another connection. Any other error may leave a
+        frame half sent or read, so the connection is closed before it is raised.
+        """
+        client = self.acquire()
+        for attempt in range(self.retries + 1):
+            try:
+                result = send(client)
+            except OSError as e:
+                LOG.warning(f"Connection to {client.host}:{client.port} broke: {e}")
+                try:
+                    reconnected = client.reconnect()
+                except OSError:
+                    reconnected = False
+                if not reconnected:
+                    self.discard(client)
+                if attempt == self.retries:
+                    if reconnected:
+                        self.release(client)
+                    raise
+                if not reconnected:
+                    client = self.acquire()
+            except BaseException:
+                self.discard(client)
+                raise
+            else:
+                self.release(client)
+                return result
+
+    def send_to_server(
+        self, message: str, number: str = "float", precision: int = None
+    ) -> str:
+        """Sends the given message on a pooled connection and gets the result."""
+        return self.request(
+            lambda client: client.send_to_server(message, number, precision)
+        )
+
+    def evaluate(
+        self, message: str, number: str = "float", precision: int = None
+    ) -> protocol.Result:
+        """Sends the given message on a pooled connection for a binary result."""
+        return self.request(lambda client: client.evaluate(message, number, precision))
+
+    def evaluate_many(
+        self, messages: list[str], number: str = "float", precision: int = None
+    ) -> list[protocol.Result]:
+        """Sends the given messages as one batch request on a pooled connection."""
+        return self.request(
+            lambda client: client.evaluate_many(messages, number, precision)
+        )
+
+    def send_many(
+        self, messages: list[str], number: str = "float", precision: int = None
+    ) -> list[str]:
+        """
+        Spreads the given messages across the pool in parallel.
+        Messages are split into one pipelined chunk per connection, every chunk
+        is sent before any response is read, and results keep message order.
+        """
+        if not messages:
+            return []
+        step = Client.PIPELINE_WINDOW * self.size * len(self.servers)
+        if len(messages) > step:
+            # keep each connection's pipeline within its window
+            results = []
+            for start in range(0, len(messages), step):
+                chunk = messages[start : start + step]
+                results += self.send_many(chunk, number, precision)
+            return results
+        flags = protocol.encode_options(number, precision)
+        clients = [self.acquire()]
+        while len(clients) < min(len(messages), self.size * len(self.servers)):
+            try:
+                client = self.try_acquire()
+            except ConnectionError:
+                client = None
+            if client is None:
+                break
+            clients.append(client)
+
+        chunk_size = -(-len(messages) // len(clients))
+        chunks = [
+            messages[i : i + chunk_size] for i in range(0, len(messages), chunk_size)
+        ]
+        broken = []
+        done = False
+        try:
+            pending = []
+            for chunk, client in zip(chunks, clients):
+                try:
+                    pending.append((chunk, client, client.submit_many(chunk, flags)))
+                except OSError:
+                    pending.append((chunk, client, None))
+
+            results = []
+            for chunk, client, request_ids in pending:
+                try:
+                    if request_ids is None:
+                        raise ConnectionError("Could not send requests")
+                    results += [client.receive(i).payload.decode() for i in request_ids]
+                except OSError as e:
+                    # resend the whole chunk on another connection
+                    LOG.warning(f"Connection to {client.host}:{client.port} broke: {e}")
+                    broken.append(client)
+                    self.discard(client)
+                    results += self.request(
+                        lambda c, chunk=chunk: c.send_many(chunk, number, precision)
+                    )
+            done = True
+            return results
+        finally:
+            for client in clients:
+                if client in broken:
+                    continue
+                # responses may be left unread on a connection after an error
+                if done:
+                    self.release(client)
+                else:
+                    self.discard(client)
+
+    def close(self) -> None:
+        """Closes every pooled connection."""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close_connection()
+            except queue.Empty:
+                break
+
+
+def parse_endpoints(value: str, default_port: int = 8000) -> list[tuple[str, int]]:
+    """
+    Parses comma-separated "host[:port]" endpoints.
+    Ex. "10.0.0.1:8001,10.0.0.2" -> [("10.0.0.1", 8001), ("10.0.0.2", 8000)]
+    """
+    endpoints = []
+    for endpoint in value.split(","):
+        host, _, port = endpoint.strip().partition(":")
+        endpoints.append((host, int(port) if port else default_port))
+    return endpoints
+
+
+class Node(object):
+    """One server of a ShardedClient, with its pooled connections."""
+
+    def __init__(self, server: tuple[str, int], pool: ClientPool):
+        self.server = server
+        self.pool = pool
+        self.healthy = True
+        self.outstanding = 0
+
+    def __repr__(self) -> str:
+        state = "up" if self.healthy else "down"
+        return f"Node({self.server[0]}:{self.server[1]}, {state})"
+
+
+class ShardedClient(object):
+    """
+    Client that spreads requests across several servers.
+    Routing strategies:
+        - "hash": consistent hashing on the normalized expression, so a repeated
+          expression reaches the same server and hits its compiled cache
+        - "least": the server with the fewest requests in flight
+    A server that fails a request is ejected and its requests move to the
+    next server; a background health check ejects dead servers and brings
+    them back once they answer again.
+    Ex. with ShardedClient([("10.0.0.1", 8000), ("10.0.0.2", 8000)]) as client:
+            client.send_to_server("1+2") -> "3.0"
+    """
+
+    STRATEGIES = ["hash", "least"]
+    # points per server on the hash ring, to even out the share of each
+    VIRTUAL_NODES = 64
+
+    def __init__(
+        self,
+        servers: list[tuple[str, int]],
+        strategy: str = "hash",
+        size: int = 2,
+        timeout: float = None,
+        health_interval: float = 5.0,
+        health_timeout: float = 1.0,
+    ):
+        """
+        Args:
+            servers: (ip, port) of each server
+            strategy: how to pick the server of a request, "hash" or "least"
+            size: number of connections to keep to each server
+            timeout: seconds to wait on a connection before treating it as broken
+            health_interval: seconds between health checks, 0 to disable them
+            health_timeout: seconds a server has to answer a health check
+        """
+        if strategy not in self.STRATEGIES:
+            raise ValueError(
+                f"Unknown strategy '{strategy}', expected {self.STRATEGIES}"
+            )
+        self.strategy = strategy
+        self.nodes = [
+            Node(server, ClientPool([server], size=size, timeout=timeout))
+            for server in servers
+        ]
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.ring = sorted(
+            (self.hash(f"{ip}:{port}#{i}"), index)
+            for index, (ip, port) in enumerate(servers)
+            for i in range(self.VIRTUAL_NODES)
+        )
+        self.ring_keys = [key for key, _ in self.ring]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+
+    def __enter__(self) -> "ShardedClient":
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @staticmethod
+    def hash(key: str) -> int:
+        """Gets a stable 64-bit hash of a string."""
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def connect(self) -> int:
+        """
+        Opens the connections to every server and starts the health checks.
+        Returns the number of servers reachable.
+        """
+        for node in self.nodes:
+            node.healthy = node.pool.connect() > 0
+            if not node.healthy:
+                LOG.warning(f"Ejected {node}: could not connect")
+        if self.health_interval > 0 and self._health_thread is None:
+            self._health_thread = threading.Thread(
+                target=self.check_health_periodically, daemon=True
+            )
+            self._health_thread.start()
+        return sum(node.healthy for node in self.nodes)
+
+    def route(self, message: str) -> list[Node]:
+        """Gets the healthy nodes to try for a message, best first."""
+        if self.strategy == "hash":
+            start = bisect.bisect(self.ring_keys, self.hash(normalize(message)))
+            order = []
+            for i in range(len(self.ring)):
+                node = self.nodes[self.ring[(start + i) % len(self.ring)][1]]
+                if node not in order:
+                    order.append(node)
+                    if len(order) == len(self.nodes):
+                        break
+        else:
+            order = sorted(self.nodes, key=lambda node: node.outstanding)
+        healthy = [node for node in order if node.healthy]
+        if not healthy:
+            raise ConnectionError("No healthy servers")
+        return healthy
+
+    def request(self, nodes: list[Node], send: callable) -> object:
+        """
+        Runs send(pool) on the first node, moving on to the next node if it
+        fails. Failed nodes are ejected until a health check passes.
+        """
+        for node in nodes:
+            with self._lock:
+                node.outstanding += 1
+            try:
+                return send(node.pool)
+            except (OSError, queue.Empty) as e:
+                self.eject(node, e)
+            finally:
+                with self._lock:
+                    node.outstanding -= 1
+        raise ConnectionError("No healthy servers")
+
+    def send_to_server(
+        self, message: str, number: str = "float", precision: int = None
+    ) -> str:
+        """Sends the given message to the server picked for it."""
+        return self.request(
+            self.route(message),
+            lambda pool: pool.send_to_server(message, number, precision),
+        )
+
+    def send_many(
+        self, messages: list[str], number: str = "float", precision: int = None
+    ) -> list[str]:
+        """
+        Routes each message like send_to_server, then sends the messages for
+        each server in one batch, all servers in parallel.
+        Results keep message order.
+        """
+        groups = {}
+        for position, message in enumerate(messages):
+            nodes = self.route(message)
+            if self.strategy == "least":
+                # spread the batch evenly rather than all to the idlest server
+                node = nodes[position % len(nodes)]
+            else:
+                node = nodes[0]
+            groups.setdefault(node, []).append(position)
+
+        def send_group(node: Node, positions: list[int]) -> list[str]:
+            batch = [messages[position] for position in positions]
+            try:
+                return self.request(
+                    [node], lambda pool: pool.send_many(batch, number, precision)
+                )
+            except ConnectionError:
+                # the node was ejected; route its messages to the others
+                return self.send_many(batch, number, precision)
+
+        results = [None] * len(messages)
+        with ThreadPoolExecutor(max_workers=len(groups) or 1) as executor:
+            futures = {
+                executor.submit(send_group, node, positions): positions
+                for node, positions in groups.items()
+            }
+            for future, positions in futures.items():
+                for position, result in zip(positions, future.result()):
+                    results[position] = result
+        return results
+
+    def eject(self, node: Node, error: Exception) -> None:
+        """Stops routing to a node until a health check passes."""
+        if node.healthy:
+            LOG.warning(f"Ejected {node}: {error}")
+        node.healthy = False
+
+    def check_health(self) -> None:
+        """Checks every node with a fresh connection; ejects or restores it."""
+        for node in self.nodes:
+            ip, port = node.server
+            client = Client(ip=ip, port=port)
+            client.socket.settimeout(self.health_timeout)
+            try:
+                healthy = client.connect_to_host() and client.send_to_server("0")
+            except OSError as e:
+                healthy = False
+                error = e
+            else:
+                error = "health check failed"
+            finally:
+                client.socket.close()
+            if healthy and not node.healthy:
+                LOG.info(f"Restored {node}")
+                node.healthy = True
+            elif not healthy:
+                self.eject(node, error)
+
+    def check_health_periodically(self) -> None:
+        """Runs the health checks every interval until closed."""
+        while not self._stop.wait(self.health_interval):
+            self.check_health()
+
+    def close(self) -> None:
+        """Stops the health checks and closes every connection."""
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+            self._health_thread = None
+        for node in self.nodes:
+            node.pool.close()
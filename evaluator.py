@@ -0,0 +1,1218 @@
+# built-in imports
+import logging
+import math
+import operator
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from decimal import (
+    Decimal,
+    DecimalException,
+    DivisionByZero,
+    DivisionUndefined,
+    Overflow,
+    localcontext,
+)
+from fractions import Fraction
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+LOG = logging.getLogger(__name__)
+
+NUMBER, NAME, OPERATOR, LPAREN, RPAREN = range(5)
+CONST, VAR, BINARY, UNARY = range(4)
+# CONST stored in a program's array of floats rather than as an object
+FLOAT = 4
+TOKEN_REGEX = re.compile(
+    r"\s*(?:(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)"
+    r"|(?P<name>[A-Za-z_]\w*)"
+    r"|(?P<operator>\*\*|[-+*/])|(?P<lparen>\()|(?P<rparen>\))|(?P<invalid>\S))"
+)
+# an exponent still being typed after a number, e.g. "1e+", rather than a variable
+PARTIAL_EXPONENT = re.compile(r"(?<=[\d.])[eE][-+]\s*\Z")
+TOKEN_KINDS = {
+    "number": NUMBER,
+    "name": NAME,
+    "operator": OPERATOR,
+    "lparen": LPAREN,
+    "rparen": RPAREN,
+}
+
+# number types literals are converted to; operators work on each natively
+NUMBER_TYPES = {
+    "float": float,
+    "fraction": Fraction,
+    "decimal": Decimal,
+}
+
+# exact powers with larger exponents take too long to compute
+MAX_EXACT_EXPONENT = 10000
+# messages for decimal signals, whose own message is a list of classes
+DECIMAL_ERRORS = [
+    (DivisionByZero, "decimal division by zero"),
+    (DivisionUndefined, "decimal division by zero"),
+    (Overflow, "Result is too large for a decimal"),
+    (DecimalException, "Invalid decimal operation"),
+]
+
+
+def power(base: object, exponent: object) -> object:
+    """Raises a number to a power, refusing complex results."""
+    if type(exponent) is Fraction and abs(exponent) > MAX_EXACT_EXPONENT:
+        raise OverflowError(f"Exponent {exponent} is too large for an exact power")
+    try:
+        result = base**exponent
+    except OverflowError:
+        raise OverflowError("Result of power is too large") from None
+    if type(result) is complex:
+        raise ValueError("Negative number raised to a fractional power")
+    return result
+
+
+def _math_function(name: str) -> Callable:
+    """Gets a math function that also takes the NumPy arrays of evaluate_batch()."""
+    function = getattr(math, name)
+
+    def apply(value: object) -> object:
+        try:
+            return function(value)
+        except TypeError:
+            # imported here so scalar evaluation never loads NumPy
+            import numpy as np
+
+            return getattr(np, name)(value)
+
+    apply.__name__ = name
+    return apply
+
+
+def _decimal_function(function: Callable) -> Callable:
+    """Gets a float function that rounds its result to the decimal context."""
+    return lambda value: +Decimal(function(value))
+
+
+# operator: (precedence, function)
+BINARY_OPERATORS = {
+    "+": (1, operator.add),
+    "-": (1, operator.sub),
+    "*": (2, operator.mul),
+    "/": (2, operator.truediv),
+    "**": (4, power),
+}
+UNARY_OPERATORS = {
+    "u+": (3, operator.pos),
+    "u-": (3, operator.neg),
+}
+# these group right to left, so "2**3**2" is "2**(3**2)"
+RIGHT_ASSOCIATIVE = {"**"}
+
+# number mode: {function name: function}; fractions take the float functions,
+# so an expression calling one gives a float result
+FLOAT_FUNCTIONS = {
+    "abs": abs,
+    **{
+        name: _math_function(name)
+        for name in ["sqrt", "exp", "log", "sin", "cos", "tan"]
+    },
+}
+FUNCTIONS = {
+    "float": FLOAT_FUNCTIONS,
+    "fraction": FLOAT_FUNCTIONS,
+    "decimal": {
+        "abs": abs,
+        "sqrt": Decimal.sqrt,
+        "exp": Decimal.exp,
+        "log": Decimal.ln,
+        # computed in float, then rounded to the precision
+        "sin": _decimal_function(math.sin),
+        "cos": _decimal_function(math.cos),
+        "tan": _decimal_function(math.tan),
+    },
+}
+# written as Python operators by compile_function(), anything else is called
+PYTHON_OPERATORS = {
+    operator.add: "+",
+    operator.sub: "-",
+    operator.mul: "*",
+    operator.truediv: "/",
+    operator.pos: "+",
+    operator.neg: "-",
+}
+# deepest parentheses compile_function() writes before storing to a local
+MAX_NESTING = 32
+# bits assumed for a variable when estimating the cost of exact arithmetic
+VARIABLE_BITS = 64
+# exact arithmetic costs one unit per this many products of operand bits
+COST_SHIFT = 16
+# compile_batch() stands in for a parenthesized group with this name + node
+GROUP_PREFIX = "__group"
+PAREN_REGEX = re.compile(r"[()]")
+# operands of these may be swapped, so "a+b" and "b+a" share one node
+COMMUTATIVE = {operator.add, operator.mul}
+
+
+class LimitError(ValueError):
+    """Raised when an expression exceeds a size or cost limit."""
+
+
+class Limits(NamedTuple):
+    """
+    Bounds on the work of evaluating one expression; None is unbounded.
+    The cost of a float or decimal expression is its number of instructions.
+    Exact fractions grow as they are combined, so each of their operations
+    costs one unit plus one per 2**COST_SHIFT products of its operand bits.
+    """
+
+    max_tokens: int = None
+    max_depth: int = None
+    max_cost: int = None
+
+
+def iter_tokens(expression: str) -> Iterator[tuple[int, str]]:
+    """Lazily yields the (kind, text) tokens of an arithmetic string."""
+    for match in TOKEN_REGEX.finditer(expression):
+        kind = match.lastgroup
+        if kind is None:
+            # trailing whitespace
+            continue
+        text = match.group(kind)
+        if kind == "invalid":
+            raise ValueError(f"Invalid character '{text}' at {match.start(kind)}")
+        if kind == "name" and PARTIAL_EXPONENT.match(expression, match.start(kind)):
+            raise ValueError("Incomplete expression")
+        yield (TOKEN_KINDS[kind], text)
+
+
+def tokenize(expression: str) -> list[tuple[int, str]]:
+    """
+    Splits an arithmetic string into (kind, text) tokens in a single scan.
+    Ex. input "7/-4":
+            -> [(NUMBER, '7'), (OPERATOR, '/'), (OPERATOR, '-'), (NUMBER, '4')]
+    """
+    return list(iter_tokens(expression))
+
+
+def iter_instructions(
+    expression: str, number: str = "float", limits: Limits = None
+) -> Iterator[tuple[int, object]]:
+    """
+    Lazily yields the postfix instructions of an arithmetic string using the
+    shunting-yard algorithm. Follows order of operations; a sign directly
+    before an operand is unary, so "7/-4", "-4--5" and "6 - -7 * 9" are valid.
+    "**" raises to a power and binds tighter than a sign, so "-2**2" is -4.
+    An operand directly followed by a name or "(" is multiplied by it, so
+    "2x", "(1+2)(3-4)" and "2sqrt(2)" are valid, but "2 3" is not.
+    Names such as "x" or "rate_2" are variables bound at evaluation time,
+    except for functions: abs, sqrt, exp, log, sin, cos and tan.
+    Only pending operators are held, so memory grows with nesting depth
+    rather than expression length. Literals are converted to the given
+    number type, e.g. "fraction" keeps "0.1" exact as 1/10.
+    Token and nesting limits raise LimitError as soon as they are passed,
+    before the rest of the expression is read.
+    Ex. input "7/-4-3":
+            -> (CONST, 7.0), (CONST, 4.0), (UNARY, neg), (BINARY, truediv),
+               (CONST, 3.0), (BINARY, sub)
+    """
+    convert = get_converter(number)
+    functions = FUNCTIONS[number]
+    multiply = BINARY_OPERATORS["*"][0]
+    limits = limits or Limits()
+    max_depth = limits.max_depth
+    depth = 0
+    tokens = iter_tokens(expression)
+    if limits.max_tokens is not None:
+        tokens = _limit_tokens(tokens, limits.max_tokens)
+    ops = []
+    expect_operand = True
+    for kind, text in tokens:
+        if expect_operand:
+            if ops and ops[-1] in functions and kind != LPAREN:
+                raise ValueError(f"Missing '(' after '{ops[-1]}'")
+        elif kind == NAME or kind == LPAREN:
+            # implicit multiplication
+            while ops and ops[-1] != "(" and _precedence(ops[-1]) >= multiply:
+                yield _instruction(ops.pop(), functions)
+            ops.append("*")
+            expect_operand = True
+
+        if kind == NUMBER or kind == NAME:
+            if not expect_operand:
+                raise ValueError(f"Missing operator before '{text}'")
+            if kind == NUMBER:
+                yield (CONST, convert(text))
+            elif text in functions:
+                ops.append(text)
+                continue
+            else:
+                yield (VAR, text)
+            expect_operand = False
+        elif kind == LPAREN:
+            depth += 1
+            if max_depth is not None and depth > max_depth:
+                raise LimitError(f"Expression nests deeper than {max_depth}")
+            ops.append(text)
+        elif kind == RPAREN:
+            if expect_operand:
+                raise ValueError("Missing operand before ')'")
+            while ops and ops[-1] != "(":
+                yield _instruction(ops.pop(), functions)
+            if not ops:
+                raise ValueError("Unmatched ')'")
+            ops.pop()
+            depth -= 1
+            if ops and ops[-1] in functions:
+                yield _instruction(ops.pop(), functions)
+        elif expect_operand:
+            if text not in "+-":
+                raise ValueError(f"Missing operand before '{text}'")
+            ops.append(f"u{text}")
+        else:
+            precedence = BINARY_OPERATORS[text][0]
+            if text in RIGHT_ASSOCIATIVE:
+                precedence += 1
+            while ops and ops[-1] != "(" and _precedence(ops[-1]) >= precedence:
+                yield _instruction(ops.pop(), functions)
+            ops.append(text)
+            expect_operand = True
+
+    if expect_operand:
+        raise ValueError("Incomplete expression")
+    while ops:
+        op = ops.pop()
+        if op == "(":
+            raise ValueError("Unmatched '('")
+        yield _instruction(op, functions)
+
+
+def execute(instructions: Iterable[tuple[int, object]], variables: dict) -> float:
+    """
+    Runs postfix instructions on a value stack and returns the result.
+    Iterative, and results are written in place on the stack, so there is no
+    recursion or list copying per operator.
+    """
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    try:
+        for opcode, arg in instructions:
+            if opcode == CONST:
+                push(arg)
+            elif opcode == VAR:
+                push(variables[arg])
+            elif opcode == BINARY:
+                rval = pop()
+                stack[-1] = arg(stack[-1], rval)
+            else:
+                stack[-1] = arg(stack[-1])
+    except KeyError as e:
+        raise ValueError(f"Undefined variable '{e.args[0]}'") from None
+    return stack[0]
+
+
+def compile_expression(
+    expression: str, number: str = "float", limits: Limits = None
+) -> "Program":
+    """
+    Compiles an arithmetic string into a reusable postfix program.
+    Raises LimitError if it is over the limits, before it is ever run.
+    """
+    instructions = iter_instructions(expression, number, limits)
+    if limits is not None and limits.max_cost is not None:
+        instructions = meter(instructions, number, limits.max_cost)
+    return Program(expression, instructions, number)
+
+
+def meter(
+    instructions: Iterable[tuple[int, object]], number: str, max_cost: int
+) -> Iterator[tuple[int, object]]:
+    """
+    Passes instructions through while adding up their cost, and raises
+    LimitError before the first instruction that takes it over the budget.
+    Ex. meter(iter_instructions("(1/3)**9999", "fraction"), "fraction", 10**4)
+            -> LimitError after (CONST, 1/3), (CONST, 9999)
+    """
+    cost = 0
+    if number != "fraction":
+        for instruction in instructions:
+            cost += 1
+            if cost > max_cost:
+                raise LimitError(f"Expression exceeds the cost budget of {max_cost}")
+            yield instruction
+        return
+
+    # (bits, value if known) of each operand
+    stack = []
+    for opcode, arg in instructions:
+        if opcode == BINARY:
+            right = stack.pop()
+            operands = (stack.pop(), right)
+        elif opcode == UNARY:
+            operands = (stack.pop(), None)
+        else:
+            operands = (None, None)
+        size, op_cost = _fraction_cost(opcode, arg, *operands)
+        cost += op_cost
+        if cost > max_cost:
+            raise LimitError(f"Expression exceeds the cost budget of {max_cost}")
+        stack.append(size)
+        yield (opcode, arg)
+
+
+def compile_function(code: Iterable[tuple[int, object]]) -> Callable[[dict], object]:
+    """
+    Compiles postfix instructions into a Python function of a variables dict,
+    so evaluating runs as native bytecode instead of a loop over instructions.
+    Only generated names and float literals are written into the source, never
+    input text. Subexpressions nested deeper than MAX_NESTING are stored in
+    locals, as Python limits how deep parentheses may nest.
+    Ex. [(VAR, "x"), (CONST, 2.0), (BINARY, mul), (UNARY, sqrt)]
+            -> def program(variables):
+                   v0 = variables['x']
+                   return f0((v0 * 2.0))
+    """
+    namespace = {"__builtins__": {}}
+    references = {}
+    variables = {}
+    lines = []
+    # (source, nesting depth) of each operand
+    stack = []
+
+    def reference(value: object) -> str:
+        name = references.get(id(value))
+        if name is None:
+            prefix = "f" if callable(value) else "k"
+            name = references[id(value)] = f"{prefix}{len(references)}"
+            namespace[name] = value
+        return name
+
+    for opcode, arg in code:
+        if opcode == CONST:
+            if type(arg) is float and math.isfinite(arg):
+                stack.append((repr(arg), 0))
+            else:
+                stack.append((reference(arg), 0))
+            continue
+        if opcode == VAR:
+            local = variables.get(arg)
+            if local is None:
+                local = variables[arg] = f"v{len(variables)}"
+                lines.append(f"{local} = variables[{arg!r}]")
+            stack.append((local, 0))
+            continue
+
+        symbol = PYTHON_OPERATORS.get(arg)
+        if opcode == BINARY:
+            right, right_depth = stack.pop()
+            left, left_depth = stack.pop()
+            depth = max(left_depth, right_depth) + 1
+            if symbol is None:
+                source = f"{reference(arg)}({left}, {right})"
+            else:
+                source = f"({left} {symbol} {right})"
+        else:
+            operand, depth = stack.pop()
+            depth += 1
+            if symbol is None:
+                source = f"{reference(arg)}({operand})"
+            else:
+                source = f"({symbol}{operand})"
+        if depth > MAX_NESTING:
+            local = f"t{len(lines)}"
+            lines.append(f"{local} = {source}")
+            source, depth = local, 0
+        stack.append((source, depth))
+
+    lines.append(f"return {stack[0][0]}")
+    body = "".join(f"    {line}\n" for line in lines)
+    exec(compile(f"def program(variables):\n{body}", "<program>", "exec"), namespace)
+    return namespace["program"]
+
+
+def compile_batch(
+    expressions: Iterable[str], number: str = "float", limits: Limits = None
+) -> "Batch":
+    """
+    Compiles many expressions together into one graph of distinct subtrees.
+    Each subtree is keyed on its operator and operand nodes, so one shared by
+    several expressions, or repeated within one, becomes a single node.
+    Parenthesized groups are also keyed on their text, innermost first, so a
+    group seen before is not parsed again.
+    Operators on constants are folded into a constant node, except in
+    "decimal" mode where rounding depends on the precision at evaluation.
+    An expression over the limits gives a LimitError in place of its output.
+    Ex. input ["(1+2)*x", "x*(1+2) - y"]:
+            -> 0: 3.0, 1: x, 2: 0 * 1, 3: y, 4: 2 - 3
+               outputs [2, 4]
+    """
+    nodes = []
+    index = {}
+    groups = {}
+    fold = number != "decimal"
+    limits = limits or Limits()
+    # fractions are only folded if it is within the budget, as folding runs them
+    fold_budget = limits.max_cost if number == "fraction" else None
+    # equal decimals such as 1 and 1.0 print differently, as do 0.0 and -0.0,
+    # so those constants are keyed on their repr rather than their value
+    exact_keys = number == "decimal"
+    # floats folded from exact literals, such as 4**0.5, are kept apart from
+    # equal fractions by their type; a fraction's repr may be too long to make
+    typed_keys = number == "fraction"
+
+    def add(key: tuple, node: tuple) -> int:
+        position = index.get(key)
+        if position is None:
+            position = index[key] = len(nodes)
+            nodes.append(node)
+        return position
+
+    def add_const(value: object) -> int:
+        if exact_keys or not value:
+            key = (CONST, repr(value))
+        elif typed_keys:
+            key = (CONST, type(value), value)
+        else:
+            key = (CONST, value)
+        return add(key, (CONST, value, None, None))
+
+    def add_expression(expression: str, grouped: bool = False) -> int:
+        """
+        Adds the nodes of an expression and gets its root node.
+        If grouped, names starting with GROUP_PREFIX refer to existing nodes.
+        """
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        for opcode, arg in iter_instructions(expression, number, limits):
+            if opcode == CONST:
+                push(add_const(arg))
+                continue
+            if opcode == VAR:
+                if grouped and arg.startswith(GROUP_PREFIX):
+                    push(int(arg[len(GROUP_PREFIX) :]))
+                else:
+                    node = (VAR, arg, None, None)
+                    push(add(node, node))
+                continue
+            if opcode == BINARY:
+                right = pop()
+                left = pop()
+                if arg in COMMUTATIVE and right < left:
+                    left, right = right, left
+                constant = nodes[left][0] == CONST == nodes[right][0]
+            else:
+                right = None
+                left = pop()
+                constant = nodes[left][0] == CONST
+            if fold_budget is not None and constant:
+                left_size = _fraction_size(nodes[left][1])
+                right_size = None if right is None else _fraction_size(nodes[right][1])
+                _, cost = _fraction_cost(opcode, arg, left_size, right_size)
+                constant = cost <= fold_budget
+            if fold and constant:
+                try:
+                    if right is None:
+                        value = arg(nodes[left][1])
+                    else:
+                        value = arg(nodes[left][1], nodes[right][1])
+                except (ArithmeticError, ValueError):
+                    # left for evaluation, which reports the error
+                    pass
+                else:
+                    push(add_const(value))
+                    continue
+            node = (opcode, arg, left, right)
+            push(add(node, node))
+        return stack[0]
+
+    def add_group(text: str) -> int:
+        position = groups.get(text)
+        if position is None:
+            position = groups[text] = add_expression(text, grouped=True)
+        return position
+
+    def add_grouped(expression: str) -> int:
+        """
+        Adds an expression one parenthesized group at a time, replacing each
+        group with a name standing for its node, e.g. "2*(1+x)" -> "2*(__group3)".
+        The parentheses are kept so a group can still be a function argument.
+        """
+        levels = [[]]
+        last = 0
+        for match in PAREN_REGEX.finditer(expression):
+            levels[-1].append(expression[last : match.start()])
+            last = match.end()
+            if match.group() == "(":
+                levels.append([])
+                if limits.max_depth is not None and len(levels) > limits.max_depth + 1:
+                    raise LimitError(f"Expression nests deeper than {limits.max_depth}")
+            elif len(levels) > 1:
+                position = add_group("".join(levels.pop()))
+                levels[-1].append(f"({GROUP_PREFIX}{position})")
+            else:
+                raise ValueError("Unmatched ')'")
+        if len(levels) > 1:
+            raise ValueError("Unmatched '('")
+        levels[0].append(expression[last:])
+        return add_group("".join(levels[0]))
+
+    sources = []
+    outputs = []
+    for expression in expressions:
+        sources.append(expression)
+        try:
+            if limits.max_tokens is not None:
+                # groups are parsed apart, so count the tokens of the whole first
+                for _ in _limit_tokens(iter_tokens(expression), limits.max_tokens):
+                    pass
+            if GROUP_PREFIX in expression:
+                outputs.append(add_expression(expression))
+                continue
+            try:
+                outputs.append(add_grouped(expression))
+            except ValueError:
+                # parse the whole input for the same error as compile_expression
+                outputs.append(add_expression(expression))
+        except ValueError as e:
+            outputs.append(e)
+    if limits.max_cost is not None:
+        outputs = _limit_cost(nodes, outputs, number, limits.max_cost)
+    nodes, outputs = _prune(nodes, outputs)
+    return Batch(sources, nodes, outputs, number)
+
+
+def evaluate(
+    expression: str,
+    variables: dict = None,
+    number: str = "float",
+    precision: int = None,
+    limits: Limits = None,
+) -> float:
+    """
+    Evaluates an arithmetic string in one streaming pass.
+    Instructions are executed as they are parsed without building a program,
+    so memory stays bounded by nesting depth even for huge expressions.
+    Precision is the number of significant digits in "decimal" mode.
+    An expression over the limits raises LimitError before the instruction
+    that passes them is run.
+    """
+    instructions = iter_instructions(expression, number, limits)
+    if limits is not None and limits.max_cost is not None:
+        instructions = meter(instructions, number, limits.max_cost)
+    if number == "decimal" and precision:
+        with localcontext(prec=precision):
+            return execute(instructions, variables or {})
+    return execute(instructions, variables or {})
+
+
+def get_number_type(number: str) -> type:
+    """Gets the number type for a mode name: "float", "fraction" or "decimal"."""
+    try:
+        return NUMBER_TYPES[number]
+    except KeyError:
+        raise ValueError(
+            f"Unknown number type '{number}', expected {list(NUMBER_TYPES)}"
+        ) from None
+
+
+def get_converter(number: str) -> Callable[[str], object]:
+    """Gets the function converting literals to the number type of a mode."""
+    if number == "fraction":
+        return fraction_literal
+    return get_number_type(number)
+
+
+def fraction_literal(text: str) -> Fraction:
+    """
+    Converts a literal to an exact fraction, refusing exponents too large to
+    expand before any cost budget could see them.
+    Ex. "1e5000000" -> LimitError, rather than a 16 million bit integer
+    """
+    _, _, exponent = text.lower().partition("e")
+    if exponent and abs(int(exponent)) > MAX_EXACT_EXPONENT:
+        raise LimitError(f"Exponent of {text} is too large for an exact fraction")
+    return Fraction(text)
+
+
+def error_message(error: Exception) -> str:
+    """
+    Gets a readable message for an evaluation error. Exact arithmetic errors
+    otherwise read as reprs, like float errors such as "float division by zero".
+    Ex. InvalidOperation([<class 'decimal.InvalidOperation'>])
+            -> "Invalid decimal operation"
+        ZeroDivisionError("Fraction(1, 0)") -> "fraction division by zero"
+        ValueError("Exceeds the limit (4300 digits) for integer string ...")
+            -> "Result is too large to display"
+    """
+    if isinstance(error, DecimalException):
+        # the C implementation lists the signals raised, e.g. 0/0 raises
+        # InvalidOperation([DivisionUndefined])
+        signals = error.args[0] if error.args else []
+        if not isinstance(signals, list):
+            signals = []
+        for signal, message in DECIMAL_ERRORS:
+            if any(issubclass(s, signal) for s in [type(error), *signals]):
+                return message
+    if isinstance(error, ZeroDivisionError) and str(error).startswith("Fraction("):
+        return "fraction division by zero"
+    if isinstance(error, ValueError) and "integer string conversion" in str(error):
+        # an exact result within the cost budget may still be too long to print
+        return "Result is too large to display"
+    return str(error)
+
+
+def normalize(expression: str) -> str:
+    """
+    Normalizes an expression for use as a cache key.
+    Collapses whitespace runs without joining tokens, so "2 3" stays invalid.
+    """
+    return " ".join(expression.split())
+
+
+def _limit_cost(
+    nodes: list[tuple], outputs: list, number: str, max_cost: int
+) -> list:
+    """
+    Replaces the outputs over the cost budget with a LimitError. The cost of
+    an output is that of its subtree, counting shared nodes once per use.
+    """
+    sizes = []
+    costs = []
+    for opcode, arg, left, right in nodes:
+        cost = 1
+        size = None
+        if number == "fraction":
+            size, cost = _fraction_cost(
+                opcode,
+                arg,
+                None if left is None else sizes[left],
+                None if right is None else sizes[right],
+            )
+        if left is not None:
+            cost += costs[left]
+        if right is not None:
+            cost += costs[right]
+        sizes.append(size)
+        costs.append(cost)
+
+    error = LimitError(f"Expression exceeds the cost budget of {max_cost}")
+    return [
+        error if not isinstance(output, Exception) and costs[output] > max_cost
+        else output
+        for output in outputs
+    ]
+
+
+def _prune(nodes: list[tuple], outputs: list) -> tuple[list[tuple], list]:
+    """
+    Drops nodes no output depends on, such as operands of folded constants.
+    Nodes only refer to earlier ones, so one backward pass finds the live ones.
+    """
+    live = [False] * len(nodes)
+    for output in outputs:
+        if not isinstance(output, Exception):
+            live[output] = True
+    for position in range(len(nodes) - 1, -1, -1):
+        opcode, _, left, right = nodes[position]
+        if live[position] and opcode in (BINARY, UNARY):
+            live[left] = True
+            if right is not None:
+                live[right] = True
+
+    moved = {}
+    kept = []
+    for position, (opcode, arg, left, right) in enumerate(nodes):
+        if live[position]:
+            moved[position] = len(kept)
+            kept.append((opcode, arg, moved.get(left), moved.get(right)))
+    outputs = [moved.get(output, output) for output in outputs]
+    return kept, outputs
+
+
+def _limit_tokens(
+    tokens: Iterator[tuple[int, str]], max_tokens: int
+) -> Iterator[tuple[int, str]]:
+    """Passes tokens through, raising LimitError once there are too many."""
+    for count, token in enumerate(tokens, 1):
+        if count > max_tokens:
+            raise LimitError(f"Expression exceeds {max_tokens} tokens")
+        yield token
+
+
+def _fraction_size(value: object) -> tuple:
+    """Gets the size of a constant for _fraction_cost(): (bits, value)."""
+    if type(value) is not Fraction:
+        return (None, None)
+    return (value.numerator.bit_length() + value.denominator.bit_length(), value)
+
+
+def _fraction_cost(
+    opcode: int, arg: object, left: tuple, right: tuple
+) -> tuple[tuple, int]:
+    """
+    Estimates an instruction of exact fraction arithmetic from the sizes of its
+    operands, each an upper bound on its bits with its value if known. A size
+    of None is a float, e.g. the result of a function.
+
+    Returns: (size of the result, cost)
+    """
+    if opcode == CONST:
+        return _fraction_size(arg), 1
+    if opcode == VAR:
+        return (VARIABLE_BITS, None), 1
+    if opcode == UNARY:
+        bits, value = left
+        if arg is operator.neg or arg is operator.pos or arg is abs:
+            return (bits, None if value is None else arg(value)), 1
+        return (None, None), 1
+    (left_bits, left_value), (right_bits, right_value) = left, right
+    if left_bits is None or right_bits is None:
+        return (None, None), 1
+    if arg is power:
+        if right_value is None:
+            exponent = min(1 << min(right_bits, 64), MAX_EXACT_EXPONENT)
+        elif right_value.denominator != 1 or abs(right_value) > MAX_EXACT_EXPONENT:
+            # a float result, or refused by power()
+            return (None, None), 1
+        else:
+            exponent = abs(right_value.numerator)
+        bits = left_bits * max(1, exponent)
+        return (bits, None), 1 + (bits * bits >> COST_SHIFT)
+    bits = left_bits + right_bits
+    value = None
+    if left_value is not None and right_value is not None and bits <= 128:
+        # small constants are tracked so an exponent such as "(1+2)" is known
+        try:
+            value = arg(left_value, right_value)
+        except ArithmeticError:
+            pass
+    return (bits, value), 1 + (left_bits * right_bits >> COST_SHIFT)
+
+
+def _instruction(op: str, functions: dict) -> tuple[int, Callable]:
+    """Gets the program instruction for an operator or function."""
+    if op in UNARY_OPERATORS:
+        return (UNARY, UNARY_OPERATORS[op][1])
+    if op in BINARY_OPERATORS:
+        return (BINARY, BINARY_OPERATORS[op][1])
+    return (UNARY, functions[op])
+
+
+def _precedence(op: str) -> int:
+    """Gets the precedence of a binary or unary operator."""
+    if op in UNARY_OPERATORS:
+        return UNARY_OPERATORS[op][0]
+    return BINARY_OPERATORS[op][0]
+
+
+class Program(object):
+    """
+    Compiled postfix form of an expression that can be evaluated many times.
+    A program evaluated again is compiled to a Python function, so repeated
+    evaluations run as native bytecode; programs too long to compile quickly
+    keep running on the value stack.
+
+    Instructions are packed so cached programs stay small: one byte per
+    opcode, float constants in an array of doubles, and the other arguments
+    (operators, variable names and exact constants) in a tuple, in order.
+    Ex. "2*x+1" -> opcodes [FLOAT, VAR, BINARY, FLOAT, BINARY]
+                   floats [2.0, 1.0], args ("x", mul, add)
+    """
+
+    __slots__ = (
+        "source",
+        "opcodes",
+        "floats",
+        "args",
+        "number",
+        "names",
+        "function",
+        "runs",
+    )
+
+    # evaluations before compiling to Python, so one-off programs never pay for it
+    COMPILE_AFTER = 2
+    MAX_COMPILED_LENGTH = 2048
+
+    def __init__(
+        self, source: str, code: Iterable[tuple[int, object]], number: str = "float"
+    ):
+        self.source = source
+        self.number = number
+        opcodes = []
+        floats = []
+        args = []
+        names = set()
+        for opcode, arg in code:
+            if opcode == CONST and type(arg) is float:
+                opcodes.append(FLOAT)
+                floats.append(arg)
+                continue
+            if opcode == VAR:
+                names.add(arg)
+            opcodes.append(opcode)
+            args.append(arg)
+        self.opcodes = array("b", opcodes)
+        self.floats = array("d", floats)
+        self.args = tuple(args)
+        self.names = tuple(sorted(names))
+        self.function = None
+        self.runs = 0
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    def __repr__(self) -> str:
+        return f"Program({self.source!r}, {len(self)} instructions)"
+
+    @property
+    def code(self) -> list[tuple[int, object]]:
+        """Gets the instructions as (opcode, arg) pairs."""
+        return list(self.instructions())
+
+    def instructions(self) -> Iterator[tuple[int, object]]:
+        """Unpacks the instructions into (opcode, arg) pairs."""
+        floats = iter(self.floats)
+        args = iter(self.args)
+        for opcode in self.opcodes:
+            if opcode == FLOAT:
+                yield CONST, next(floats)
+            else:
+                yield opcode, next(args)
+
+    def evaluate(self, variables: dict = None, precision: int = None) -> float:
+        """
+        Runs the program on a value stack and returns the result.
+        Variables may be floats or NumPy arrays; arrays are evaluated with
+        vectorized operations and give an array result.
+        Precision is the number of significant digits in "decimal" mode.
+        """
+        if variables is None:
+            variables = {}
+        missing = [name for name in self.names if name not in variables]
+        if missing:
+            raise ValueError(f"Undefined variable '{missing[0]}'")
+        if self.number == "decimal" and precision:
+            with localcontext(prec=precision):
+                return self.run(variables)
+        return self.run(variables)
+
+    def run(self, variables: dict) -> object:
+        """Runs the compiled function, compiling it once the program is reused."""
+        function = self.function
+        if function is None:
+            self.runs += 1
+            if self.runs < self.COMPILE_AFTER or len(self) > self.MAX_COMPILED_LENGTH:
+                return self.execute(variables)
+            function = self.function = compile_function(self.instructions())
+        return function(variables)
+
+    def execute(self, variables: dict) -> object:
+        """Runs the packed instructions on a value stack, like execute()."""
+        stack = []
+        push = stack.append
+        pop = stack.pop
+        floats = iter(self.floats)
+        args = iter(self.args)
+        try:
+            for opcode in self.opcodes:
+                if opcode == FLOAT:
+                    push(next(floats))
+                elif opcode == BINARY:
+                    rval = pop()
+                    stack[-1] = next(args)(stack[-1], rval)
+                elif opcode == UNARY:
+                    stack[-1] = next(args)(stack[-1])
+                elif opcode == VAR:
+                    push(variables[next(args)])
+                else:
+                    push(next(args))
+        except KeyError as e:
+            raise ValueError(f"Undefined variable '{e.args[0]}'") from None
+        return stack[0]
+
+
+class Batch(object):
+    """
+    Expressions compiled together by compile_batch(), sharing their subtrees.
+    Every distinct subexpression is evaluated once per call, however many
+    expressions contain it.
+    """
+
+    def __init__(
+        self,
+        sources: list[str],
+        nodes: list[tuple[int, object, int, int]],
+        outputs: list,
+        number: str = "float",
+    ):
+        self.sources = sources
+        self.nodes = nodes
+        self.outputs = outputs
+        self.number = number
+        self.names = tuple(sorted({node[1] for node in nodes if node[0] == VAR}))
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __repr__(self) -> str:
+        return f"Batch({len(self.sources)} expressions, {len(self.nodes)} nodes)"
+
+    def evaluate(self, variables: dict = None, precision: int = None) -> list:
+        """
+        Evaluates every node once and gets the result of each expression.
+        An expression that fails to parse or evaluate gives its exception in
+        place of a result, so one bad input does not fail the whole batch.
+        Precision is the number of significant digits in "decimal" mode.
+        """
+        if self.number == "decimal" and precision:
+            with localcontext(prec=precision):
+                return self._evaluate(variables or {})
+        return self._evaluate(variables or {})
+
+    def _evaluate(self, variables: dict) -> list:
+        """Runs the nodes in order; errors are passed on to dependent nodes."""
+        values = [None] * len(self.nodes)
+        errors = {}
+        for position, (opcode, arg, left, right) in enumerate(self.nodes):
+            if opcode == CONST:
+                values[position] = arg
+                continue
+            if errors and (left in errors or right in errors):
+                errors[position] = errors.get(left) or errors[right]
+                continue
+            try:
+                if opcode == VAR:
+                    values[position] = variables[arg]
+                elif opcode == BINARY:
+                    values[position] = arg(values[left], values[right])
+                else:
+                    values[position] = arg(values[left])
+            except KeyError:
+                errors[position] = ValueError(f"Undefined variable '{arg}'")
+            except (ArithmeticError, ValueError) as e:
+                errors[position] = e
+
+        results = []
+        for output in self.outputs:
+            if isinstance(output, Exception):
+                results.append(output)
+            else:
+                results.append(errors.get(output, values[output]))
+        return results
+
+
+class IncrementalParser(object):
+    """
+    Evaluates an expression as it is edited, reusing the parse of the
+    unchanged prefix. The parser state after every token is kept as a
+    checkpoint on persistent linked stacks, so each costs O(1); an edit rolls
+    back to the last checkpoint before it and only the rest is parsed again.
+    Ex. update("12*3") then update("12*34")
+            -> re-parses only "34", result() 408.0
+    """
+
+    # chars after a number that may still join it once more is typed, e.g. "1e+5"
+    NUMBER_LOOKAHEAD = 3
+
+    def __init__(self, number: str = "float", variables: dict = None):
+        self.convert = get_converter(number)
+        self.functions = FUNCTIONS[number]
+        self.variables = variables or {}
+        self.text = ""
+        # (end of token, values, ops, expect operand, error)
+        self.checkpoints = [(0, None, None, True, None)]
+        # tokens parsed by the last update
+        self.parsed = 0
+
+    def update(self, text: str) -> None:
+        """Parses the new text, starting from the last unchanged token."""
+        old = self.text
+        common = 0
+        limit = min(len(old), len(text))
+        while common < limit and old[common] == text[common]:
+            common += 1
+
+        # a token ending at the edit may continue into it, e.g. "12" -> "123",
+        # and a number before an "e" may become an exponent, e.g. "1e+" -> "1e+5"
+        cut = common
+        for position in range(max(0, common - self.NUMBER_LOOKAHEAD), common):
+            if text[position] in "eE":
+                cut = position
+                break
+        checkpoints = self.checkpoints
+        while len(checkpoints) > 1 and checkpoints[-1][0] >= cut:
+            checkpoints.pop()
+
+        end, values, ops, expect_operand, error = checkpoints[-1]
+        self.parsed = 0
+        if error is None:
+            for match in TOKEN_REGEX.finditer(text, end):
+                kind = match.lastgroup
+                if kind is None:
+                    # trailing whitespace
+                    continue
+                try:
+                    values, ops, expect_operand = self._step(
+                        kind, match, values, ops, expect_operand
+                    )
+                except (ValueError, ArithmeticError) as e:
+                    error = e
+                checkpoints.append((match.end(), values, ops, expect_operand, error))
+                self.parsed += 1
+                if error is not None:
+                    break
+        self.text = text
+
+    def result(self) -> float:
+        """
+        Gets the value of the current text.
+        Raises ValueError if the text is not a complete expression.
+        """
+        _, values, ops, expect_operand, error = self.checkpoints[-1]
+        if error is not None:
+            raise error
+        if expect_operand:
+            raise ValueError("Incomplete expression")
+        while ops:
+            op, ops = ops
+            if op == "(":
+                raise ValueError("Unmatched '('")
+            values = self._apply(op, values)
+        return values[0]
+
+    def _step(
+        self,
+        kind: str,
+        match: re.Match,
+        values: tuple,
+        ops: tuple,
+        expect_operand: bool,
+    ) -> tuple[tuple, tuple, bool]:
+        """Applies one token to the parser state and gets the new state."""
+        text = match.group(kind)
+        if kind == "name" and PARTIAL_EXPONENT.match(match.string, match.start(kind)):
+            raise ValueError("Incomplete expression")
+        if expect_operand:
+            if ops and ops[0] in self.functions and kind != "lparen":
+                raise ValueError(f"Missing '(' after '{ops[0]}'")
+        elif kind == "name" or kind == "lparen":
+            # implicit multiplication
+            values, ops = self._push("*", values, ops)
+            expect_operand = True
+
+        if kind == "number" or kind == "name":
+            if not expect_operand:
+                raise ValueError(f"Missing operator before '{text}'")
+            if kind == "number":
+                return (self.convert(text), values), ops, False
+            if text in self.functions:
+                return values, (text, ops), True
+            if text not in self.variables:
+                raise ValueError(f"Undefined variable '{text}'")
+            return (self.variables[text], values), ops, False
+        if kind == "lparen":
+            return values, (text, ops), True
+        if kind == "rparen":
+            if expect_operand:
+                raise ValueError("Missing operand before ')'")
+            while ops and ops[0] != "(":
+                values = self._apply(ops[0], values)
+                ops = ops[1]
+            if not ops:
+                raise ValueError("Unmatched ')'")
+            ops = ops[1]
+            if ops and ops[0] in self.functions:
+                values = self._apply(ops[0], values)
+                ops = ops[1]
+            return values, ops, False
+        if kind == "invalid":
+            raise ValueError(f"Invalid character '{text}' at {match.start(kind)}")
+        if expect_operand:
+            if text not in "+-":
+                raise ValueError(f"Missing operand before '{text}'")
+            return values, (f"u{text}", ops), True
+        values, ops = self._push(text, values, ops)
+        return values, ops, True
+
+    def _push(self, op: str, values: tuple, ops: tuple) -> tuple[tuple, tuple]:
+        """Applies the pending operators that bind tighter, then pushes a binary one."""
+        precedence = BINARY_OPERATORS[op][0]
+        if op in RIGHT_ASSOCIATIVE:
+            precedence += 1
+        while ops and ops[0] != "(" and _precedence(ops[0]) >= precedence:
+            values = self._apply(ops[0], values)
+            ops = ops[1]
+        return values, (op, ops)
+
+    def _apply(self, op: str, values: tuple) -> tuple:
+        """Applies an operator or function to the top of the value stack."""
+        if op in UNARY_OPERATORS:
+            value, rest = values
+            return (UNARY_OPERATORS[op][1](value), rest)
+        if op in self.functions:
+            value, rest = values
+            return (self.functions[op](value), rest)
+        right, (left, rest) = values
+        return (BINARY_OPERATORS[op][1](left, right), rest)
+
+
+class ProgramCache(object):
+    """
+    Bounded LRU cache of compiled programs keyed on the normalized expression.
+    Repeated expressions skip tokenizing and parsing entirely.
+    """
+
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._programs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._programs)
+
+    def get(
+        self, expression: str, number: str = "float", limits: Limits = None
+    ) -> Program:
+        """
+        Gets the compiled program for an expression, compiling on a miss.
+        Limits are checked when compiling, so a cache should always be given
+        the same limits.
+        """
+        key = (normalize(expression), number)
+        with self._lock:
+            program = self._programs.get(key)
+            if program is not None:
+                self._programs.move_to_end(key)
+                self.hits += 1
+                return program
+            self.misses += 1
+
+        program = compile_expression(key[0], number, limits)
+        if self.max_size <= 0:
+            return program
+        with self._lock:
+            self._programs[key] = program
+            self._programs.move_to_end(key)
+            while len(self._programs) > self.max_size:
+                self._programs.popitem(last=False)
+                self.evictions += 1
+        return program
+
+    def clear(self) -> None:
+        """Removes all cached programs and resets the counters."""
+        with self._lock:
+            self._programs.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        """Gets the cache size and hit/miss/eviction counters."""
+        return {
+            "size": len(self._programs),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,599 @@
+"""
+Differential fuzzing of the evaluation engines against each other.
+
+    python3 fuzz.py --count 1000000 --processes 8
+    python3 fuzz.py --engine classic --engine exact --max-ulps 16
+
+Random valid expressions, with negatives, spaces, deep and negated
+parentheses, powers, functions and implicit multiplication, are evaluated by
+every engine in worker processes, in float, fraction and decimal modes.
+Float results further apart than the ULP tolerance, exact results that differ
+at all, or an error from one engine but not another, are reported with a
+reproducer shrunk to as few tokens as still diverge, and the run exits with a
+non-zero status. An engine skips the cases it does not support, e.g. the
+classic engine only evaluates floats with the four basic operators.
+"""
+# built-in imports
+import argparse
+import math
+import multiprocessing
+import random
+import re
+import struct
+import sys
+from decimal import Decimal
+from fractions import Fraction
+from typing import Callable, Iterator, NamedTuple
+
+# custom imports
+import evaluator
+from calculator import Calculator
+
+# engines run by default; "exact" rounds fraction arithmetic to a float, so it
+# differs from float engines wherever rounding errors cancel out
+DEFAULT_ENGINES = [
+    "precedence",
+    "classic",
+    "program",
+    "compiled",
+    "batch",
+    "incremental",
+]
+NUMBERS = ["float", "fraction", "decimal"]
+TOKEN_REGEX = re.compile(r"\s+|\d+(?:\.\d*)?|[A-Za-z_]\w*|\*\*|\S")
+OPERAND_END = re.compile(r"[\d.)]$")
+OPERAND_START = re.compile(r"^[\d.]")
+OPERATORS = ["+", "-", "*", "/", "**"]
+FUNCTIONS = ["abs", "sqrt", "exp", "log", "sin", "cos", "tan"]
+# right operands of powers, small so results stay within float and cost range
+EXPONENTS = ["2", "3", "0.5", "-1", "(1/3)"]
+# powers, names and implicit multiplication, which the classic engine lacks
+EXTENDED_REGEX = re.compile(r"\*\*|[A-Za-z_]|[\d.)]\s*\(")
+# outcome of an engine that does not support a case
+SKIPPED = None
+
+
+class Divergence(NamedTuple):
+    """Expression on which the engines disagree, with its shrunk reproducer."""
+
+    expression: str
+    outcomes: dict[str, object]
+    shrunk: str = None
+    shrunk_outcomes: dict[str, object] = None
+    number: str = "float"
+
+
+# -------
+# Engines
+# -------
+
+
+def run_precedence(expressions: list[str], number: str) -> list:
+    return [
+        outcome(lambda e: evaluator.evaluate(e, number=number), e)
+        for e in expressions
+    ]
+
+
+def run_classic(expressions: list[str], number: str) -> list:
+    if number != "float":
+        return [SKIPPED] * len(expressions)
+    calculator = Calculator(engine="classic")
+    return [
+        SKIPPED
+        if EXTENDED_REGEX.search(e)
+        else outcome(calculator.evaluate_expression, e)
+        for e in expressions
+    ]
+
+
+def run_program(expressions: list[str], number: str) -> list:
+    return [
+        outcome(lambda e: evaluator.compile_expression(e, number).evaluate(), e)
+        for e in expressions
+    ]
+
+
+def run_compiled(expressions: list[str], number: str) -> list:
+    def compiled(expression: str) -> object:
+        code = evaluator.compile_expression(expression, number).code
+        return evaluator.compile_function(code)({})
+
+    return [outcome(compiled, e) for e in expressions]
+
+
+def run_batch(expressions: list[str], number: str) -> list:
+    # one batch per mode, so constants and subtrees are shared across cases
+    try:
+        results = evaluator.compile_batch(expressions, number).evaluate()
+    except Exception as e:
+        return [error_outcome(e)] * len(expressions)
+    return [
+        error_outcome(result) if isinstance(result, Exception) else exact(result)
+        for result in results
+    ]
+
+
+def run_incremental(expressions: list[str], number: str) -> list:
+    def incremental(expression: str) -> object:
+        # typed in two edits, so the second resumes from a checkpoint
+        parser = evaluator.IncrementalParser(number)
+        parser.update(expression[: len(expression) // 2])
+        parser.update(expression)
+        return parser.result()
+
+    return [outcome(incremental, e) for e in expressions]
+
+
+def run_exact(expressions: list[str], number: str) -> list:
+    if number != "float":
+        return [SKIPPED] * len(expressions)
+    return [
+        outcome(lambda e: float(evaluator.evaluate(e, number="fraction")), e)
+        for e in expressions
+    ]
+
+
+ENGINES = {
+    "precedence": run_precedence,
+    "classic": run_classic,
+    "program": run_program,
+    "compiled": run_compiled,
+    "batch": run_batch,
+    "incremental": run_incremental,
+    "exact": run_exact,
+}
+
+
+def outcome(func: Callable[[str], object], expression: str) -> object:
+    """
+    Gets the result of a function, a float unless it is an exact fraction or
+    decimal, or its error as a string.
+    """
+    try:
+        return exact(func(expression))
+    except Exception as e:
+        return error_outcome(e)
+
+
+def exact(result: object) -> object:
+    """Keeps an exact result as it is and converts any other to a float."""
+    if isinstance(result, (Fraction, Decimal)):
+        return result
+    return float(result)
+
+
+def error_outcome(error: Exception) -> str:
+    return f"Error: {type(error).__name__}: {error}"
+
+
+def run_engines(
+    expressions: list[str], engines: list[str], number: str = "float"
+) -> list[dict]:
+    """Gets the outcome of every engine for each expression."""
+    columns = {name: ENGINES[name](expressions, number) for name in engines}
+    return [
+        {name: columns[name][i] for name in engines} for i in range(len(expressions))
+    ]
+
+
+# ----------
+# Comparison
+# ----------
+
+
+def ulp_distance(a: float, b: float) -> int:
+    """
+    Counts the representable doubles between two floats.
+    Ex. ulp_distance(1.0, math.nextafter(1.0, 2.0)) -> 1
+    """
+    a, b = (struct.unpack("<q", struct.pack("<d", value))[0] for value in (a, b))
+    # map negative floats below the positive ones so the order is monotonic
+    a, b = (value if value >= 0 else -(2**63) - value for value in (a, b))
+    return abs(a - b)
+
+
+def diverges(a: object, b: object, max_ulps: int = 4, abs_tol: float = 1e-12) -> bool:
+    """
+    Checks whether two outcomes disagree: one is an error and the other is
+    not, they are different types, exact results are not identical, or float
+    results are over max_ulps apart and over abs_tol apart.
+    The absolute tolerance allows for rounding left over where terms cancel.
+    A skipped outcome agrees with any other.
+    """
+    if a is SKIPPED or b is SKIPPED:
+        return False
+    if isinstance(a, str) or isinstance(b, str):
+        return isinstance(a, str) != isinstance(b, str)
+    if type(a) is not type(b):
+        return True
+    if isinstance(a, Decimal):
+        # equal decimals such as 1 and 1.0 are still written differently
+        return a.as_tuple() != b.as_tuple()
+    if isinstance(a, Fraction):
+        return a != b
+    if math.isnan(a) or math.isnan(b):
+        return math.isnan(a) != math.isnan(b)
+    if a == b:
+        return False
+    if math.isinf(a) or math.isinf(b):
+        return True
+    return abs(a - b) > abs_tol and ulp_distance(a, b) > max_ulps
+
+
+def find_divergence(
+    outcomes: dict, max_ulps: int, abs_tol: float
+) -> tuple[str, str]:
+    """Gets the first engine and one disagreeing with it, or None if all agree."""
+    names = list(outcomes)
+    for name in names[1:]:
+        if diverges(outcomes[names[0]], outcomes[name], max_ulps, abs_tol):
+            return names[0], name
+    return None
+
+
+# ---------
+# Shrinking
+# ---------
+
+
+def is_valid_shape(tokens: list[str]) -> bool:
+    """
+    Checks that no number directly follows an operand, e.g. "2 3" or ")4",
+    and that no operator but "-" follows another, e.g. "2*/3". Shrinking
+    removes tokens, and these are invalid in ways each engine reports
+    differently.
+    """
+    previous = ""
+    for token in tokens:
+        if token.isspace():
+            continue
+        if OPERAND_END.search(previous) and OPERAND_START.match(token):
+            return False
+        if previous in OPERATORS and token in OPERATORS and token != "-":
+            return False
+        previous = token
+    return True
+
+
+def shrink_candidates(tokens: list[str]) -> Iterator[list[str]]:
+    """
+    Yields smaller or simpler variants of a token list, largest cuts first:
+    removed runs of tokens, unwrapped parentheses, operands with a digit
+    removed and operands replaced by 1.
+    """
+    sizes = []
+    size = len(tokens) // 2
+    while size:
+        sizes.append(size)
+        size //= 2
+    if len(tokens) > 2 and 2 not in sizes:
+        # an operator and its operand, e.g. "7-1" -> "7"
+        sizes.insert(-1, 2)
+    for size in sizes:
+        for start in range(0, len(tokens) - size + 1):
+            yield tokens[:start] + tokens[start + size :]
+    opened = []
+    for position, token in enumerate(tokens):
+        if token == "(":
+            opened.append(position)
+        elif token == ")" and opened:
+            start = opened.pop()
+            yield [t for i, t in enumerate(tokens) if i not in (start, position)]
+    for position, token in enumerate(tokens):
+        if token[0].isdigit():
+            for i in range(len(token)):
+                shorter = token[:i] + token[i + 1 :]
+                if shorter and shorter[0].isdigit():
+                    yield tokens[:position] + [shorter] + tokens[position + 1 :]
+            if token != "1":
+                yield tokens[:position] + ["1"] + tokens[position + 1 :]
+
+
+def shrink(
+    expression: str,
+    engines: tuple[str, str],
+    number: str = "float",
+    max_ulps: int = 4,
+    abs_tol: float = 1e-12,
+    max_steps: int = 10000,
+) -> str:
+    """
+    Shrinks an expression on which two engines diverge to a minimal one on
+    which they still diverge the same way, i.e. with the same engine failing.
+    Ex. shrink("12+(3*47-5)", ...) -> "7" for an engine that mishandles 7s
+
+    Returns: the smallest diverging expression found
+    """
+
+    def check(candidate: str) -> tuple:
+        outcomes = run_engines([candidate], list(engines), number)[0]
+        a, b = (outcomes[name] for name in engines)
+        if not diverges(a, b, max_ulps, abs_tol):
+            return None
+        return isinstance(a, str), isinstance(b, str)
+
+    kind = check(expression)
+    if kind is None:
+        return expression
+    tokens = TOKEN_REGEX.findall(expression)
+    steps = 0
+    shrunk = True
+    while shrunk and steps < max_steps:
+        shrunk = False
+        for candidate in shrink_candidates(tokens):
+            steps += 1
+            if steps >= max_steps:
+                break
+            if not candidate or not is_valid_shape(candidate):
+                continue
+            if check("".join(candidate)) == kind:
+                tokens = candidate
+                shrunk = True
+                break
+    return "".join(tokens)
+
+
+# -------
+# Fuzzing
+# -------
+
+
+def random_expression(seed: int, index: int, max_length: int, max_depth: int) -> str:
+    """
+    Gets the deterministic random expression at an index of a fuzz run.
+    Half of the expressions only use the grammar of the classic engine:
+    operands, signs, the four basic operators and (negated) parentheses.
+    """
+    rng = random.Random(f"{seed}:{index}")
+    depth = rng.randint(0, max_depth)
+    negatives = rng.choice([0.0, 0.2, 0.5])
+    joiner = " {} " if rng.random() < 0.3 else "{}"
+    extended = rng.random() < 0.5
+    operators = OPERATORS if extended else OPERATORS[:4]
+
+    def operand() -> str:
+        value = str(rng.randint(1, 99))
+        if rng.random() < 0.2:
+            value += f".{rng.randint(1, 99)}"
+        if rng.random() < negatives:
+            value = f"-{value}"
+        return value
+
+    def group(count: int, level: int) -> str:
+        inner = build(count, level + 1)
+        choice = rng.random()
+        if extended and choice < 0.3:
+            return f"{rng.choice(FUNCTIONS)}({inner})"
+        if choice < 0.5:
+            return f"-({inner})"
+        return f"({inner})"
+
+    def build(count: int, level: int) -> str:
+        terms = []
+        remaining = count
+        while remaining:
+            # the first term of each level opens a group so the depth is reached
+            if level < depth and remaining >= 2 and (not terms or rng.random() < 0.3):
+                size = rng.randint(2, max(2, min(remaining, count // 2 or 2)))
+                terms.append(group(size, level))
+                remaining -= size
+            else:
+                terms.append(operand())
+                remaining -= 1
+        expression = terms[0]
+        for term in terms[1:]:
+            operator = rng.choice(operators)
+            if operator == "**":
+                expression += joiner.format(operator) + rng.choice(EXPONENTS)
+                operator = rng.choice(OPERATORS[:4])
+            implicit = term[0] == "(" or term[0].isalpha()
+            if extended and implicit and rng.random() < 0.3:
+                # implicit multiplication, e.g. "2(3+4)" or "(1+2)sqrt(4)"
+                expression += term
+            else:
+                expression += joiner.format(operator) + term
+        return expression
+
+    expression = build(rng.randint(1, max_length), 0)
+    # occasionally wrap the whole expression in redundant parentheses
+    if rng.random() < 0.1:
+        wraps = rng.randint(1, max_depth * 4)
+        expression = "(" * wraps + expression + ")" * wraps
+    return expression
+
+
+def random_number(seed: int, index: int, numbers: list[str]) -> str:
+    """Gets the deterministic number mode of the expression at an index."""
+    return random.Random(f"{seed}:{index}:number").choice(numbers)
+
+
+def check_range(args: tuple) -> tuple[int, list[Divergence]]:
+    """
+    Evaluates the expressions at a range of indexes with every engine.
+
+    Returns: (number of expressions checked, divergences found)
+    """
+    start, stop, seed, engines, numbers, max_length, max_depth, max_ulps, abs_tol = (
+        args
+    )
+    cases = {number: [] for number in numbers}
+    for i in range(start, stop):
+        expression = random_expression(seed, i, max_length, max_depth)
+        cases[random_number(seed, i, numbers)].append(expression)
+    divergences = []
+    for number, expressions in cases.items():
+        results = run_engines(expressions, engines, number)
+        for expression, outcomes in zip(expressions, results):
+            if find_divergence(outcomes, max_ulps, abs_tol):
+                divergences.append(Divergence(expression, outcomes, number=number))
+    return stop - start, divergences
+
+
+def fuzz(
+    count: int = 100000,
+    engines: list[str] = None,
+    numbers: list[str] = None,
+    seed: int = 0,
+    processes: int = None,
+    max_length: int = 30,
+    max_depth: int = 6,
+    max_ulps: int = 4,
+    abs_tol: float = 1e-12,
+    max_failures: int = 10,
+    chunk_size: int = 1000,
+    progress: Callable[[int], None] = None,
+) -> list[Divergence]:
+    """
+    Evaluates random expressions with every engine across worker processes.
+    The run is deterministic for a seed, whatever the number of processes.
+
+    Args:
+        count: number of expressions to generate
+        engines: names of ENGINES to compare; all are compared to the first
+        numbers: number modes to evaluate expressions in, one picked for each
+        seed: random seed of the run
+        processes: worker processes; defaults to one per core, 1 runs in-process
+        max_length: max number of operands in an expression
+        max_depth: max nesting depth of parentheses in an expression
+        max_ulps: ULPs two results may differ by before they diverge
+        abs_tol: absolute difference under which results never diverge
+        max_failures: divergences to find before stopping early
+        chunk_size: expressions evaluated per task
+        progress: called with the number checked so far after each chunk
+
+    Returns: divergences found, each with a shrunk reproducer
+    """
+    engines = engines or DEFAULT_ENGINES
+    numbers = numbers or NUMBERS
+    for name in engines:
+        if name not in ENGINES:
+            raise ValueError(f"Unknown engine '{name}', expected {list(ENGINES)}")
+    for number in numbers:
+        evaluator.get_number_type(number)
+    tasks = (
+        (start, min(start + chunk_size, count), seed, engines, numbers)
+        + (max_length, max_depth, max_ulps, abs_tol)
+        for start in range(0, count, chunk_size)
+    )
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    results = pool.imap(check_range, tasks) if pool else map(check_range, tasks)
+
+    checked = 0
+    divergences = []
+    try:
+        for done, found in results:
+            checked += done
+            divergences += found
+            if progress is not None:
+                progress(checked)
+            if len(divergences) >= max_failures:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    shrunk = []
+    for divergence in divergences[:max_failures]:
+        pair = find_divergence(divergence.outcomes, max_ulps, abs_tol)
+        number = divergence.number
+        expression = shrink(divergence.expression, pair, number, max_ulps, abs_tol)
+        outcomes = run_engines([expression], engines, number)[0]
+        shrunk.append(divergence._replace(shrunk=expression, shrunk_outcomes=outcomes))
+    return shrunk
+
+
+def format_divergence(divergence: Divergence) -> list[str]:
+    """Formats a divergence as report lines, shrunk reproducer first."""
+    lines = [f"DIVERGENCE {divergence.shrunk!r} ({divergence.number})"]
+    for name, value in divergence.shrunk_outcomes.items():
+        lines.append(f"    {name:<12} {value!r}")
+    lines.append(f"    found in {divergence.expression!r}")
+    return lines
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses command-line args to configure a fuzz run."""
+    parser = argparse.ArgumentParser(description="Differential engine fuzzing.")
+    parser.add_argument(
+        "--count", "-c", type=int, default=100000, help="Expressions to generate."
+    )
+    parser.add_argument(
+        "--engine",
+        "-e",
+        choices=list(ENGINES),
+        action="append",
+        help="Engine to compare; repeat for several. The first is the reference.\n"
+        f"Defaults to {', '.join(DEFAULT_ENGINES)}.",
+    )
+    parser.add_argument(
+        "--number",
+        "-n",
+        choices=NUMBERS,
+        action="append",
+        help="Number mode to evaluate in; repeat for several. Defaults to all.",
+    )
+    parser.add_argument("--seed", "-s", type=int, default=0, help="Random seed.")
+    parser.add_argument(
+        "--processes",
+        "-p",
+        type=int,
+        help="Worker processes; defaults to one per core.",
+    )
+    parser.add_argument(
+        "--max-length", type=int, default=30, help="Max operands per expression."
+    )
+    parser.add_argument(
+        "--max-depth", type=int, default=6, help="Max nesting of parentheses."
+    )
+    parser.add_argument(
+        "--max-ulps",
+        type=int,
+        default=4,
+        help="ULPs results may differ by before they diverge.",
+    )
+    parser.add_argument(
+        "--abs-tol",
+        type=float,
+        default=1e-12,
+        help="Absolute difference under which results never diverge.",
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=10,
+        help="Divergences to find before stopping.",
+    )
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    divergences = fuzz(
+        count=args.count,
+        engines=args.engine,
+        numbers=args.number,
+        seed=args.seed,
+        processes=args.processes,
+        max_length=args.max_length,
+        max_depth=args.max_depth,
+        max_ulps=args.max_ulps,
+        abs_tol=args.abs_tol,
+        max_failures=args.max_failures,
+        progress=lambda checked: print(
+            f"\rChecked {checked} expressions", end="", file=sys.stderr
+        ),
+    )
+    print(file=sys.stderr)
+    for divergence in divergences:
+        print("\n".join(format_divergence(divergence)))
+    if divergences:
+        return 1
+    print("No divergences found.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+# built-in imports
+import atexit
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_FORMAT = "%(filename)-18s:%(lineno)-8d %(levelname)-8s - %(message)s"
+FILE_FORMAT = f"[%(asctime)s] {LOG_FORMAT}"
+DATE_FORMAT = "%H:%M:%S"
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps one in every N records at or below a level.
+    Records above the level, e.g. warnings and errors, are always kept.
+    """
+
+    def __init__(self, rate: int, max_level: int = logging.INFO):
+        super(SamplingFilter, self).__init__()
+        self.rate = max(1, rate)
+        self.max_level = max_level
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level:
+            return True
+        return next(self.counter) % self.rate == 0
+
+
+def create_logger(
+    log_file: str = None,
+    level: int = logging.DEBUG,
+    console: bool = True,
+    queued: bool = True,
+    module_levels: dict[str, int] = None,
+    sample_rate: int = 1,
+) -> QueueListener:
+    """
+    Creates logger for console and text file.
+
+    Args:
+        log_file: file to append records to, if any
+        level: minimum level of records to emit
+        console: whether to also write records to the console
+        queued: whether to hand records to a background thread for writing,
+            so callers never wait on console or disk I/O
+        module_levels: minimum level per logger name, e.g. {"calculator": 30}
+        sample_rate: keep one in this many records at INFO level and below
+
+    Returns: queue listener writing the records if queued, otherwise None
+    """
+    handlers = []
+    if log_file:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter(FILE_FORMAT, DATE_FORMAT))
+        handlers.append(file_handler)
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers.append(console_handler)
+
+    root_logger = logging.getLogger("")
+    root_logger.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    listener = None
+    if queued:
+        # the queue handler formats the message in the calling thread, so
+        # mutable arguments are captured before the caller changes them
+        records = queue.SimpleQueue()
+        queue_handler = QueueHandler(records)
+        listener = QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(stop_listener, listener)
+        handlers = [queue_handler]
+
+    for handler in handlers:
+        if sample_rate > 1:
+            handler.addFilter(SamplingFilter(sample_rate))
+        root_logger.addHandler(handler)
+    return listener
+
+
+def stop_listener(listener: QueueListener) -> None:
+    """Writes any queued records and stops the listener; safe to call twice."""
+    if listener._thread is not None:
+        listener.stop()
+
+
+def parse_module_levels(values: list[str]) -> dict[str, int]:
+    """
+    Parses "name=LEVEL" strings into a mapping of logger name to level.
+    Ex. ["calculator=WARNING", "server=DEBUG"]
+            -> {"calculator": 30, "server": 10}
+    """
+    module_levels = {}
+    for value in values or []:
+        name, _, level_name = value.partition("=")
+        level = logging.getLevelName(level_name.strip().upper())
+        if not name or not isinstance(level, int):
+            raise ValueError(f"Invalid module level '{value}', expected name=LEVEL")
+        module_levels[name.strip()] = level
+    return module_levels
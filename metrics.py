@@ -0,0 +1,231 @@
+"""
+Lightweight metrics with Prometheus text output.
+
+Metrics are only recorded when a Registry is passed to the class being
+measured, so instrumentation costs a single None check when disabled.
+"""
+# built-in imports
+import bisect
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+LOG = logging.getLogger(__name__)
+
+# latency buckets in seconds, from 10us to 10s
+DEFAULT_BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+    10.0,
+)
+
+
+def format_labels(labels: tuple[tuple[str, str], ...], extra: str = "") -> str:
+    """Formats label pairs as a Prometheus label set, e.g. {phase="parse"}."""
+    pairs = [f'{key}="{value}"' for key, value in labels]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    """Monotonically increasing count."""
+
+    kind = "counter"
+
+    def __init__(self, labels: tuple = ()):
+        self.labels = labels
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        """Increases the count by the given amount."""
+        with self._lock:
+            self.value += amount
+
+    def render(self, name: str) -> list[str]:
+        """Gets the Prometheus sample lines of the counter."""
+        return [f"{name}{format_labels(self.labels)} {self.value}"]
+
+
+class Gauge(object):
+    """Value that can go up and down, optionally read from a function."""
+
+    kind = "gauge"
+
+    def __init__(self, labels: tuple = (), func: Callable[[], float] = None):
+        self.labels = labels
+        self.value = 0
+        self.func = func
+
+    def set(self, value: float) -> None:
+        """Sets the gauge to the given value."""
+        self.value = value
+
+    def render(self, name: str) -> list[str]:
+        """Gets the Prometheus sample lines of the gauge."""
+        value = self.func() if self.func else self.value
+        return [f"{name}{format_labels(self.labels)} {value}"]
+
+
+class Histogram(object):
+    """Distribution of observed values in cumulative buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        """Records one value."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def render(self, name: str) -> list[str]:
+        """Gets the Prometheus sample lines of the histogram."""
+        lines = []
+        cumulative = 0
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            labels = format_labels(self.labels, f'le="{bound}"')
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels)
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {self.count}")
+        return lines
+
+
+class Registry(object):
+    """Collection of named metrics that renders in Prometheus text format."""
+
+    def __init__(self):
+        self.families = {}
+        self._lock = threading.Lock()
+
+    def get(self, metric_type: type, name: str, help: str, labels: dict, **kwargs):
+        """Gets the metric with the given name and labels, creating it if needed."""
+        key = tuple(sorted((labels or {}).items()))
+        with self._lock:
+            family = self.families.setdefault(name, (metric_type, help, {}))
+            if family[0] is not metric_type:
+                raise ValueError(f"Metric '{name}' is already a {family[0].kind}")
+            metrics = family[2]
+            if key not in metrics:
+                metrics[key] = metric_type(labels=key, **kwargs)
+            return metrics[key]
+
+    def counter(self, name: str, help: str, labels: dict = None) -> Counter:
+        """Gets a counter metric."""
+        return self.get(Counter, name, help, labels)
+
+    def gauge(
+        self, name: str, help: str, labels: dict = None, func: Callable = None
+    ) -> Gauge:
+        """Gets a gauge metric; if a function is given, it is read on render."""
+        return self.get(Gauge, name, help, labels, func=func)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: dict = None,
+        buckets: tuple = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        """Gets a histogram metric."""
+        return self.get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self) -> str:
+        """Renders all metrics in Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            families = list(self.families.items())
+        for name, (metric_type, help, metrics) in sorted(families):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {metric_type.kind}")
+            for metric in list(metrics.values()):
+                lines.extend(metric.render(name))
+        return "\n".join(lines) + "\n"
+
+
+def serve(
+    registry: Registry,
+    host: str = "127.0.0.1",
+    port: int = 9100,
+    routes: dict[str, Callable[[dict], str]] = None,
+):
+    """
+    Serves the registry at http://host:port/metrics from a background thread.
+    Extra routes map a path to a function of the parsed query string that
+    gets the text to answer with, e.g. {"/profile": profiler.handle_admin}.
+
+    Returns: the running HTTP server; call shutdown() on it to stop
+    """
+    routes = {"/metrics": lambda query: registry.render(), **(routes or {})}
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            url = urllib.parse.urlsplit(self.path)
+            route = routes.get(url.path)
+            if route is None:
+                self.send_error(404)
+                return
+            try:
+                body = route(urllib.parse.parse_qs(url.query)).encode()
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args) -> None:
+            LOG.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    LOG.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+
+def dump_periodically(
+    registry: Registry, path: str, interval: float = 60.0
+) -> threading.Event:
+    """
+    Writes the registry to a file every interval from a background thread.
+
+    Returns: event to set to stop dumping
+    """
+    stop = threading.Event()
+
+    def dump() -> None:
+        while not stop.wait(interval):
+            with open(path, "w") as f:
+                f.write(registry.render())
+
+    threading.Thread(target=dump, daemon=True).start()
+    return stop
+
@@ -0,0 +1,287 @@
+"""
+Sampling profiler for finding where requests spend time and memory.
+
+One in every N calls is run under cProfile and/or tracemalloc, and the
+samples are aggregated until they are dumped, so profiling can be left on in
+production. Unsampled calls cost a counter increment.
+"""
+# built-in imports
+import collections
+import contextlib
+import cProfile
+import io
+import itertools
+import logging
+import os
+import pstats
+import signal
+import threading
+import tracemalloc
+from typing import Iterator
+
+LOG = logging.getLogger(__name__)
+
+FORMATS = ["pstats", "collapsed", "text"]
+NOT_SAMPLED = contextlib.nullcontext()
+# deepest call stack written in collapsed format
+MAX_STACK_DEPTH = 64
+
+
+class Profiler(object):
+    """
+    Profiles one in every rate calls and aggregates the results.
+    Samples are taken one at a time, so a call selected while another is
+    being profiled on a different thread is skipped rather than blocked.
+    Memory samples record what a call allocated and still held when it
+    returned, and the peak traced while it ran; allocations made by other
+    threads during a sample are counted too.
+    """
+
+    def __init__(
+        self,
+        rate: int = 100,
+        cpu: bool = True,
+        memory: bool = False,
+        top: int = 25,
+        enabled: bool = True,
+    ):
+        self.rate = max(1, rate)
+        self.cpu = cpu
+        self.memory = memory
+        self.top = top
+        self.enabled = enabled
+        self.counter = itertools.count()
+        self.sample_lock = threading.Lock()
+        self.results_lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """Discards the aggregated samples."""
+        with self.results_lock:
+            self.stats = None
+            self.allocations = collections.Counter()
+            self.calls = 0
+            self.samples = 0
+            self.peak = 0
+
+    def configure(self, enabled: bool = None, rate: int = None) -> None:
+        """Turns sampling on or off, or changes its rate, while running."""
+        if rate is not None:
+            self.rate = max(1, rate)
+        if enabled is not None:
+            self.enabled = enabled
+        LOG.info(
+            "Profiling %s, 1 in %d calls", "on" if self.enabled else "off", self.rate
+        )
+
+    def sample(self) -> contextlib.AbstractContextManager:
+        """
+        Gets a context manager that profiles the call inside it if the call
+        is one of the sampled ones.
+        Ex. with profiler.sample():
+                calculator.evaluate_expression(input)
+        """
+        if not self.enabled:
+            return NOT_SAMPLED
+        self.calls += 1
+        if next(self.counter) % self.rate or not self.sample_lock.acquire(False):
+            return NOT_SAMPLED
+        return self._profile()
+
+    def profile(self) -> contextlib.AbstractContextManager:
+        """Gets a context manager that always profiles the code inside it."""
+        self.calls += 1
+        self.sample_lock.acquire()
+        return self._profile()
+
+    @contextlib.contextmanager
+    def _profile(self) -> Iterator[None]:
+        """Profiles the code inside; the sample lock must already be held."""
+        profile = cProfile.Profile() if self.cpu else None
+        # leave tracing alone if something else started it
+        memory = self.memory and not tracemalloc.is_tracing()
+        snapshot = None
+        peak = 0
+        try:
+            if memory:
+                tracemalloc.start()
+            if profile is not None:
+                profile.enable()
+            try:
+                yield
+            finally:
+                if profile is not None:
+                    profile.disable()
+                if memory:
+                    snapshot = tracemalloc.take_snapshot()
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                self.record(profile, snapshot, peak)
+        finally:
+            self.sample_lock.release()
+
+    def record(
+        self, profile: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak: int
+    ) -> None:
+        """Adds one sample to the aggregated results."""
+        allocations = {}
+        if snapshot is not None:
+            snapshot = snapshot.filter_traces(
+                [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, "<*")]
+            )
+            for stat in snapshot.statistics("lineno"):
+                frame = stat.traceback[0]
+                allocations[f"{frame.filename}:{frame.lineno}"] = stat.size
+        with self.results_lock:
+            self.samples += 1
+            self.peak = max(self.peak, peak)
+            self.allocations.update(allocations)
+            if profile is not None:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+    def report(self) -> str:
+        """Gets the aggregated samples as text, busiest functions first."""
+        lines = [
+            f"Profiled {self.samples} of {self.calls} calls "
+            f"(1 in {self.rate}, {'on' if self.enabled else 'off'})"
+        ]
+        with self.results_lock:
+            if self.stats is not None:
+                text = io.StringIO()
+                stats = pstats.Stats(stream=text)
+                stats.add(self.stats)
+                stats.sort_stats("cumulative").print_stats(self.top)
+                lines.append(text.getvalue().strip("\n"))
+            if self.allocations:
+                lines.append(f"Peak traced memory: {self.peak} bytes")
+                lines.append("Bytes still allocated when sampled calls returned:")
+                for location, size in self.allocations.most_common(self.top):
+                    lines.append(f"{size:>12} {location}")
+        return "\n".join(lines) + "\n"
+
+    def collapsed(self) -> list[str]:
+        """
+        Gets the CPU samples as collapsed stacks for flame graph tools, one
+        "caller;callee self-microseconds" line per stack.
+        pstats only keeps caller-callee pairs, so the time of a function
+        called from several places is split between its stacks in proportion
+        to the time each caller spent in it.
+        Ex. ["calculator.py:351:run;evaluator.py:266:execute 120"]
+        """
+        with self.results_lock:
+            if self.stats is None:
+                return []
+            entries = dict(self.stats.stats)
+
+        children = collections.defaultdict(dict)
+        for function, (_, _, _, _, callers) in entries.items():
+            for caller, (_, _, _, cumulative) in callers.items():
+                children[caller][function] = cumulative
+        roots = [
+            function
+            for function, entry in entries.items()
+            if not any(caller in entries for caller in entry[4])
+        ]
+
+        totals = collections.Counter()
+
+        def walk(function: tuple, stack: tuple, share: float) -> None:
+            own = entries[function][2]
+            stack += (function,)
+            totals[stack] += own * share
+            if len(stack) >= MAX_STACK_DEPTH:
+                return
+            for child, time in children[function].items():
+                if child in stack or not entries[child][3]:
+                    continue
+                child_share = min(1.0, time * share / entries[child][3])
+                # skip branches under a microsecond
+                if entries[child][3] * child_share >= 1e-6:
+                    walk(child, stack, child_share)
+
+        for root in roots:
+            walk(root, (), 1.0)
+        lines = []
+        for stack, seconds in totals.items():
+            microseconds = round(seconds * 1e6)
+            if microseconds:
+                lines.append(f"{';'.join(map(frame_label, stack))} {microseconds}")
+        return lines
+
+    def dump(self, path: str, format: str = "pstats") -> None:
+        """
+        Writes the aggregated samples to a file.
+            - "pstats": binary stats for pstats, snakeviz or gprof2dot
+            - "collapsed": stacks for flamegraph.pl or speedscope
+            - "text": the report, including memory samples
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Unknown profile format '{format}', expected {FORMATS}")
+        if format == "pstats":
+            with self.results_lock:
+                if self.stats is None:
+                    raise ValueError("No CPU samples to dump")
+                self.stats.dump_stats(path)
+            return
+        with open(path, "w") as f:
+            if format == "collapsed":
+                f.write("".join(f"{line}\n" for line in self.collapsed()))
+            else:
+                f.write(self.report())
+
+    def dump_all(self, prefix: str) -> None:
+        """Writes the text report, and the CPU samples if any, next to a prefix."""
+        self.dump(f"{prefix}.txt", "text")
+        if self.stats is not None:
+            self.dump(f"{prefix}.prof", "pstats")
+            self.dump(f"{prefix}.folded", "collapsed")
+        LOG.info(f"Wrote profile to {prefix}.*")
+
+    def install_signals(self, prefix: str) -> None:
+        """
+        Dumps the samples to files next to the prefix on SIGUSR1, and turns
+        sampling on or off on SIGUSR2, e.g. kill -USR1 <pid>.
+        """
+        if not hasattr(signal, "SIGUSR1"):
+            LOG.warning("Profiling signals are not supported on this platform")
+            return
+
+        # the handler may interrupt a sample holding the locks, so the work
+        # is done on another thread
+        def dump(signum: int, frame: object) -> None:
+            threading.Thread(target=self.dump_all, args=(prefix,)).start()
+
+        def toggle(signum: int, frame: object) -> None:
+            self.configure(enabled=not self.enabled)
+
+        signal.signal(signal.SIGUSR1, dump)
+        signal.signal(signal.SIGUSR2, toggle)
+        LOG.info(f"Profiling: kill -USR1 {os.getpid()} writes {prefix}.*")
+
+    def handle_admin(self, query: dict[str, list[str]]) -> str:
+        """
+        Handles an admin request to the profiler and gets the report.
+        Ex. {"rate": ["10"]} samples 1 in 10 calls; a rate of 0 turns it off
+            {"reset": ["1"]} discards the samples so far
+        """
+        if "rate" in query:
+            rate = int(query["rate"][0])
+            self.configure(enabled=rate > 0, rate=rate or None)
+        if "reset" in query:
+            self.reset()
+        return self.report()
+
+
+def frame_label(function: tuple[str, int, str]) -> str:
+    """
+    Gets a short label for a pstats function key.
+    Ex. ("/src/evaluator.py", 266, "execute") -> "evaluator.py:266:execute"
+    """
+    filename, line, name = function
+    if filename == "~":
+        # built-in functions, e.g. "<built-in method math.sqrt>"
+        return name.strip("<>")
+    return f"{os.path.basename(filename)}:{line}:{name}"
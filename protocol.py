@@ -0,0 +1,283 @@
+"""
+Wire protocol shared by the client and server.
+
+Every message is a frame: a fixed header followed by a UTF-8 payload.
+    request_id (uint32) | flags (uint16) | length (uint32) | payload
+Responses echo the request_id of their request, so a client can pipeline
+many requests on one connection and match responses in any order.
+On requests the flags carry evaluation options:
+    bits 0-1: number mode (0 float, 1 fraction, 2 decimal)
+    bit 2: binary, results may be sent as packed doubles
+    bit 3: batch, the payload holds many expressions separated by newlines
+    bits 8-15: decimal precision in digits (0 for the server default)
+On responses the flags carry a status code in bits 0-1 (0 ok, 1 error,
+2 overloaded: not evaluated, safe to retry later), and the binary and
+batch bits describe the payload. Binary is only honoured for float requests,
+so clients must check the response bit rather than assume it. A response too
+large to send is replaced by a single text error, even for a batch request.
+
+Response payloads:
+    text: the UTF-8 result, or the error message
+    binary: the result as a big-endian double, or the UTF-8 error message
+    text batch: count (uint32) | failed (uint32) | status (uint8) per result
+        | UTF-8 results separated by newlines
+    binary batch: count (uint32) | failed (uint32) | big-endian double per
+        result, NaN if it failed | status (uint8) per result
+        | UTF-8 error messages of the failed results separated by newlines
+The doubles of a binary batch start at byte 8, so they can be read in place,
+e.g. numpy.frombuffer(payload, ">f8", count, offset=8).
+"""
+# built-in imports
+import math
+import socket
+import struct
+from typing import NamedTuple
+
+HEADER = struct.Struct("!IHI")
+MAX_PAYLOAD = 16 * 1024 * 1024
+MAX_REQUEST_ID = 2**32 - 1
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_OVERLOADED = 2
+STATUS_MASK = 0x0003
+
+FLAG_BINARY = 0x0004
+FLAG_BATCH = 0x0008
+DOUBLE = struct.Struct("!d")
+BATCH_HEADER = struct.Struct("!II")
+
+NUMBER_MODES = ["float", "fraction", "decimal"]
+NUMBER_MASK = 0x0003
+PRECISION_SHIFT = 8
+MAX_PRECISION = 255
+
+
+class Frame(NamedTuple):
+    """Single protocol message."""
+
+    request_id: int
+    flags: int
+    payload: bytes
+
+
+class Result(NamedTuple):
+    """Single decoded result; the value is a float if sent in binary."""
+
+    status: int
+    value: object
+
+    @property
+    def ok(self) -> bool:
+        return self.status == STATUS_OK
+
+
+def encode_frame(request_id: int, payload: bytes, flags: int = 0) -> bytes:
+    """Packs a payload and its header into bytes ready to send."""
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {len(payload)} bytes exceeds {MAX_PAYLOAD}")
+    return HEADER.pack(request_id, flags, len(payload)) + payload
+
+
+def decode_header(header: bytes) -> tuple[int, int, int]:
+    """Unpacks a header into (request_id, flags, length)."""
+    request_id, flags, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise ValueError(f"Payload of {length} bytes exceeds {MAX_PAYLOAD}")
+    return request_id, flags, length
+
+
+def recv_exactly(sock: socket.socket, size: int, buffer: int = 65536) -> bytes:
+    """
+    Receives exactly the given number of bytes from a blocking socket.
+    Returns an empty bytes object if the connection closes before any data.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, buffer))
+        if not chunk:
+            if remaining == size:
+                return b""
+            raise ConnectionError("Connection closed mid-frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(sock: socket.socket, buffer: int = 65536) -> Frame:
+    """Reads one frame from a blocking socket; returns None on a clean close."""
+    header = recv_exactly(sock, HEADER.size, buffer)
+    if not header:
+        return None
+    request_id, flags, length = decode_header(header)
+    payload = recv_exactly(sock, length, buffer) if length else b""
+    if length and not payload:
+        raise ConnectionError("Connection closed mid-frame")
+    return Frame(request_id, flags, payload)
+
+
+async def read_frame_async(reader: "asyncio.StreamReader") -> Frame:
+    """Reads one frame from an asyncio stream; returns None on a clean close."""
+    # imported here so blocking clients never pay for loading asyncio
+    import asyncio
+
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed mid-frame") from e
+        return None
+    request_id, flags, length = decode_header(header)
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("Connection closed mid-frame") from e
+    return Frame(request_id, flags, payload)
+
+
+def encode_options(number: str = "float", precision: int = None) -> int:
+    """Packs evaluation options into request flags."""
+    if number not in NUMBER_MODES:
+        raise ValueError(f"Unknown number type '{number}', expected {NUMBER_MODES}")
+    # 0 asks for the server default
+    precision = precision or 0
+    if not 0 <= precision <= MAX_PRECISION:
+        raise ValueError(
+            f"Precision must be between 1 and {MAX_PRECISION}, or 0 for the default"
+        )
+    return NUMBER_MODES.index(number) | (precision << PRECISION_SHIFT)
+
+
+def decode_options(flags: int) -> dict:
+    """
+    Unpacks request flags into keyword arguments for a class run().
+    Returns an empty dict for default options, so plain requests call run(input).
+    """
+    options = {}
+    mode = flags & NUMBER_MASK
+    if mode:
+        if mode >= len(NUMBER_MODES):
+            raise ValueError(f"Unknown number mode {mode}")
+        options["number"] = NUMBER_MODES[mode]
+    precision = (flags >> PRECISION_SHIFT) & MAX_PRECISION
+    if precision:
+        options["precision"] = precision
+    return options
+
+
+def result_status(result: object) -> int:
+    """Gets the response status for a result returned by a class run()."""
+    if str(result).startswith("Error"):
+        return STATUS_ERROR
+    return STATUS_OK
+
+
+def split_batch(payload: bytes) -> list[str]:
+    """Splits the payload of a batch request into its expressions."""
+    if not payload:
+        return []
+    return payload.decode(errors="replace").split("\n")
+
+
+def encode_results(
+    results: list, flags: int, statuses: list[int] = None
+) -> tuple[int, bytes]:
+    """
+    Encodes the results of a request in the format the request flags ask for.
+    A single request has one result. Statuses default to those of the results.
+
+    Returns: (response flags, payload)
+    """
+    if statuses is None:
+        statuses = [result_status(result) for result in results]
+    texts = [str(result).replace("\n", " ") for result in results]
+    binary = bool(flags & FLAG_BINARY) and not flags & NUMBER_MASK
+    if binary:
+        try:
+            values = [
+                float(text) if status == STATUS_OK else math.nan
+                for text, status in zip(texts, statuses)
+            ]
+        except ValueError:
+            binary = False
+    response_flags = (FLAG_BINARY if binary else 0) | (flags & FLAG_BATCH)
+
+    if not flags & FLAG_BATCH:
+        if binary and statuses[0] == STATUS_OK:
+            payload = DOUBLE.pack(values[0])
+        else:
+            payload = texts[0].encode()
+        return response_flags | statuses[0], payload
+
+    # a batch is an error if any of its results is
+    response_flags |= max(statuses, default=STATUS_OK)
+    failed = [text for text, status in zip(texts, statuses) if status != STATUS_OK]
+    parts = [BATCH_HEADER.pack(len(results), len(failed))]
+    if binary:
+        parts += [struct.pack(f"!{len(values)}d", *values), bytes(statuses)]
+        parts.append("\n".join(failed).encode())
+    else:
+        parts += [bytes(statuses), "\n".join(texts).encode()]
+    return response_flags, b"".join(parts)
+
+
+def encode_response(
+    request_id: int, results: list, flags: int, statuses: list[int] = None
+) -> tuple[int, bytes]:
+    """
+    Encodes the results of a request into a response frame ready to send.
+    Results can encode larger than their request, e.g. a batch of "1/3" in
+    fraction mode, so a payload over MAX_PAYLOAD is replaced by an error.
+
+    Returns: (response flags, frame)
+    """
+    response_flags, payload = encode_results(results, flags, statuses)
+    if len(payload) > MAX_PAYLOAD:
+        message = f"Error: Response of {len(payload)} bytes exceeds {MAX_PAYLOAD}"
+        response_flags, payload = STATUS_ERROR, message.encode()
+    return response_flags, encode_frame(request_id, payload, response_flags)
+
+
+def decode_results(frame: Frame) -> list[Result]:
+    """Decodes the result, or results of a batch, in a response frame."""
+    payload = frame.payload
+    binary = frame.flags & FLAG_BINARY
+    if not frame.flags & FLAG_BATCH:
+        status = frame.flags & STATUS_MASK
+        if binary and status == STATUS_OK:
+            return [Result(status, DOUBLE.unpack(payload)[0])]
+        return [Result(status, payload.decode())]
+
+    count, failed = BATCH_HEADER.unpack_from(payload)
+    offset = BATCH_HEADER.size
+    if binary:
+        values = struct.unpack_from(f"!{count}d", payload, offset)
+        offset += DOUBLE.size * count
+    statuses = payload[offset : offset + count]
+    text = payload[offset + count :].decode()
+    texts = text.split("\n") if (failed if binary else count) else []
+    if not binary:
+        return [Result(status, text) for status, text in zip(statuses, texts)]
+    errors = iter(texts)
+    return [
+        Result(status, value if status == STATUS_OK else next(errors))
+        for status, value in zip(statuses, values)
+    ]
+
+
+def decode_arrays(frame: Frame) -> tuple["numpy.ndarray", "numpy.ndarray"]:
+    """
+    Reads the values and statuses of a binary batch response as arrays,
+    without decoding each result. Failed results have a NaN value.
+    """
+    # imported here so numpy is only needed by bulk consumers
+    import numpy as np
+
+    if frame.flags & (FLAG_BINARY | FLAG_BATCH) != FLAG_BINARY | FLAG_BATCH:
+        raise ValueError("Response is not a binary batch")
+    count, _ = BATCH_HEADER.unpack_from(frame.payload)
+    offset = BATCH_HEADER.size
+    values = np.frombuffer(frame.payload, ">f8", count, offset).astype(float)
+    statuses = np.frombuffer(frame.payload, np.uint8, count, offset + 8 * count)
+    return values, statuses
@@ -0,0 +1,202 @@
+"""
+Persistent cache of results shared by every process on a host.
+
+The cache is a fixed-size hash table in a memory-mapped file, so its size is
+bounded and it survives restarts. Each slot holds one key and its result:
+    version (uint32) | stamp (uint64) | hash (uint64) | key length (uint16)
+    | value length (uint16) | key | value
+Readers take no lock and compare keys in place in the mapping. Writers
+serialize on a thread lock within a process and a file lock across processes,
+and bump the slot version to an odd number while writing, so a reader that
+races a writer, or finds a slot torn by a crash, sees a miss rather than a
+mixed result. When the probe window of a key is full, the slot written longest
+ago is evicted.
+"""
+# built-in imports
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b"CALCRC01"
+# magic, number of slots, slot size, write clock
+HEADER = struct.Struct("<8sIIQ")
+SLOT_HEADER = struct.Struct("<IQQHH")
+CLOCK_OFFSET = 16
+# slots tried per key before evicting
+PROBES = 8
+
+
+def hash_key(key: bytes) -> int:
+    """Gets a 64-bit hash of a key that is the same in every process."""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+class ResultCache(object):
+    """
+    Memory-mapped hash table of string results, shared across processes.
+    Ex. cache = ResultCache("results.cache")
+        cache.put("float|1 + 2", "3.0")
+        cache.get("float|1 + 2") -> "3.0"
+    """
+
+    def __init__(self, path: str, slots: int = 65536, slot_size: int = 256):
+        """
+        Args:
+            path: cache file, created if missing; an existing file keeps the
+                slot count and size it was created with
+            slots: max number of results kept
+            slot_size: bytes per slot; longer key and result pairs are not cached
+        """
+        self.path = Path(path)
+        if not self.path.exists():
+            self.create(self.path, slots, slot_size)
+        self.file = open(self.path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, self.slots, self.slot_size, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a result cache")
+        self.view = memoryview(self.map)
+        self.capacity = self.slot_size - SLOT_HEADER.size
+        self.hits = 0
+        self.misses = 0
+        # flock does not exclude threads sharing the file, so they take this too
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create(path: Path, slots: int, slot_size: int) -> None:
+        """
+        Creates an empty cache file. The file is written in full under a
+        temporary name and then linked into place, so other processes never
+        open a half-initialized file.
+        """
+        if slot_size <= SLOT_HEADER.size:
+            raise ValueError(f"Slot size must be over {SLOT_HEADER.size} bytes")
+        fd, temp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(HEADER.pack(MAGIC, slots, slot_size, 0))
+                f.truncate(HEADER.size + slots * slot_size)
+            try:
+                os.link(temp, path)
+                LOG.info(f"Created result cache {path} with {slots} slots")
+            except FileExistsError:
+                # another process created it first
+                pass
+        finally:
+            os.unlink(temp)
+
+    def __len__(self) -> int:
+        """Gets the number of slots in use."""
+        return sum(
+            SLOT_HEADER.unpack_from(self.map, self.offset(slot))[0] != 0
+            for slot in range(self.slots)
+        )
+
+    def offset(self, slot: int) -> int:
+        """Gets the byte offset of a slot in the file."""
+        return HEADER.size + slot * self.slot_size
+
+    def get(self, key: str) -> str:
+        """Gets the cached result for a key, or None on a miss."""
+        data = key.encode()
+        key_hash = hash_key(data)
+        for probe in range(PROBES):
+            offset = self.offset((key_hash + probe) % self.slots)
+            version, _, slot_hash, key_length, value_length = SLOT_HEADER.unpack_from(
+                self.map, offset
+            )
+            if version == 0:
+                # slots are never emptied, so the key is not further along
+                break
+            if slot_hash != key_hash or key_length != len(data) or version & 1:
+                continue
+            start = offset + SLOT_HEADER.size
+            if self.view[start : start + key_length] != data:
+                continue
+            start += key_length
+            value = self.view[start : start + value_length].tobytes()
+            if SLOT_HEADER.unpack_from(self.map, offset)[0] != version:
+                # rewritten while reading
+                break
+            self.hits += 1
+            return value.decode()
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: str) -> bool:
+        """
+        Stores a result, evicting the oldest entry in the key's probe window
+        if it is full. Returns False if the pair is too long for a slot.
+        """
+        data = key.encode()
+        encoded = value.encode()
+        if len(data) + len(encoded) > self.capacity:
+            return False
+        key_hash = hash_key(data)
+        with self.lock:
+            self._write(key_hash, data, encoded)
+        return True
+
+    def _write(self, key_hash: int, data: bytes, encoded: bytes) -> None:
+        """Writes a pair to its slot under the file lock."""
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        try:
+            clock = struct.unpack_from("<Q", self.map, CLOCK_OFFSET)[0] + 1
+            struct.pack_into("<Q", self.map, CLOCK_OFFSET, clock)
+
+            target = None
+            oldest = None
+            for probe in range(PROBES):
+                offset = self.offset((key_hash + probe) % self.slots)
+                version, stamp, slot_hash, key_length, _ = SLOT_HEADER.unpack_from(
+                    self.map, offset
+                )
+                start = offset + SLOT_HEADER.size
+                if version == 0 or (
+                    slot_hash == key_hash
+                    and self.view[start : start + key_length] == data
+                ):
+                    target = (offset, version)
+                    break
+                if oldest is None or stamp < oldest[2]:
+                    oldest = (offset, version, stamp)
+            offset, version = target or oldest[:2]
+
+            # odd while writing, so readers skip the slot
+            struct.pack_into("<I", self.map, offset, (version + 1) | 1)
+            start = offset + SLOT_HEADER.size
+            self.map[start : start + len(data)] = data
+            start += len(data)
+            self.map[start : start + len(encoded)] = encoded
+            SLOT_HEADER.pack_into(
+                self.map,
+                offset,
+                (version | 1) + 1,
+                clock,
+                key_hash,
+                len(data),
+                len(encoded),
+            )
+        finally:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+
+    def stats(self) -> dict[str, int]:
+        """Gets the slot count and this process's hit/miss counters."""
+        return {"slots": self.slots, "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        """Unmaps and closes the cache file."""
+        if getattr(self, "view", None) is not None:
+            self.view.release()
+            self.view = None
+        self.map.close()
+        self.file.close()
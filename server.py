@@ -1,13 +1,27 @@
+import argparse
+import asyncio
+import functools
+import logging
 import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import logger
+import metrics
+import protocol
 from calculator import Calculator
+from profiler import Profiler
+from workers import WorkerPool
+
+
+LOG = logging.getLogger(__name__)
 
 
 class Server(object):
     """Simple server class."""
 
-    def __init__(self, port: int = 8000, buffer: int = 1024):
-        self.host = socket.gethostbyname(socket.gethostname())
+    def __init__(self, port: int = 8000, buffer: int = 1024, host: str = None):
+        self.host = host or socket.gethostbyname(socket.gethostname())
         self.port = port
         self.buffer = buffer
         self.connection = None
@@ -29,26 +43,444 @@ class Server(object):
 
         while True:
             # receive data
-            data = self.connection.recv(self.buffer).decode()
-            if not data:
+            frame = protocol.read_frame(self.connection, self.buffer)
+            if frame is None:
                 break
-            print(f"Received: {data}")
+            if frame.flags & protocol.FLAG_BATCH:
+                messages = protocol.split_batch(frame.payload)
+            else:
+                messages = [frame.payload.decode(errors="replace")]
+            print(f"Received: {messages}")
 
             # execute class - assumes there is a run function
-            result = class_inst.run(data)
+            try:
+                options = protocol.decode_options(frame.flags)
+                results = [class_inst.run(data, **options) for data in messages]
+            except ValueError as e:
+                results = [f"Error: {e}"] * len(messages)
 
             # send result to client
-            self.connection.send(str(result).encode())
-            print(f"Sent: {result}")
+            _, response = protocol.encode_response(
+                frame.request_id, results, frame.flags
+            )
+            self.connection.sendall(response)
+            print(f"Sent: {results}")
 
         # close connection
         self.connection.close()
         print("Closed connection")
 
 
+class AsyncServer(object):
+    """
+    Concurrent server class built on asyncio streams.
+    Accepts many clients at once and keeps each connection open across requests.
+    Pipelined requests on one connection are evaluated concurrently and
+    answered as they complete, tagged with their request id.
+    Evaluation runs in a thread pool, or in worker processes if a pool is given.
+
+    Admission control keeps one client from slowing down the others:
+        - a connection with max_inflight requests in flight is not read from
+          until one completes, so TCP pushes back on a client sending faster
+          than it is served
+        - once max_pending expressions are in flight across all connections,
+          new requests are answered at once with an overloaded status
+    """
+
+    def __init__(
+        self,
+        port: int = 8000,
+        buffer: int = 1024,
+        host: str = None,
+        backlog: int = 1024,
+        max_workers: int = None,
+        pool: WorkerPool = None,
+        registry: metrics.Registry = None,
+        max_inflight: int = 64,
+        max_pending: int = None,
+    ):
+        self.host = host or socket.gethostbyname(socket.gethostname())
+        self.port = port
+        self.buffer = buffer
+        self.backlog = backlog
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pool = pool
+        self.server = None
+        self.class_inst = None
+        self.connections = set()
+        self.registry = registry
+        if registry is not None:
+            self.create_metrics(registry)
+
+    def create_metrics(self, registry: metrics.Registry) -> None:
+        """Creates the request counters and latency histogram."""
+        self.requests_total = registry.counter(
+            "server_requests_total", "Requests handled."
+        )
+        self.errors_total = registry.counter(
+            "server_errors_total", "Requests answered with an error status."
+        )
+        self.rejected_total = registry.counter(
+            "server_rejected_total", "Requests refused with an overloaded status."
+        )
+        self.request_latency = registry.histogram(
+            "server_request_latency_seconds", "Time from request to response."
+        )
+        registry.gauge(
+            "server_connections",
+            "Open client connections.",
+            func=lambda: len(self.connections),
+        )
+
+    async def start(self, class_inst: object) -> None:
+        """Starts listening for clients without blocking."""
+        self.class_inst = class_inst
+        if self.pool is not None:
+            self.pool.start()
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, backlog=self.backlog
+        )
+        # resolve the actual port when binding to port 0
+        self.port = self.server.sockets[0].getsockname()[1]
+        LOG.info(f"Listening on {self.host}:{self.port}")
+
+    async def serve(self, class_inst: object) -> None:
+        """Starts the server and handles clients until cancelled."""
+        await self.start(class_inst)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def stop(self) -> None:
+        """Stops accepting clients and closes all open connections."""
+        self.server.close()
+        for task in list(self.connections):
+            task.cancel()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+        if self.pool is not None:
+            self.pool.close()
+
+    def run(self, class_inst: object) -> None:
+        """
+        Runs the given class on the server.
+        Assumes the class includes a run() function and accepts a string input.
+        """
+        try:
+            asyncio.run(self.serve(class_inst))
+        finally:
+            self.executor.shutdown(wait=False)
+            if self.pool is not None:
+                self.pool.close()
+
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Handles requests from one client until it disconnects."""
+        address = writer.get_extra_info("peername")
+        LOG.info(f"Connected to {address}")
+        task = asyncio.current_task()
+        self.connections.add(task)
+        write_lock = asyncio.Lock()
+        requests = set()
+        inflight = asyncio.Semaphore(self.max_inflight)
+
+        def done(request: asyncio.Task) -> None:
+            requests.discard(request)
+            inflight.release()
+
+        try:
+            while True:
+                # stop reading while the connection is at its limit
+                await inflight.acquire()
+                frame = await protocol.read_frame_async(reader)
+                if frame is None:
+                    break
+                request = asyncio.create_task(
+                    self.handle_request(frame, writer, write_lock)
+                )
+                requests.add(request)
+                request.add_done_callback(done)
+            # finish in-flight requests before closing
+            await asyncio.gather(*requests)
+        except (ConnectionError, ValueError) as e:
+            LOG.error(e)
+        except asyncio.CancelledError:
+            # server is stopping; end the handler cleanly
+            pass
+        finally:
+            for request in requests:
+                request.cancel()
+            self.connections.discard(task)
+            writer.close()
+            LOG.info(f"Closed connection to {address}")
+
+    async def handle_request(
+        self,
+        frame: protocol.Frame,
+        writer: asyncio.StreamWriter,
+        write_lock: asyncio.Lock,
+    ) -> None:
+        """
+        Evaluates one request, or every expression of a batch request, and
+        writes its response frame.
+        """
+        start = time.perf_counter()
+        if frame.flags & protocol.FLAG_BATCH:
+            messages = protocol.split_batch(frame.payload)
+        else:
+            messages = [frame.payload.decode(errors="replace")]
+        LOG.debug("Received [%d]: %s", frame.request_id, messages)
+
+        if self.overloaded(len(messages)):
+            results = ["Error: Server is overloaded, retry later"] * len(messages)
+            statuses = [protocol.STATUS_OVERLOADED] * len(messages)
+        else:
+            statuses = None
+            self.pending += len(messages)
+            try:
+                results = await self.evaluate(messages, frame.flags)
+            finally:
+                self.pending -= len(messages)
+
+        flags, response = protocol.encode_response(
+            frame.request_id, results, frame.flags, statuses
+        )
+        if self.registry is not None:
+            self.requests_total.inc()
+            if statuses is not None:
+                self.rejected_total.inc()
+            elif flags & protocol.STATUS_MASK != protocol.STATUS_OK:
+                self.errors_total.inc()
+            self.request_latency.observe(time.perf_counter() - start)
+
+        async with write_lock:
+            writer.write(response)
+            await writer.drain()
+        LOG.debug("Sent [%d]: %s", frame.request_id, results)
+
+    def overloaded(self, count: int) -> bool:
+        """
+        Checks whether taking on more expressions would pass max_pending.
+        An idle server takes any request, so one large batch is never refused.
+        """
+        if self.max_pending is None or not self.pending:
+            return False
+        return self.pending + count > self.max_pending
+
+    async def evaluate(self, messages: list[str], flags: int) -> list[object]:
+        """Evaluates the messages of a request off the event loop."""
+        try:
+            options = protocol.decode_options(flags)
+        except ValueError as e:
+            return [f"Error: {e}"] * len(messages)
+        if self.pool is not None:
+            return await asyncio.gather(
+                *(self.pool.run(message, options) for message in messages)
+            )
+        loop = asyncio.get_running_loop()
+        run = functools.partial(self.run_all, messages, options)
+        return await loop.run_in_executor(self.executor, run)
+
+    def run_all(self, messages: list[str], options: dict) -> list[object]:
+        """Runs the class on each message of a request."""
+        return [self.class_inst.run(message, **options) for message in messages]
+
+
+def parse_args() -> argparse.Namespace:
+    """Parses command-line args to configure the server."""
+    parser = argparse.ArgumentParser(description="Calculator server.")
+    parser.add_argument(
+        "--host", type=str, help="Address to listen on; defaults to this host's IP."
+    )
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument(
+        "--mode",
+        choices=["async", "single"],
+        default="async",
+        help="Serve many concurrent clients (async) or one client (single).",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Max number of compiled expressions to keep in the LRU cache.",
+    )
+    parser.add_argument(
+        "--precision",
+        type=int,
+        help="Default significant digits for requests in decimal mode.",
+    )
+    parser.add_argument(
+        "--result-cache",
+        type=str,
+        help="File of results shared by every server process on this host.\n"
+        "Kept across restarts, so a restarted server starts warm.",
+    )
+    parser.add_argument(
+        "--result-cache-slots",
+        type=int,
+        default=65536,
+        help="Max number of results in a new --result-cache file.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to evaluate in (async mode only).\n"
+        "Defaults to 0, evaluating in threads of the server process.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=10.0,
+        help="Seconds before a worker evaluation is killed.",
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=1_000_000,
+        help="Max number of tokens in one expression.",
+    )
+    parser.add_argument(
+        "--max-depth",
+        type=int,
+        default=1000,
+        help="Max nesting depth of parentheses in one expression.",
+    )
+    parser.add_argument(
+        "--max-cost",
+        type=int,
+        default=10_000_000,
+        help="Max estimated cost of evaluating one expression.",
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=64,
+        help="Max requests in flight per connection before it is no longer read.",
+    )
+    parser.add_argument(
+        "--max-pending",
+        type=int,
+        default=4096,
+        help="Max expressions in flight before requests are refused as overloaded.",
+    )
+    parser.add_argument(
+        "--profile-rate",
+        type=int,
+        default=0,
+        help="Profile one in N requests; defaults to 0, off until turned on\n"
+        "with SIGUSR2 or /profile?rate=N on the metrics port.",
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also trace memory allocated by profiled requests.",
+    )
+    parser.add_argument(
+        "--profile-dump",
+        type=str,
+        default="server_profile",
+        help="Prefix of the files SIGUSR1 writes the profile to.",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+        help="Minimum level to log.",
+    )
+    parser.add_argument(
+        "--log-sample",
+        type=int,
+        default=1,
+        help="Keep one in N log records at INFO level and below.",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve Prometheus metrics at http://127.0.0.1:{port}/metrics.",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="127.0.0.1",
+        help="Address to serve metrics on; defaults to localhost only.",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        type=str,
+        help="File to periodically write Prometheus metrics to.",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between writes of --metrics-file.",
+    )
+    return parser.parse_args()
+
+
 def main():
-    server = Server()
-    server.run(Calculator())
+    args = parse_args()
+    logger.create_logger(
+        level=getattr(logging, args.log_level), sample_rate=args.log_sample
+    )
+
+    # off unless asked for, but can be turned on without a restart
+    profiler = Profiler(
+        rate=args.profile_rate or 100,
+        memory=args.profile_memory,
+        enabled=args.profile_rate > 0,
+    )
+    profiler.install_signals(args.profile_dump)
+
+    registry = None
+    if args.metrics_port is not None or args.metrics_file:
+        registry = metrics.Registry()
+        if args.metrics_port is not None:
+            metrics.serve(
+                registry,
+                args.metrics_host,
+                args.metrics_port,
+                routes={"/profile": profiler.handle_admin},
+            )
+        if args.metrics_file:
+            metrics.dump_periodically(
+                registry, args.metrics_file, args.metrics_interval
+            )
+
+    calc_kwargs = {
+        "cache_size": args.cache_size,
+        "precision": args.precision,
+        "result_cache": args.result_cache,
+        "result_cache_slots": args.result_cache_slots,
+        "max_tokens": args.max_tokens,
+        "max_depth": args.max_depth,
+        "max_cost": args.max_cost,
+    }
+    if args.mode == "async":
+        pool = None
+        if args.workers:
+            pool = WorkerPool(
+                Calculator,
+                calc_kwargs,
+                processes=args.workers,
+                timeout=args.timeout,
+            )
+        server = AsyncServer(
+            host=args.host,
+            port=args.port,
+            pool=pool,
+            registry=registry,
+            max_inflight=args.max_inflight,
+            max_pending=args.max_pending,
+        )
+    else:
+        server = Server(host=args.host, port=args.port)
+    server.run(Calculator(metrics=registry, profiler=profiler, **calc_kwargs))
 
 
 if __name__ == "__main__":
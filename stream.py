@@ -0,0 +1,173 @@
+# built-in imports
+import itertools
+import json
+import logging
+import multiprocessing
+from collections import deque
+from typing import Iterable, Iterator, TextIO
+
+# custom imports
+import workers
+from calculator import Calculator
+
+LOG = logging.getLogger(__name__)
+
+
+class InvalidRecord(dict):
+    """JSON lines record standing in for a line that is not valid JSON."""
+
+    def __init__(self, line: str, key: str, error: json.JSONDecodeError):
+        super(InvalidRecord, self).__init__({key: line})
+        self.error = f"Error: Invalid JSON: {error}"
+
+
+def read_expressions(
+    source: TextIO, jsonl: bool = False, key: str = "input"
+) -> Iterator:
+    """
+    Lazily reads newline-delimited expressions from a text stream.
+    Blank lines are skipped. In JSON lines mode, each line is either a JSON
+    string or an object holding the expression under the given key, and the
+    decoded record is yielded so it can be written back with its result.
+    A line that is not valid JSON yields an InvalidRecord holding the line, so
+    one bad line fails alone rather than ending the stream.
+    """
+    for line in source:
+        line = line.strip()
+        if not line:
+            continue
+        if not jsonl:
+            yield line
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            LOG.error(f"Invalid JSON line: {e}")
+            yield InvalidRecord(line, key, e)
+            continue
+        if not isinstance(record, dict):
+            record = {key: record}
+        yield record
+
+
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Groups an iterable into lists of up to the given size."""
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def evaluate_chunks(
+    chunks: Iterable[list[str]],
+    engine: str = "precedence",
+    processes: int = 1,
+    number: str = "float",
+    precision: int = None,
+    result_cache: str = None,
+) -> Iterator[list[str]]:
+    """
+    Evaluates chunks of expressions as they are read, yielding results in order.
+    With more than one process, chunks are spread across a pool of workers.
+    Only a few chunks per worker are in flight at once, so memory stays
+    bounded however long the input is.
+    """
+    calc_kwargs = {
+        "engine": engine,
+        "number": number,
+        "precision": precision,
+        "result_cache": result_cache,
+    }
+    if processes <= 1:
+        calc = Calculator(**calc_kwargs)
+        for chunk in chunks:
+            yield [calc.run(expression) for expression in chunk]
+        return
+
+    with multiprocessing.Pool(
+        processes,
+        initializer=workers.init_worker,
+        initargs=(Calculator, calc_kwargs),
+    ) as pool:
+        window = deque()
+        for chunk in chunks:
+            window.append(pool.apply_async(workers.run_batch, (chunk,)))
+            if len(window) >= processes * 2:
+                yield window.popleft().get()
+        while window:
+            yield window.popleft().get()
+
+
+def evaluate_stream(
+    expressions: Iterable[str],
+    engine: str = "precedence",
+    processes: int = 1,
+    chunk_size: int = 256,
+    number: str = "float",
+    precision: int = None,
+    result_cache: str = None,
+) -> Iterator[str]:
+    """Evaluates expressions as they are read and yields results in input order."""
+    chunks = chunked(expressions, chunk_size)
+    results_iter = evaluate_chunks(
+        chunks, engine, processes, number, precision, result_cache
+    )
+    for results in results_iter:
+        yield from results
+
+
+def run_stream(
+    source: TextIO,
+    output: TextIO,
+    engine: str = "precedence",
+    processes: int = 1,
+    jsonl: bool = False,
+    key: str = "input",
+    chunk_size: int = 256,
+    number: str = "float",
+    precision: int = None,
+    result_cache: str = None,
+) -> int:
+    """
+    Evaluates every expression in the source and writes one result per line.
+    In JSON lines mode, each output line is the input record plus a "result".
+
+    Returns: number of expressions evaluated
+    """
+    pending = deque()
+
+    def expression_chunks() -> Iterator[list[str]]:
+        for chunk in chunked(read_expressions(source, jsonl, key), chunk_size):
+            pending.append(chunk)
+            if jsonl:
+                # invalid records are not evaluated, their error is the result
+                yield [
+                    ""
+                    if isinstance(record, InvalidRecord)
+                    else str(record.get(key, ""))
+                    for record in chunk
+                ]
+            else:
+                yield chunk
+
+    count = 0
+    results_iter = evaluate_chunks(
+        expression_chunks(), engine, processes, number, precision, result_cache
+    )
+    for results in results_iter:
+        chunk = pending.popleft()
+        if jsonl:
+            for record, result in zip(chunk, results):
+                if isinstance(record, InvalidRecord):
+                    result = record.error
+                record["result"] = result
+            lines = [json.dumps(record) for record in chunk]
+        else:
+            lines = results
+        output.write("\n".join(lines) + "\n")
+        count += len(chunk)
+    output.flush()
+    LOG.info(f"Evaluated {count} expressions")
+    return count
@@ -1,45 +1,1466 @@
+import asyncio
+import fcntl
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import pstats
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+from decimal import Decimal, localcontext
+from fractions import Fraction
+from pathlib import Path
 
 from sympy import sympify
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import calculator_ui
+    from PySide6 import QtWidgets
+except ImportError:
+    calculator_ui = None
+
+import benchmarks
+import evaluator
+import fuzz
+import logger
+import metrics
+import protocol
+import stream
+from result_cache import ResultCache
 from calculator import Calculator
+from client import Client, ClientPool, ShardedClient, parse_endpoints
+from profiler import Profiler
+from server import AsyncServer
+from workers import WorkerPool
+
+
+TEST_EXPRESSIONS = [
+    "4/3",
+    "4/-3",
+    "-4/-3",
+    "-4--5+3*9",
+    "-4*((-5+3)/7)",
+    "7/25-9/15",
+    "7/(25-9)/15",
+    "7/25/9+(-5/15)",
+    "8 / 2 * (2 + 2)",
+    "(((6 + ((4 + 2) * 9) + (8 + 1)) - 2) / 4)",
+    "2+4-3+(4-5)*3/6-(3-54)",
+    "2+4-3*3/6-(3-54*45)",
+    "7-9*(4+5+7) / 4-(-5)",
+    "(7-9*7+8) / (3+4-(-1431)) / (-4--56)",
+]
+# (expression, expected) for the grammar the classic engine does not support
+EXTENDED_EXPRESSIONS = [
+    ("2**3**2", 512.0),
+    ("-2**2", -4.0),
+    ("2**-1", 0.5),
+    ("(1+2)(3-4)", -3.0),
+    ("2(3)", 6.0),
+    ("2sqrt(16)", 8.0),
+    ("sqrt(2)**2", math.sqrt(2) ** 2),
+    ("abs(-3) + log(exp(2))", 5.0),
+    ("sin(0) - cos(0) + tan(0)", -1.0),
+    ("2*3**2 - 2**3*2", 2.0),
+    ("1/2(4)", 2.0),
+]
 
 
 class CalculatorTest(unittest.TestCase):
     """Class to check calculator implementation against library."""
 
-    def __init__(self):
-        super(CalculatorTest, self).__init__()
-        self.tests = [
-            "4/3",
-            "4/-3",
-            "-4/-3",
-            "-4--5+3*9",
-            "-4*((-5+3)/7)",
-            "7/25-9/15",
-            "7/(25-9)/15",
-            "7/25/9+(-5/15)",
-            "8 / 2 * (2 + 2)",
-            "(((6 + ((4 + 2) * 9) + (8 + 1)) - 2) / 4)",
-            "2+4-3+(4-5)*3/6-(3-54)",
-            "2+4-3*3/6-(3-54*45)",
-            "7-9*(4+5+7) / 4-(-5)",
-            "(7-9*7+8) / (3+4-(-1431)) / (-4--56)",
-        ]
-
-    def run(self) -> None:
-        calculator = Calculator()
-        for test in self.tests:
+    def test_matches_library(self) -> None:
+        calculator = Calculator(engine="classic")
+        for test in TEST_EXPRESSIONS:
             my_solution = calculator.evaluate_expression(test)
             library_check = float(sympify(test))
             self.assertAlmostEqual(my_solution, library_check, places=10)
-        print("Woohoo! Everything passed.")
 
+    def test_classic_edge_cases(self) -> None:
+        # reproducers found by fuzz.py
+        calculator = Calculator(engine="classic")
+        self.assertEqual(calculator.evaluate_expression("(28.31)"), 28.31)
+        self.assertEqual(calculator.evaluate_expression("1* -1 "), -1.0)
+        self.assertEqual(calculator.evaluate_expression("((68 - -51))"), 119.0)
+        self.assertEqual(calculator.evaluate_expression("(1+2)*(3+4)"), 21.0)
+        self.assertEqual(calculator.evaluate_expression("(1/32/38)-1"), 1 / 32 / 38 - 1)
+
+
+class EngineTest(unittest.TestCase):
+    """Class to check the precedence engine against the classic engine."""
+
+    def test_matches_classic(self) -> None:
+        calculator = Calculator()
+        for test in TEST_EXPRESSIONS:
+            classic = calculator.evaluate_expression(test, engine="classic")
+            precedence = calculator.evaluate_expression(test, engine="precedence")
+            self.assertAlmostEqual(precedence, classic, places=10)
+
+    def test_matches_library(self) -> None:
+        for test in TEST_EXPRESSIONS:
+            self.assertAlmostEqual(
+                evaluator.evaluate(test), float(sympify(test)), places=10
+            )
+
+    def test_unary_operators(self) -> None:
+        self.assertEqual(evaluator.evaluate("6 - -7 * 9"), 69.0)
+        self.assertEqual(evaluator.evaluate("+-1"), -1.0)
+        self.assertEqual(evaluator.evaluate("-(2+3)*2"), -10.0)
+        self.assertEqual(evaluator.evaluate("42"), 42.0)
+
+    def test_long_expression(self) -> None:
+        expression = "+".join(["(1*2-1)"] * 5000)
+        self.assertEqual(evaluator.evaluate(expression), 5000.0)
+
+    def test_cache(self) -> None:
+        calculator = Calculator(cache_size=2)
+        calculator.evaluate_expression("1 + 2")
+        calculator.evaluate_expression("1  +  2 ")
+        calculator.evaluate_expression("3*4")
+        calculator.evaluate_expression("5-6")
+        self.assertEqual(
+            calculator.cache.stats(),
+            {"size": 2, "max_size": 2, "hits": 1, "misses": 3, "evictions": 1},
+        )
+        self.assertEqual(calculator.evaluate_expression("3*4"), 12.0)
+        self.assertEqual(calculator.cache.hits, 2)
+
+    def test_variables(self) -> None:
+        program = evaluator.compile_expression("x * (y - 2) / -x_1")
+        self.assertEqual(program.names, ("x", "x_1", "y"))
+        self.assertEqual(program.evaluate({"x": 3, "y": 4, "x_1": 2}), -3.0)
+        with self.assertRaises(ValueError):
+            program.evaluate({"x": 3})
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_evaluate_batch(self) -> None:
+        calculator = Calculator()
+        x = np.arange(1000, dtype=float)
+        y = np.linspace(1, 2, 1000)
+        result = calculator.evaluate_batch("x * 2 - x / y + 1", {"x": x, "y": y})
+        np.testing.assert_allclose(result, x * 2 - x / y + 1)
+        result = calculator.evaluate_batch("3 * 4", {"x": x})
+        np.testing.assert_array_equal(result, np.full(1000, 12.0))
+        result = calculator.evaluate_batch("sqrt(x)**2 + 2x", {"x": x})
+        np.testing.assert_allclose(result, x * 3)
+
+    def test_invalid_input(self) -> None:
+        for test in ["", "1+", "(1+2", "1+2)", "2 3", "4 $ 5", "*3", "x y"]:
+            with self.assertRaises(ValueError):
+                evaluator.evaluate(test)
+        for test in ["sqrt 4", "sqrt", "sqrt()", "2***3", "(x)2"]:
+            with self.assertRaises(ValueError):
+                evaluator.evaluate(test, {"x": 1.0})
+
+    def test_extended_grammar(self) -> None:
+        for expression, expected in EXTENDED_EXPRESSIONS:
+            self.assertEqual(evaluator.evaluate(expression), expected, expression)
+        self.assertEqual(evaluator.evaluate("2x**2 + x y", {"x": 3, "y": 2}), 24)
+        for expression in ["(-8)**(1/3)", "sqrt(-1)", "log(0)", "10**400", "0**-1"]:
+            with self.assertRaises((ValueError, ArithmeticError)):
+                evaluator.evaluate(expression)
+        # exact powers stay exact, functions give floats
+        result = evaluator.evaluate("(2/3)**3", None, "fraction")
+        self.assertEqual(result, Fraction(8, 27))
+        self.assertEqual(evaluator.evaluate("sqrt(1/4)", None, "fraction"), 0.5)
+        with self.assertRaises(OverflowError):
+            evaluator.evaluate("10**100000", None, "fraction")
+        result = evaluator.evaluate("sqrt(2) + sin(1)", None, "decimal", 30)
+        with localcontext(prec=30):
+            self.assertEqual(result, Decimal(2).sqrt() + Decimal(math.sin(1)))
+        self.assertEqual(len(str(result)), 31)
+
+    def test_compiled_programs(self) -> None:
+        expressions = TEST_EXPRESSIONS + [e for e, _ in EXTENDED_EXPRESSIONS]
+        expressions += ["x * (y - 2) / -x", "None + variables * v0", "(1/0) + x"]
+        variables = {"x": 3, "y": 4, "None": 1, "variables": 2, "v0": 3}
+        for number in Calculator.NUMBERS:
+            for expression in expressions:
+                program = evaluator.compile_expression(expression, number)
+                interpreted = self.outcome(lambda: program.evaluate(variables, 10))
+                self.assertIsNone(program.function)
+                compiled = self.outcome(lambda: program.evaluate(variables, 10))
+                self.assertIsNotNone(program.function)
+                self.assertEqual(compiled, interpreted, (expression, number))
+
+    def test_compiled_deep_nesting(self) -> None:
+        program = evaluator.compile_expression("-(" * 2000 + "x" + ")" * 2000)
+        program.evaluate({"x": 1.0})
+        self.assertIsNone(program.function)
+        with unittest.mock.patch.object(evaluator.Program, "MAX_COMPILED_LENGTH", 4096):
+            for _ in range(2):
+                self.assertEqual(program.evaluate({"x": 1.0}), 1.0)
+        self.assertIsNotNone(program.function)
+
+    def test_packed_program(self) -> None:
+        for number in Calculator.NUMBERS:
+            for expression in TEST_EXPRESSIONS + ["2*x - sqrt(y)"]:
+                program = evaluator.compile_expression(expression, number)
+                code = list(evaluator.iter_instructions(expression, number))
+                self.assertEqual(program.code, code)
+        program = evaluator.compile_expression("2*x - sqrt(y) + 0.5")
+        self.assertEqual(list(program.floats), [2.0, 0.5])
+        self.assertEqual(program.names, ("x", "y"))
+        self.assertEqual(program.opcodes.itemsize, 1)
+        self.assertFalse(hasattr(program, "__dict__"))
+
+    @staticmethod
+    def outcome(func: callable) -> object:
+        try:
+            return func()
+        except (ValueError, ArithmeticError) as e:
+            return f"{type(e).__name__}: {e}"
+
+
+class ExactArithmeticTest(unittest.TestCase):
+    """Class to check evaluation with fractions and decimals."""
+
+    def test_fraction(self) -> None:
+        calculator = Calculator(number="fraction")
+        self.assertEqual(calculator.evaluate_expression("1/3*3"), 1)
+        self.assertEqual(calculator.evaluate_expression("0.1+0.2"), Fraction(3, 10))
+        self.assertEqual(calculator.run("1/3 - -1/6"), "1/2")
+        self.assertEqual(calculator.run("2e-3"), "1/500")
+
+    def test_decimal_precision(self) -> None:
+        calculator = Calculator(number="decimal")
+        self.assertEqual(calculator.evaluate_expression("0.1+0.2"), Decimal("0.3"))
+        self.assertEqual(calculator.run("1/3", precision=5), "0.33333")
+        self.assertEqual(calculator.run("2/3", precision=3), "0.667")
+        self.assertEqual(len(calculator.run("1/3")), 30)
+
+    def test_cached_per_number_type(self) -> None:
+        calculator = Calculator()
+        self.assertEqual(calculator.run("0.1+0.2"), str(0.1 + 0.2))
+        self.assertEqual(calculator.run("0.1+0.2", number="fraction"), "3/10")
+        self.assertEqual(calculator.cache.stats()["size"], 2)
+
+    def test_invalid_modes(self) -> None:
+        with self.assertRaises(ValueError):
+            Calculator(number="complex")
+        calculator = Calculator(engine="classic")
+        self.assertTrue(calculator.run("1/3", number="fraction").startswith("Error"))
+        self.assertTrue(Calculator(number="fraction").run("1/0").startswith("Error"))
+
+    def test_error_messages(self) -> None:
+        calculator = Calculator()
+        errors = {
+            ("1/0", "fraction"): "fraction division by zero",
+            ("1/0", "decimal"): "decimal division by zero",
+            ("0/0", "decimal"): "decimal division by zero",
+            ("sqrt(-1)", "decimal"): "Invalid decimal operation",
+            ("1e999999999*1e999999999", "decimal"): "Result is too large for a decimal",
+        }
+        for (expression, number), message in errors.items():
+            result = calculator.run(expression, number=number)
+            self.assertEqual(result, f"Error: {message}", expression)
+        results = calculator.run_many(["1/0", "1/2"], number="fraction")
+        self.assertEqual(results, ["Error: fraction division by zero", "1/2"])
+        # within the cost budget, but too many digits to convert to a string
+        message = "Error: Result is too large to display"
+        self.assertEqual(calculator.run("10**10000", number="fraction"), message)
+        results = calculator.run_many(["10**10000", "(10**10000)/3"], "fraction")
+        self.assertEqual(results, [message] * 2)
+
+    def test_protocol_options(self) -> None:
+        self.assertEqual(protocol.encode_options(), 0)
+        self.assertEqual(protocol.decode_options(0), {})
+        flags = protocol.encode_options("decimal", 50)
+        self.assertEqual(
+            protocol.decode_options(flags), {"number": "decimal", "precision": 50}
+        )
+        self.assertEqual(protocol.encode_options("decimal", 0), 2)
+        for precision in [-1, 1000]:
+            with self.assertRaisesRegex(ValueError, "or 0 for the default"):
+                protocol.encode_options("decimal", precision)
+
+    def test_stream(self) -> None:
+        results = stream.evaluate_stream(["1/3*3", "1/4"], number="fraction")
+        self.assertEqual(list(results), ["1", "1/4"])
+
+
+class BatchTest(unittest.TestCase):
+    """Class to check batches sharing common subexpressions."""
+
+    def test_matches_single(self) -> None:
+        calculator = Calculator()
+        expressions = [f"({e}) * 2 - ({e})" for e in TEST_EXPRESSIONS]
+        expressions += TEST_EXPRESSIONS
+        expected = [calculator.evaluate_expression(e) for e in expressions]
+        self.assertEqual(calculator.evaluate_many(expressions), expected)
+
+    def test_shared_subtrees(self) -> None:
+        shared = benchmarks.generate_expression(length=50, depth=2, seed=1)
+        expressions = [f"({shared}) * x + {i}" for i in range(100)]
+        batch = evaluator.compile_batch(expressions)
+        # one folded constant for the group, then x, the product and 100 sums
+        self.assertEqual(len(batch), 1 + 1 + 1 + 100 * 2)
+        batch = evaluator.compile_batch(["(x+1)*(1+x)", "(x + 1) * y", "x+1"])
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(batch.evaluate({"x": 2.0, "y": 3.0}), [9.0, 9.0, 3.0])
+
+    def test_constant_folding(self) -> None:
+        batch = evaluator.compile_batch(["2*(3+4)-1", "-0", "0", "x*(2/4)"])
+        self.assertEqual(batch.nodes[0], (evaluator.CONST, 13.0, None, None))
+        self.assertEqual(len(batch), 6)
+        self.assertEqual(batch.evaluate({"x": 3.0}), [13.0, -0.0, 0.0, 1.5])
+        self.assertEqual(str(batch.evaluate({"x": 1.0})[1]), "-0.0")
+
+    def test_errors_isolated(self) -> None:
+        calculator = Calculator()
+        results = calculator.run_many(["(1/0)+1", "2*(1/0)", "1+", "(2+2)", "y"])
+        self.assertTrue(all(r.startswith("Error") for r in results[:3]))
+        self.assertEqual(results[3], "4.0")
+        self.assertEqual(results[4], "Error: Undefined variable 'y'")
+        self.assertEqual(results[2], f"Error: {calculator.run('1+')[7:]}")
+
+    def test_extended_grammar(self) -> None:
+        expressions = [e for e, _ in EXTENDED_EXPRESSIONS]
+        self.assertEqual(
+            evaluator.compile_batch(expressions).evaluate(),
+            [expected for _, expected in EXTENDED_EXPRESSIONS],
+        )
+        expressions = ["sqrt(x+1)", "2(x+1)", "(x+1)**2", "sqrt(x)"]
+        batch = evaluator.compile_batch(expressions)
+        # x, 1, x+1, sqrt, 2, the product, the power and sqrt(x)
+        self.assertEqual(len(batch), 8)
+        self.assertEqual(batch.evaluate({"x": 3.0}), [2.0, 8.0, 16.0, math.sqrt(3)])
+        results = batch.evaluate({"x": -2.0})
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual(results[1:3], [-2.0, 1.0])
+
+    def test_group_prefix_not_a_node(self) -> None:
+        batch = evaluator.compile_batch(["(1+2)*x", "__group0 + 1"])
+        self.assertEqual(batch.evaluate({"x": 1.0, "__group0": 5.0}), [3.0, 6.0])
+
+    def test_number_types(self) -> None:
+        calculator = Calculator(number="fraction")
+        self.assertEqual(calculator.run_many(["(1/3)*3", "(1/3)+1"]), ["1", "4/3"])
+        calculator = Calculator(number="decimal")
+        results = calculator.run_many(["(1/3)*3", "1.0*2", "1*2"], precision=5)
+        self.assertEqual(results, ["0.99999", "2.0", "2"])
+
+    def test_mixed_constants(self) -> None:
+        # float results folded from exact literals equal to other literals
+        expressions = ["2", "4**0.5/3", "1", "-1**0.5", "sqrt(4)*3", "6/3"]
+        outputs = evaluator.compile_batch(expressions, "fraction").evaluate()
+        for expression, output in zip(expressions, outputs):
+            single = evaluator.evaluate(expression, number="fraction")
+            self.assertEqual(repr(output), repr(single), expression)
+        batch = evaluator.compile_batch(["10**10000/10**9999"], "fraction")
+        self.assertEqual(batch.evaluate(), [10])
+
+
+class IncrementalParserTest(unittest.TestCase):
+    """Class to check live re-evaluation of an expression as it is edited."""
+
+    @staticmethod
+    def outcome(func: callable) -> object:
+        try:
+            return func()
+        except (ValueError, ArithmeticError) as e:
+            return f"{type(e).__name__}: {e}"
+
+    def assertMatchesEvaluate(self, parser: evaluator.IncrementalParser) -> None:
+        self.assertEqual(
+            self.outcome(parser.result),
+            self.outcome(lambda: evaluator.evaluate(parser.text)),
+            parser.text,
+        )
+
+    def test_typing(self) -> None:
+        expressions = TEST_EXPRESSIONS + ["1.5e-3*2", "4 $ 5", "(1/0)+2", "sqrt 4"]
+        for expression in expressions + [e for e, _ in EXTENDED_EXPRESSIONS]:
+            parser = evaluator.IncrementalParser()
+            for end in range(len(expression) + 1):
+                parser.update(expression[:end])
+                self.assertLessEqual(parser.parsed, 3)
+                self.assertMatchesEvaluate(parser)
+
+    def test_edits(self) -> None:
+        parser = evaluator.IncrementalParser()
+        edits = ["12*3", "12*34", "12*3", "12+3", "2+3", "(2+3", "(2+3)*2", "1e+"]
+        for text in edits + ["1e+5", "1e+5-1", "1e+5 - 1", "x"]:
+            parser.update(text)
+            self.assertMatchesEvaluate(parser)
+        parser.update("1+2+3+4+5")
+        parser.update("1+2+3+4+5*2")
+        # the last number may have been extended, so it is parsed again
+        self.assertEqual(parser.parsed, 3)
+        self.assertEqual(parser.result(), 20.0)
+
+    def test_partial_exponent(self) -> None:
+        # the live result while typing an exponent matches the final error
+        parser = evaluator.IncrementalParser(variables={"e": 2.0})
+        for text in ["1e+", "1E-", "2*(1.5e+ "]:
+            parser.update(text)
+            self.assertMatchesEvaluate(parser)
+            with self.assertRaisesRegex(ValueError, "Incomplete expression"):
+                parser.result()
+            self.assertEqual(Calculator().run(text), "Error: Incomplete expression")
+        parser.update("1e")
+        self.assertEqual(parser.result(), 2.0)
+
+
+def fill_result_cache(path: str, start: int, count: int) -> int:
+    """Stores results from a separate process; returns the number stored."""
+    calculator = Calculator(result_cache=path)
+    for i in range(start, start + count):
+        calculator.run(f"{i} * 2")
+    return calculator.result_cache.stats()["misses"]
+
+
+class ResultCacheTest(unittest.TestCase):
+    """Class to check the persistent result cache shared by processes."""
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "results.cache")
+
+    def open_cache(self, **kwargs) -> ResultCache:
+        cache = ResultCache(self.path, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_survives_reopen(self) -> None:
+        cache = self.open_cache(slots=64)
+        self.assertIsNone(cache.get("a"))
+        self.assertTrue(cache.put("a", "1.0"))
+        cache.put("a", "2.0")
+        cache.close()
+        cache = self.open_cache(slots=1024)
+        self.assertEqual(cache.get("a"), "2.0")
+        # an existing file keeps its size
+        self.assertEqual((cache.slots, len(cache)), (64, 1))
+        self.assertFalse(cache.put("b" * 300, "1.0"))
+
+    def test_bounded_eviction(self) -> None:
+        cache = self.open_cache(slots=16, slot_size=64)
+        size = os.path.getsize(self.path)
+        for i in range(200):
+            cache.put(f"key {i}", str(i))
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(len(cache), 16)
+        self.assertEqual(cache.get("key 199"), "199")
+        kept = [i for i in range(200) if cache.get(f"key {i}") == str(i)]
+        self.assertEqual(len(kept), 16)
+
+    def test_torn_slot_is_a_miss(self) -> None:
+        cache = self.open_cache(slots=16)
+        cache.put("a", "1.0")
+        for slot in range(cache.slots):
+            offset = cache.offset(slot)
+            if cache.map[offset] == 2:
+                # as if a writer crashed mid-write
+                cache.map[offset] = 3
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", "1.0")
+        self.assertEqual(cache.get("a"), "1.0")
+
+    def test_threads_take_turns(self) -> None:
+        cache = self.open_cache(slots=4)
+        flock = fcntl.flock
+        holders = []
+        most = []
+
+        def slow_flock(file: object, operation: int) -> None:
+            flock(file, operation)
+            if operation == fcntl.LOCK_EX:
+                holders.append(threading.get_ident())
+                most.append(len(holders))
+                # long enough for another thread to try writing meanwhile
+                time.sleep(0.01)
+            else:
+                holders.pop()
+
+        def work(n: int) -> None:
+            for i in range(5):
+                cache.put(f"key {n} {i}", str(i))
+
+        with unittest.mock.patch.object(fcntl, "flock", slow_flock):
+            threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        # flock alone lets every thread of a process hold the lock at once
+        self.assertEqual(max(most), 1)
+        self.assertEqual(len(most), 20)
+
+    def test_shared_across_processes(self) -> None:
+        with multiprocessing.Pool(4) as pool:
+            args = [(self.path, i * 100, 100) for i in range(4)]
+            misses = pool.starmap(fill_result_cache, args)
+        self.assertEqual(sum(misses), 400)
+        cache = self.open_cache()
+        calculator = Calculator()
+        for i in range(400):
+            key = calculator.result_key(f"{i}  *  2")
+            self.assertEqual(cache.get(key), str(i * 2.0))
+
+    def test_calculator(self) -> None:
+        first = Calculator(result_cache=self.path)
+        self.assertEqual(first.run("1 + 2"), "3.0")
+        self.assertTrue(first.run("1/0").startswith("Error"))
+        self.assertEqual(first.run("1/3", number="fraction"), "1/3")
+        second = Calculator(result_cache=self.path)
+        self.assertEqual(second.run(" 1  + 2"), "3.0")
+        self.assertEqual(second.run("1/3"), str(1 / 3))
+        self.assertEqual(second.run("1/3", number="fraction"), "1/3")
+        self.assertEqual(second.result_cache.stats()["hits"], 2)
+        self.assertEqual(len(second.result_cache), 3)
+
+
+class StressTest(unittest.TestCase):
+    """Class to check huge inputs evaluate in linear time and bounded memory."""
+
+    @staticmethod
+    def flat_expression(tokens: int) -> str:
+        return "+".join(["2*3"] * (tokens // 4))
+
+    def test_million_tokens_linear(self) -> None:
+        timings = {}
+        for tokens in [10**5, 10**6]:
+            expression = self.flat_expression(tokens)
+            start = time.perf_counter()
+            self.assertEqual(evaluator.evaluate(expression), 6.0 * (tokens // 4))
+            timings[tokens] = time.perf_counter() - start
+        # 10x the tokens may not cost much more than 10x the time
+        self.assertLess(timings[10**6], timings[10**5] * 20)
+
+    def test_bounded_memory(self) -> None:
+        expression = self.flat_expression(2 * 10**5)
+        tracemalloc.start()
+        try:
+            evaluator.evaluate(expression)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, 64 * 1024)
+
+    def test_deep_nesting(self) -> None:
+        expression = "-(" * 100000 + "1" + ")" * 100000
+        self.assertEqual(evaluator.evaluate(expression), 1.0)
+        calculator = Calculator()
+        self.assertEqual(calculator.evaluate_expression(expression), 1.0)
+
+    def test_classic_without_recursion(self) -> None:
+        calculator = Calculator(engine="classic")
+        expression = "*".join(["1"] * 5000) + "-" + "/".join(["4"] + ["1"] * 4999)
+        self.assertEqual(calculator.evaluate_expression(expression), -3.0)
+
+
+class LimitsTest(unittest.TestCase):
+    """Class to check oversized or overly costly inputs are refused early."""
+
+    limits = evaluator.Limits(max_tokens=100, max_depth=10, max_cost=10**5)
+
+    def assertLimited(self, expression: str, number: str = "float") -> None:
+        with self.assertRaises(evaluator.LimitError):
+            evaluator.evaluate(expression, number=number, limits=self.limits)
+
+    def test_tokens_and_depth(self) -> None:
+        self.assertLimited("+".join(["1"] * 51))
+        self.assertLimited("(" * 11 + "1" + ")" * 11)
+        expression = "(" * 10 + "+".join(["1"] * 30) + ")" * 10
+        self.assertEqual(evaluator.evaluate(expression, limits=self.limits), 30.0)
+
+    def test_cost(self) -> None:
+        # each power multiplies the size of an exact number
+        bomb = "((3/7)**999)**999"
+        start = time.perf_counter()
+        self.assertLimited(bomb, "fraction")
+        self.assertLimited("(123/457)**9999", "fraction")
+        self.assertLess(time.perf_counter() - start, 1.0)
+        self.assertEqual(
+            evaluator.evaluate("(1/3)**4", number="fraction", limits=self.limits),
+            Fraction(1, 81),
+        )
+        # float instructions cost one each
+        self.assertEqual(evaluator.evaluate("2**99", limits=self.limits), 2.0**99)
+
+    def test_literal_exponent(self) -> None:
+        # refused before the literal is expanded into an exact fraction
+        start = time.perf_counter()
+        self.assertLimited("1e5000000", "fraction")
+        self.assertLimited("2*1E-5000000", "fraction")
+        self.assertLess(time.perf_counter() - start, 0.1)
+        result = evaluator.evaluate("1e300/1e299", number="fraction")
+        self.assertEqual(result, 10)
+        result = evaluator.evaluate("1e5000000", number="decimal")
+        self.assertEqual(result, Decimal("1e5000000"))
+
+    def test_batch(self) -> None:
+        expressions = ["1+2", "+".join(["1"] * 51), "(" * 11 + "1" + ")" * 11]
+        outputs = evaluator.compile_batch(expressions, limits=self.limits).evaluate()
+        self.assertEqual(outputs[0], 3.0)
+        self.assertIsInstance(outputs[1], evaluator.LimitError)
+        self.assertIsInstance(outputs[2], evaluator.LimitError)
+
+    def test_calculator(self) -> None:
+        calculator = Calculator(max_tokens=100, max_depth=10, max_cost=10**5)
+        self.assertEqual(calculator.run("1+2"), "3.0")
+        result = calculator.run("+".join(["1"] * 51))
+        self.assertEqual(result, "Error: Expression exceeds 100 tokens")
+        result = calculator.run("(123/457)**9999", number="fraction")
+        self.assertTrue(result.startswith("Error: Expression exceeds the cost"))
+
+
+class BlockingCalculator(Calculator):
+    """Calculator that waits on an event before evaluating the input "wait"."""
+
+    def __init__(self):
+        super(BlockingCalculator, self).__init__()
+        self.release = threading.Event()
+
+    def run(self, input: str, **kwargs) -> str:
+        if input == "wait":
+            self.release.wait(10)
+            input = "1"
+        return super(BlockingCalculator, self).run(input, **kwargs)
+
+
+class AsyncServerTest(unittest.TestCase):
+    """Class to check the concurrent server with real socket clients."""
+
+    def setUp(self) -> None:
+        self.registry = metrics.Registry()
+        self.server = AsyncServer(port=0, host="127.0.0.1", registry=self.registry)
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.server.start(Calculator()))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.addCleanup(self.stop_server)
+
+    def stop_server(self) -> None:
+        stopped = asyncio.run_coroutine_threadsafe(self.server.stop(), self.loop)
+        stopped.result(timeout=5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.server.executor.shutdown()
+
+    def connect(self) -> Client:
+        client = Client(ip="127.0.0.1", port=self.server.port)
+        self.assertTrue(client.connect_to_host())
+        self.addCleanup(client.close_connection)
+        return client
+
+    def test_concurrent_clients(self) -> None:
+        first = self.connect()
+        second = self.connect()
+        # second client is served while the first connection stays open
+        self.assertEqual(second.send_to_server("1+2"), "3.0")
+        self.assertEqual(first.send_to_server("2*3"), "6.0")
+        self.assertEqual(first.send_to_server("8/-4"), "-2.0")
+        self.assertTrue(second.send_to_server("1/0").startswith("Error"))
+
+    def test_pipelining(self) -> None:
+        client = self.connect()
+        messages = [f"{i}*2" for i in range(200)]
+        results = client.send_many(messages)
+        self.assertEqual(results, [str(i * 2.0) for i in range(200)])
+
+    def test_out_of_order_responses(self) -> None:
+        client = self.connect()
+        first, second = client.submit_many(["1+1", "2+2"])
+        self.assertEqual(client.receive(second).payload, b"4.0")
+        frame = client.receive(first)
+        self.assertEqual((frame.payload, frame.flags), (b"2.0", protocol.STATUS_OK))
+        frame = client.receive(client.submit("1/0"))
+        self.assertEqual(frame.flags, protocol.STATUS_ERROR)
+
+    def test_metrics(self) -> None:
+        client = self.connect()
+        client.send_many(["1+1", "1/0", "2*2"])
+        self.assertEqual(self.server.requests_total.value, 3)
+        self.assertEqual(self.server.errors_total.value, 1)
+        self.assertEqual(self.server.request_latency.count, 3)
+        self.assertIn("server_connections 1", self.registry.render())
+
+    def test_long_expression(self) -> None:
+        client = self.connect()
+        expression = "+".join(["1"] * 100000)
+        self.assertEqual(client.send_to_server(expression), "100000.0")
+
+    def test_number_modes(self) -> None:
+        client = self.connect()
+        self.assertEqual(client.send_to_server("1/3*3", "fraction"), "1")
+        self.assertEqual(client.send_to_server("1/3", "decimal", 4), "0.3333")
+        results = client.send_many(["0.1+0.2", "1/8"], "fraction")
+        self.assertEqual(results, ["3/10", "1/8"])
+        self.assertEqual(client.send_to_server("1/8"), "0.125")
+
+    def test_binary_results(self) -> None:
+        client = self.connect()
+        frame = client.receive(client.submit("1/3", protocol.FLAG_BINARY))
+        self.assertEqual(frame.payload, protocol.DOUBLE.pack(1 / 3))
+        self.assertEqual(client.evaluate("1/3"), (protocol.STATUS_OK, 1 / 3))
+        result = client.evaluate("1/0")
+        self.assertFalse(result.ok)
+        self.assertEqual(result.value, "Error: float division by zero")
+        # exact number types are answered in text
+        result = client.evaluate("1/3", "fraction")
+        self.assertEqual(result, (protocol.STATUS_OK, "1/3"))
+
+    def test_batch(self) -> None:
+        client = self.connect()
+        messages = ["1+2", "1/0", "0.1+0.2", "2*(3"]
+        frame = client.request_batch(messages)
+        self.assertEqual(frame.flags & protocol.STATUS_MASK, protocol.STATUS_ERROR)
+        results = protocol.decode_results(frame)
+        self.assertEqual([r.status for r in results], [0, 1, 0, 1])
+        self.assertEqual([results[0].value, results[2].value], [3.0, 0.1 + 0.2])
+        self.assertTrue(all(r.value.startswith("Error") for r in results[1::2]))
+        text = protocol.decode_results(client.request_batch(messages, binary=False))
+        self.assertEqual(text[0], (protocol.STATUS_OK, "3.0"))
+        self.assertEqual([r.status for r in text], [0, 1, 0, 1])
+        results = client.evaluate_many(["1/3", "1/0"], "fraction")
+        self.assertEqual(results[0].value, "1/3")
+        self.assertEqual(client.evaluate_many([]), [])
+        # one request for the whole batch
+        self.assertEqual(self.server.requests_total.value, 4)
+
+    def test_oversized_response(self) -> None:
+        client = self.connect()
+        client.socket.settimeout(5)
+        messages = ["1/3"] * 200
+        with unittest.mock.patch.object(protocol, "MAX_PAYLOAD", 1000):
+            # the request fits, but its text results do not
+            frame = client.request_batch(messages, "fraction")
+            self.assertEqual(frame.flags, protocol.STATUS_ERROR)
+            self.assertTrue(frame.payload.startswith(b"Error: Response of"))
+            self.assertEqual(client.send_to_server("1+1"), "2.0")
+        self.assertEqual(self.server.errors_total.value, 1)
+
+    @unittest.skipIf(np is None, "requires numpy")
+    def test_batch_arrays(self) -> None:
+        client = self.connect()
+        values, statuses = client.evaluate_array([f"{i}/4" for i in range(1000)])
+        np.testing.assert_array_equal(values, np.arange(1000) / 4)
+        self.assertFalse(statuses.any())
+        values, statuses = client.evaluate_array(["1", "1/0"])
+        self.assertTrue(np.isnan(values[1]))
+        self.assertEqual(list(statuses), [0, 1])
+
+    def test_overloaded(self) -> None:
+        calculator = BlockingCalculator()
+        self.server.class_inst = calculator
+        self.server.max_pending = 2
+        self.addCleanup(calculator.release.set)
+        client = self.connect()
+        # an idle server takes a batch of any size
+        results = client.evaluate_many([f"{i}" for i in range(3)])
+        self.assertTrue(all(r.ok for r in results))
+        waiting = client.submit("wait")
+        while not self.server.pending:
+            time.sleep(0.01)
+        results = client.evaluate_many(["1", "2"])
+        self.assertEqual([r.status for r in results], [protocol.STATUS_OVERLOADED] * 2)
+        self.assertEqual(client.evaluate("1+1").status, protocol.STATUS_OK)
+        self.assertEqual(self.server.rejected_total.value, 1)
+        calculator.release.set()
+        self.assertEqual(client.receive(waiting).payload, b"1.0")
+
+    def test_backpressure(self) -> None:
+        self.server.max_inflight = 1
+        client = self.connect()
+        messages = [f"{i}+1" for i in range(100)]
+        self.assertEqual(client.send_many(messages), [f"{i + 1.0}" for i in range(100)])
+
+
+def start_server(test: unittest.TestCase, port: int = 0) -> AsyncServer:
+    """
+    Starts an AsyncServer on a background event loop for the duration of a test.
+    Call server.shutdown() to stop it early, e.g. to simulate a crash.
+    """
+    registry = metrics.Registry()
+    server = AsyncServer(port=port, host="127.0.0.1", registry=registry)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start(Calculator()))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop() -> None:
+        if loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        server.executor.shutdown()
+
+    server.shutdown = stop
+    test.addCleanup(stop)
+    return server
+
+
+class ClientPoolTest(unittest.TestCase):
+    """Class to check pooled connections across several servers."""
+
+    def start_server(self, port: int = 0) -> AsyncServer:
+        return start_server(self, port)
+
+    def create_pool(self, servers: list[AsyncServer], **kwargs) -> ClientPool:
+        pool = ClientPool([("127.0.0.1", s.port) for s in servers], **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def wait_for_connections(self, server: AsyncServer, count: int) -> None:
+        """Waits for the server to handle the connections before it is stopped."""
+        deadline = time.monotonic() + 5
+        while len(server.connections) < count:
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            time.sleep(0.01)
+
+    def test_spreads_across_servers(self) -> None:
+        servers = [self.start_server() for _ in range(2)]
+        pool = self.create_pool(servers, size=2)
+        self.assertEqual(pool.connect(), 4)
+        for i in range(10):
+            self.assertEqual(pool.send_to_server(f"{i}+1"), str(i + 1.0))
+        self.assertEqual([s.requests_total.value for s in servers], [5, 5])
+        self.assertEqual(pool.count, 4)
+
+    def test_send_many(self) -> None:
+        servers = [self.start_server() for _ in range(2)]
+        pool = self.create_pool(servers, size=2)
+        messages = [f"{i}*2" for i in range(101)]
+        self.assertEqual(pool.send_many(messages), [str(i * 2.0) for i in range(101)])
+        self.assertEqual(sum(s.requests_total.value for s in servers), 101)
+        self.assertTrue(all(s.requests_total.value for s in servers))
+        self.assertEqual(pool.send_many(["1/3"], "fraction"), ["1/3"])
+        self.assertEqual(pool.evaluate("1/4").value, 0.25)
+        self.assertEqual([r.value for r in pool.evaluate_many(["1", "2"])], [1.0, 2.0])
+
+    def test_threads_share_pool(self) -> None:
+        pool = self.create_pool([self.start_server()], size=3)
+        results = {}
+
+        def work(n: int) -> None:
+            results[n] = [pool.send_to_server(f"{n}*{i}") for i in range(50)]
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(6):
+            self.assertEqual(results[n], [str(n * i * 1.0) for i in range(50)])
+        self.assertLessEqual(pool.count, 3)
+
+    def test_errors_free_connection(self) -> None:
+        pool = self.create_pool([self.start_server()], size=1, timeout=5)
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                pool.send_to_server("1", "bogus")
+            with self.assertRaises(ValueError):
+                pool.send_many(["1", "2"], "float", 999)
+        self.assertEqual(pool.count, 0)
+        self.assertEqual(pool.send_to_server("1+1"), "2.0")
+
+        def interrupt(client: Client) -> None:
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            pool.request(interrupt)
+        self.assertEqual(pool.send_many(["3+3", "4+4"]), ["6.0", "8.0"])
+
+    def test_reconnects_after_restart(self) -> None:
+        server = self.start_server()
+        pool = self.create_pool([server], size=2)
+        pool.connect()
+        self.assertEqual(pool.send_to_server("1+1"), "2.0")
+        self.wait_for_connections(server, 2)
+        server.shutdown()
+        server = self.start_server(server.port)
+        self.assertEqual(pool.send_to_server("2+2"), "4.0")
+        self.assertEqual(pool.send_many(["3+3", "4+4"]), ["6.0", "8.0"])
+
+    def test_fails_over_to_live_server(self) -> None:
+        alive, dead = self.start_server(), self.start_server()
+        pool = self.create_pool([dead, alive], size=1)
+        pool.connect()
+        self.wait_for_connections(dead, 1)
+        dead.shutdown()
+        for i in range(4):
+            self.assertEqual(pool.send_to_server(f"{i}-1"), str(i - 1.0))
+        pool = self.create_pool([dead])
+        with self.assertRaises(ConnectionError):
+            pool.send_to_server("1+1")
+
+
+class ShardedClientTest(unittest.TestCase):
+    """Class to check load balancing across several local servers."""
+
+    def setUp(self) -> None:
+        self.servers = [start_server(self) for _ in range(3)]
+
+    def create_client(self, **kwargs) -> ShardedClient:
+        endpoints = [("127.0.0.1", server.port) for server in self.servers]
+        client = ShardedClient(endpoints, health_interval=0, **kwargs)
+        self.addCleanup(client.close)
+        self.assertEqual(client.connect(), 3)
+        return client
+
+    def request_counts(self) -> list[int]:
+        return [server.requests_total.value for server in self.servers]
+
+    def test_hash_routes_repeats_to_one_node(self) -> None:
+        client = self.create_client()
+        for _ in range(5):
+            self.assertEqual(client.send_to_server("6 * 7"), "42.0")
+        # same cache key on the server, so the same node
+        self.assertEqual(client.send_to_server(" 6  *  7"), "42.0")
+        self.assertEqual(sorted(self.request_counts()), [0, 0, 6])
+
+        messages = [f"{i}+1" for i in range(300)]
+        self.assertEqual(client.send_many(messages), [str(i + 1.0) for i in range(300)])
+        # every node takes a fair share of distinct expressions
+        self.assertTrue(all(count > 50 for count in self.request_counts()))
+
+    def test_least_outstanding_spreads(self) -> None:
+        client = self.create_client(strategy="least")
+        messages = [f"{i}*2" for i in range(90)]
+        self.assertEqual(client.send_many(messages), [str(i * 2.0) for i in range(90)])
+        self.assertEqual(self.request_counts(), [30, 30, 30])
+        for i in range(6):
+            client.send_to_server("1+1")
+        self.assertEqual(sum(self.request_counts()), 96)
+
+    def test_ejects_dead_node(self) -> None:
+        client = self.create_client()
+        messages = [f"{i}-1" for i in range(60)]
+        self.servers[1].shutdown()
+        self.assertEqual(client.send_many(messages), [str(i - 1.0) for i in range(60)])
+        for i, message in enumerate(messages):
+            self.assertEqual(client.send_to_server(message), str(i - 1.0))
+        self.assertEqual([node.healthy for node in client.nodes], [True, False, True])
+
+        client.check_health()
+        self.assertFalse(client.nodes[1].healthy)
+        self.servers[1] = start_server(self, self.servers[1].port)
+        client.check_health()
+        self.assertTrue(client.nodes[1].healthy)
+        client.send_many(messages)
+        self.assertGreater(self.servers[1].requests_total.value, 0)
+
+    def test_parse_endpoints(self) -> None:
+        self.assertEqual(
+            parse_endpoints("10.0.0.1:8001, 10.0.0.2"),
+            [("10.0.0.1", 8001), ("10.0.0.2", 8000)],
+        )
+
+
+@unittest.skipIf(calculator_ui is None, "requires PySide6")
+class CalculatorUITest(unittest.TestCase):
+    """Class to check the GUI's background server requests, without a display."""
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        cls.app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    def create_ui(self, port: int) -> "calculator_ui.CalculatorUI":
+        ui = calculator_ui.CalculatorUI(ip="127.0.0.1", port=port)
+        self.addCleanup(ui.close)
+        self.wait_until(lambda: ui.use_server)
+        return ui
+
+    def wait_until(self, condition: callable, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            self.app.processEvents()
+            time.sleep(0.01)
+
+    def silent_server(self) -> int:
+        """Gets the port of a server that accepts connections but never replies."""
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen()
+        return sock.getsockname()[1]
+
+    def test_timeout_falls_back_to_local(self) -> None:
+        ui = self.create_ui(self.silent_server())
+        ui.input_string = "1+2"
+        start = time.monotonic()
+        ui.equal_button_clicked()
+        self.assertIsNotNone(ui.pending_request)
+        self.wait_until(lambda: ui.result_lineedit.text() == "3.0")
+        # answered after the latency threshold, well before the request timeout;
+        # coarse timers may fire up to 5% early
+        elapsed = time.monotonic() - start
+        self.assertGreaterEqual(elapsed, 0.95 * ui.LATENCY_THRESHOLD_MS / 1000)
+        self.assertLess(elapsed, ui.REQUEST_TIMEOUT)
+        self.assertIsNone(ui.pending_request)
+
+    def test_stale_result_dropped(self) -> None:
+        server = start_server(self)
+        ui = self.create_ui(server.port)
+        shown = []
+        ui.show_result = lambda result, ok, live: shown.append(result)
+        ui.input_string = "1+1"
+        ui.equal_button_clicked()
+        # the first reply arrives, unprocessed, before the newer input is sent
+        self.wait_until(lambda: server.requests_total.value == 1)
+        time.sleep(0.1)
+        ui.input_string = "2+2"
+        with self.assertLogs(calculator_ui.LOG, logging.DEBUG) as logs:
+            ui.equal_button_clicked()
+            self.wait_until(lambda: shown)
+            # leave time for any other reply to be shown
+            for _ in range(20):
+                self.app.processEvents()
+                time.sleep(0.01)
+        self.assertEqual(shown, ["4.0"])
+        self.assertTrue(any("Dropped reply" in line for line in logs.output))
+
+    def test_close_stops_worker(self) -> None:
+        ui = self.create_ui(self.silent_server())
+        remote = ui.remote
+        ui.input_string = "1+2"
+        ui.equal_button_clicked()
+        # the worker is now blocked waiting on a reply that never comes
+        time.sleep(0.1)
+        start = time.monotonic()
+        ui.close()
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertTrue(remote.thread.isFinished())
+        self.assertIsNone(remote.client)
+
+
+class MetricsTest(unittest.TestCase):
+    """Class to check instrumentation and Prometheus output."""
+
+    def test_calculator_phases(self) -> None:
+        registry = metrics.Registry()
+        calculator = Calculator(metrics=registry)
+        self.assertEqual(calculator.run("1+2"), "3.0")
+        self.assertEqual(calculator.run("1+2"), "3.0")
+        self.assertTrue(calculator.run("1+").startswith("Error"))
+        for phase, count in [("parse", 2), ("evaluate", 2), ("serialize", 2)]:
+            self.assertEqual(calculator.phase_timings[phase].count, count)
+        output = registry.render()
+        self.assertIn("# TYPE calculator_phase_seconds histogram", output)
+        self.assertIn('calculator_phase_seconds_count{phase="parse"} 2', output)
+        self.assertIn("calculator_cache_hits 1", output)
+
+    def test_histogram_buckets(self) -> None:
+        registry = metrics.Registry()
+        histogram = registry.histogram("latency", "Latency.", buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            histogram.observe(value)
+        lines = histogram.render("latency")
+        self.assertEqual(
+            lines,
+            [
+                'latency_bucket{le="0.1"} 2',
+                'latency_bucket{le="1.0"} 3',
+                'latency_bucket{le="+Inf"} 4',
+                "latency_sum 2.65",
+                "latency_count 4",
+            ],
+        )
+
+    def test_endpoint(self) -> None:
+        registry = metrics.Registry()
+        registry.counter("requests_total", "Requests.").inc(5)
+        server = metrics.serve(registry, port=0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            body = response.read().decode()
+        self.assertIn("requests_total 5", body)
+
+
+class ProfilerTest(unittest.TestCase):
+    """Class to check sampled profiling of calculator runs."""
+
+    def setUp(self) -> None:
+        self.profiler = Profiler(rate=3)
+        self.calculator = Calculator(profiler=self.profiler)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_sampling(self) -> None:
+        for i in range(9):
+            self.calculator.run(f"{i}*2+1")
+        self.assertEqual((self.profiler.samples, self.profiler.calls), (3, 9))
+        self.assertIn("evaluate_expression", self.profiler.report())
+        self.profiler.configure(enabled=False)
+        self.calculator.run("1+1")
+        self.assertEqual(self.profiler.samples, 3)
+        self.profiler.configure(enabled=True, rate=1)
+        self.assertEqual(self.calculator.run("1/0"), "Error: float division by zero")
+        self.assertEqual(self.profiler.samples, 4)
+        self.profiler.reset()
+        self.assertEqual(self.profiler.samples, 0)
+
+    def test_memory(self) -> None:
+        profiler = Profiler(rate=1, cpu=False, memory=True)
+        calculator = Calculator(profiler=profiler)
+        calculator.run("+".join(["1"] * 100))
+        self.assertGreater(profiler.peak, 0)
+        self.assertTrue(any("evaluator.py" in key for key in profiler.allocations))
+        self.assertIn("Peak traced memory", profiler.report())
+        self.assertFalse(tracemalloc.is_tracing())
+
+    def test_dump_formats(self) -> None:
+        with self.assertRaises(ValueError):
+            self.profiler.dump(os.path.join(self.directory.name, "empty.prof"))
+        self.profiler.configure(rate=1)
+        self.calculator.run("(1+2)*3")
+        path = os.path.join(self.directory.name, "profile")
+        self.profiler.dump(path + ".prof", "pstats")
+        stats = pstats.Stats(path + ".prof")
+        self.assertTrue(any(key[2] == "evaluate_expression" for key in stats.stats))
+        self.profiler.dump(path + ".folded", "collapsed")
+        with open(path + ".folded") as f:
+            lines = f.read().splitlines()
+        self.assertTrue(all(line.rsplit(" ", 1)[1].isdigit() for line in lines))
+        self.assertTrue(any("calculator.py" in line for line in lines))
+
+    @unittest.skipUnless(hasattr(signal, "SIGUSR1"), "requires SIGUSR1")
+    def test_signals(self) -> None:
+        for signum in [signal.SIGUSR1, signal.SIGUSR2]:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+        prefix = os.path.join(self.directory.name, "server_profile")
+        self.profiler.install_signals(prefix)
+        self.profiler.configure(rate=1)
+        self.calculator.run("1+2")
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertFalse(self.profiler.enabled)
+        os.kill(os.getpid(), signal.SIGUSR1)
+        deadline = time.monotonic() + 5
+        while not os.path.exists(prefix + ".folded") and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        with open(prefix + ".txt") as f:
+            self.assertTrue(f.read().startswith("Profiled 1 of 1 calls"))
+        self.assertTrue(os.path.exists(prefix + ".prof"))
+
+    def test_admin_route(self) -> None:
+        server = metrics.serve(
+            metrics.Registry(), port=0, routes={"/profile": self.profiler.handle_admin}
+        )
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_port}/profile"
+        with urllib.request.urlopen(url + "?rate=0") as response:
+            self.assertIn("(1 in 3, off)", response.read().decode())
+        self.assertFalse(self.profiler.enabled)
+        with urllib.request.urlopen(url + "?rate=5&reset=1") as response:
+            self.assertIn("(1 in 5, on)", response.read().decode())
+        with self.assertRaises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "?rate=x")
+
+    def test_cli_profile(self) -> None:
+        script = str(Path(__file__).resolve().parent / "calculate")
+        cwd = self.directory.name
+        with open(os.path.join(cwd, "input.txt"), "w") as f:
+            f.write("1+2\n3*4\n")
+        command = [sys.executable, script, "-f", "input.txt", "-o", "out.txt"]
+        command += ["--profile", "out.folded", "--profile-format", "collapsed"]
+        subprocess.run(command, cwd=cwd, capture_output=True, check=True)
+        with open(os.path.join(cwd, "out.folded")) as f:
+            self.assertIn("run_file", f.read())
+
+
+class LoggerTest(unittest.TestCase):
+    """Class to check the queued, sampled logging pipeline."""
+
+    def setUp(self) -> None:
+        root_logger = logging.getLogger("")
+        handlers, level = list(root_logger.handlers), root_logger.level
+        calculator_level = logging.getLogger("calculator").level
+
+        def restore() -> None:
+            root_logger.handlers = handlers
+            root_logger.setLevel(level)
+            logging.getLogger("calculator").setLevel(calculator_level)
+
+        self.addCleanup(restore)
+        logging.getLogger("").handlers = []
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.log_dir.cleanup)
+        self.log_file = os.path.join(self.log_dir.name, "log.txt")
+
+    def read_log(self) -> list[str]:
+        with open(self.log_file, "r") as f:
+            return f.read().splitlines()
+
+    def test_queued_records(self) -> None:
+        listener = logger.create_logger(self.log_file, console=False)
+        expr_list = ["1", "+", "2"]
+        logging.getLogger("calculator").debug("Sub-equation: %s", expr_list)
+        # mutating after logging must not change the queued record
+        expr_list.append("changed")
+        logger.stop_listener(listener)
+        lines = self.read_log()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("Sub-equation: ['1', '+', '2']"))
+
+    def test_sampling_and_module_levels(self) -> None:
+        listener = logger.create_logger(
+            self.log_file,
+            console=False,
+            module_levels={"calculator": logging.WARNING},
+            sample_rate=10,
+        )
+        for i in range(100):
+            logging.getLogger("server").info("request %d", i)
+        logging.getLogger("server").error("failed")
+        logging.getLogger("calculator").info("hidden")
+        logger.stop_listener(listener)
+        lines = self.read_log()
+        self.assertEqual(len(lines), 11)
+        self.assertTrue(lines[-1].endswith("failed"))
+
+    def test_parse_module_levels(self) -> None:
+        levels = logger.parse_module_levels(["calculator=warning", "server=DEBUG"])
+        self.assertEqual(levels, {"calculator": 30, "server": 10})
+        with self.assertRaises(ValueError):
+            logger.parse_module_levels(["calculator"])
+
+
+class SlowCalculator(Calculator):
+    """Calculator that never finishes on the input "slow"."""
+
+    def run(self, input: str) -> str:
+        if input == "slow":
+            time.sleep(60)
+        return super(SlowCalculator, self).run(input)
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """Class to check evaluation in worker processes."""
+
+    def setUp(self) -> None:
+        self.pool = WorkerPool(SlowCalculator, processes=2, timeout=0.5)
+        self.pool.start()
+        self.addCleanup(self.pool.close)
+
+    def run_all(self, messages: list[str]) -> list[str]:
+        async def gather() -> list[str]:
+            return await asyncio.gather(*(self.pool.run(m) for m in messages))
+
+        return asyncio.run(gather())
+
+    def test_batches(self) -> None:
+        messages = [f"{i}+1" for i in range(100)]
+        self.assertEqual(self.run_all(messages), [str(i + 1.0) for i in range(100)])
+
+    def test_timeout_kills_runaway(self) -> None:
+        results = self.run_all(["1+1", "slow", "2*3"])
+        self.assertEqual(results[0], "2.0")
+        self.assertTrue(results[1].startswith("Error: Evaluation timed out"))
+        self.assertEqual(results[2], "6.0")
+        # pool keeps working after the restart
+        self.assertEqual(self.run_all(["3-1"]), ["2.0"])
+
+
+class StreamTest(unittest.TestCase):
+    """Class to check bulk evaluation of newline-delimited expressions."""
+
+    def test_text_lines(self) -> None:
+        source = io.StringIO("1+2\n\n2*3\n1/0\n")
+        output = io.StringIO()
+        self.assertEqual(stream.run_stream(source, output), 3)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[:2], ["3.0", "6.0"])
+        self.assertTrue(lines[2].startswith("Error"))
+
+    def test_jsonl(self) -> None:
+        records = [{"id": 1, "input": "7/2"}, {"id": 2, "input": "-4--5"}]
+        source = io.StringIO("".join(json.dumps(r) + "\n" for r in records))
+        output = io.StringIO()
+        stream.run_stream(source, output, jsonl=True)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(results[0], {"id": 1, "input": "7/2", "result": "3.5"})
+        self.assertEqual(results[1]["result"], "1.0")
+
+    def test_invalid_jsonl_line(self) -> None:
+        lines = ['{"input": "1+2"}', '{"input": "2*', '"3*4"']
+        source = io.StringIO("\n".join(lines) + "\n")
+        output = io.StringIO()
+        self.assertEqual(stream.run_stream(source, output, jsonl=True), 3)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(results[0]["result"], "3.0")
+        self.assertEqual(results[1]["input"], '{"input": "2*')
+        self.assertTrue(results[1]["result"].startswith("Error: Invalid JSON"))
+        self.assertEqual(results[2], {"input": "3*4", "result": "12.0"})
+
+    def test_workers_keep_order(self) -> None:
+        expressions = [f"{i}*3" for i in range(2000)]
+        results = stream.evaluate_stream(expressions, processes=2, chunk_size=64)
+        self.assertEqual(list(results), [str(i * 3.0) for i in range(2000)])
+
+
+class StartupTest(unittest.TestCase):
+    """Class to check cold-start time and imports of the entry points."""
+
+    PACKAGE_DIR = Path(__file__).resolve().parent
+    HEAVY_MODULES = ["PySide6", "sympy", "numpy"]
+    BUDGET = float(os.environ.get("CALCULATOR_STARTUP_BUDGET", 0.5))
+
+    def run_python(self, *args: str) -> subprocess.CompletedProcess:
+        # run from a temp dir so the CLI log file is not written into the repo
+        with tempfile.TemporaryDirectory() as cwd:
+            return subprocess.run(
+                [sys.executable, *args],
+                cwd=cwd,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+
+    def test_cli_cold_start_budget(self) -> None:
+        script = str(self.PACKAGE_DIR / "calculate")
+        timings = []
+        for _ in range(3):
+            start = time.perf_counter()
+            self.run_python(script, "-i", "1+2")
+            timings.append(time.perf_counter() - start)
+        self.assertLess(min(timings), self.BUDGET)
+
+    def test_no_heavy_imports(self) -> None:
+        check = (
+            "import runpy, sys\n"
+            f"sys.path.insert(0, {str(self.PACKAGE_DIR)!r})\n"
+            "sys.argv = ['calculate', '-i', '1+2']\n"
+            f"runpy.run_path({str(self.PACKAGE_DIR / 'calculate')!r}, "
+            "run_name='__main__')\n"
+            "import server\n"
+            f"print([m for m in {self.HEAVY_MODULES!r} if m in sys.modules])"
+        )
+        output = self.run_python("-c", check).stdout.strip().splitlines()
+        self.assertEqual(output[-1], "[]")
+
+
+class FuzzTest(unittest.TestCase):
+    """Class to check the differential fuzzing harness."""
+
+    def test_engines_agree(self) -> None:
+        # the classic engine has known divergences, checked below
+        engines = [name for name in fuzz.DEFAULT_ENGINES if name != "classic"]
+        divergences = fuzz.fuzz(count=300, engines=engines, processes=1, max_depth=8)
+        self.assertEqual(divergences, [])
+
+    def test_grammar_coverage(self) -> None:
+        expressions = [fuzz.random_expression(0, i, 20, 4) for i in range(300)]
+        text = "\n".join(expressions)
+        for fragment in ["-(", "**", "sqrt(", "log(", " * ", "/"]:
+            self.assertIn(fragment, text)
+        # implicit multiplication
+        self.assertRegex(text, r"[\d)](\(|[a-z])")
+        # half stay within the classic engine's grammar
+        basic = [e for e in expressions if not fuzz.EXTENDED_REGEX.search(e)]
+        self.assertGreater(len(basic), 100)
+        numbers = {fuzz.random_number(0, i, fuzz.NUMBERS) for i in range(30)}
+        self.assertEqual(numbers, set(fuzz.NUMBERS))
+
+    def test_finds_classic_divergence(self) -> None:
+        # the classic engine mishandles a leading sign before a group or another
+        # sign, e.g. -(1+2) gives 3.0 and --1 fails
+        divergences = fuzz.fuzz(
+            count=200, engines=["precedence", "classic"], processes=1, max_failures=1
+        )
+        self.assertEqual(len(divergences), 1)
+        self.assertEqual(divergences[0].number, "float")
+        self.assertIn("-", divergences[0].shrunk)
+
+    def test_deterministic(self) -> None:
+        first = fuzz.random_expression(seed=3, index=7, max_length=20, max_depth=4)
+        second = fuzz.random_expression(seed=3, index=7, max_length=20, max_depth=4)
+        self.assertEqual(first, second)
+
+    def test_ulp_distance(self) -> None:
+        self.assertEqual(fuzz.ulp_distance(1.0, math.nextafter(1.0, 2.0)), 1)
+        self.assertEqual(fuzz.ulp_distance(-0.0, 0.0), 0)
+        self.assertEqual(fuzz.ulp_distance(math.nextafter(0.0, -1.0), 5e-324), 2)
+        self.assertFalse(fuzz.diverges(0.1 + 0.2, 0.3))
+        self.assertTrue(fuzz.diverges(1.0, 1.001))
+        self.assertTrue(fuzz.diverges(1.0, "Error: ZeroDivisionError"))
+        self.assertFalse(fuzz.diverges("Error: a", "Error: b"))
+        # exact results must match exactly, in type as well as value
+        self.assertTrue(fuzz.diverges(Fraction(2, 3), 2 / 3))
+        self.assertTrue(fuzz.diverges(Fraction(1, 3), Fraction(1, 3) + 10**-30))
+        self.assertTrue(fuzz.diverges(Decimal("1"), Decimal("1.0")))
+        self.assertFalse(fuzz.diverges(Decimal("0.5"), Decimal("0.5")))
+        self.assertFalse(fuzz.diverges(fuzz.SKIPPED, 1.0))
+
+    def test_shrinks_divergence(self) -> None:
+        def buggy(expressions: list[str], number: str) -> list:
+            # mishandles every 7 in its input
+            expressions = [e.replace("7", "8") for e in expressions]
+            return fuzz.run_precedence(expressions, number)
+
+        with unittest.mock.patch.dict(fuzz.ENGINES, {"buggy": buggy}):
+            divergences = fuzz.fuzz(
+                count=50, engines=["precedence", "buggy"], processes=1, max_failures=1
+            )
+        self.assertEqual(len(divergences), 1)
+        self.assertIn("7", divergences[0].expression)
+        self.assertEqual(divergences[0].shrunk, "7")
+
+
+class BenchmarkTest(unittest.TestCase):
+    """Class to check the benchmark expression generator and comparison."""
+
+    def test_generator_is_deterministic(self) -> None:
+        first = benchmarks.generate_expression(length=50, depth=3, seed=7)
+        second = benchmarks.generate_expression(length=50, depth=3, seed=7)
+        self.assertEqual(first, second)
+        self.assertEqual(len(evaluator.tokenize(first)) - first.count("(") * 2, 99)
+
+    def test_generator_depth(self) -> None:
+        expression = benchmarks.generate_expression(length=64, depth=4, seed=1)
+        depth = max_depth = 0
+        for char in expression:
+            depth += {"(": 1, ")": -1}.get(char, 0)
+            max_depth = max(max_depth, depth)
+        self.assertEqual(max_depth, 4)
+        expression = benchmarks.generate_expression(length=30, operators="*", seed=2)
+        self.assertNotIn("+", expression)
+        self.assertNotIn("(", expression)
+
+    def test_memory_suite(self) -> None:
+        results = benchmarks.bench_memory(quick=True)
+        for name in ["short", "medium"]:
+            tuples = results[f"memory.tuples.{name}"]
+            self.assertLess(results[f"memory.program.{name}"], tuples / 2)
+        # the compiled function costs a fixed size, small beside long programs
+        tuples = results["memory.tuples.medium"]
+        self.assertLess(results["memory.compiled.medium"], tuples / 2)
 
-def main():
-    tester = CalculatorTest()
-    tester.run()
+    def test_compare(self) -> None:
+        baseline = {"results": {"a": 1.0, "b": 1.0}}
+        current = {"results": {"a": 1.1, "b": 1.5, "c": 9.0}}
+        regressions = benchmarks.compare(current, baseline, threshold=0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("b:"))
 
 
 if __name__ == "__main__":
-    main()
+    unittest.main()
@@ -0,0 +1,163 @@
+# built-in imports
+import asyncio
+import itertools
+import logging
+import multiprocessing
+
+LOG = logging.getLogger(__name__)
+
+# class instance owned by each worker process
+WORKER_INST = None
+
+
+def init_worker(class_type: type, class_kwargs: dict) -> None:
+    """Creates the class instance used by a worker process."""
+    global WORKER_INST
+    WORKER_INST = class_type(**class_kwargs)
+
+
+def run_batch(messages: list) -> list[str]:
+    """
+    Runs a batch of messages on the worker's class instance.
+    Each message is an input string or an (input, run() keyword args) pair.
+    """
+    results = []
+    for message in messages:
+        if isinstance(message, str):
+            results.append(str(WORKER_INST.run(message)))
+        else:
+            results.append(str(WORKER_INST.run(message[0], **message[1])))
+    return results
+
+
+class WorkerPool(object):
+    """
+    Pool of worker processes to evaluate requests on every core.
+    Requests arriving close together are grouped into batches to amortize
+    the cost of sending work between processes. A batch that runs past the
+    timeout restarts the pool to kill the runaway evaluation; the batch is
+    then retried one request at a time so only the slow request fails.
+    """
+
+    def __init__(
+        self,
+        class_type: type,
+        class_kwargs: dict = None,
+        processes: int = None,
+        batch_size: int = 32,
+        batch_delay: float = 0.001,
+        timeout: float = 10.0,
+    ):
+        self.class_type = class_type
+        self.class_kwargs = class_kwargs or {}
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.timeout = timeout
+        self.pool = None
+        self.pending = []
+        self.flush_handle = None
+        self.inflight = {}
+        self.batch_ids = itertools.count()
+
+    def start(self) -> None:
+        """Starts the worker processes."""
+        self.pool = multiprocessing.Pool(
+            self.processes,
+            initializer=init_worker,
+            initargs=(self.class_type, self.class_kwargs),
+        )
+        LOG.info(f"Started {self.processes} worker processes")
+
+    def close(self) -> None:
+        """Stops the worker processes."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    async def run(self, message: str, options: dict = None) -> str:
+        """
+        Queues a message for the next batch and waits for its result.
+        Options are passed to the class run() as keyword arguments.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(((message, options) if options else message, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        """Sends the pending messages to the pool as one batch."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch: list[tuple[object, asyncio.Future]]) -> None:
+        """Evaluates a batch, retrying its requests one by one on a timeout."""
+        messages = [message for message, _ in batch]
+        try:
+            results = await self.submit(messages)
+        except asyncio.TimeoutError:
+            await self.restart()
+            if len(batch) > 1:
+                await asyncio.gather(*(self.run_batch([item]) for item in batch))
+                return
+            LOG.error("Evaluation timed out: %.100s", messages[0])
+            results = [f"Error: Evaluation timed out after {self.timeout}s"]
+        except Exception as e:
+            LOG.error(e)
+            results = [f"Error: {e}"] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def submit(self, messages: list) -> list[str]:
+        """Submits a batch to the pool and waits up to the timeout for it."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch_id = next(self.batch_ids)
+        self.inflight[batch_id] = (messages, future)
+        self.apply(messages, future)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.inflight.pop(batch_id, None)
+
+    def apply(self, messages: list, future: asyncio.Future) -> None:
+        """Starts a batch on the current pool and resolves the future with it."""
+        loop = future.get_loop()
+        pool = self.pool
+
+        def resolve(result: object, error: bool = False) -> None:
+            # ignore results from a pool that has since been restarted
+            if future.done() or pool is not self.pool:
+                return
+            if error:
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+        pool.apply_async(
+            run_batch,
+            (messages,),
+            callback=lambda r: loop.call_soon_threadsafe(resolve, r),
+            error_callback=lambda e: loop.call_soon_threadsafe(resolve, e, True),
+        )
+
+    async def restart(self) -> None:
+        """Kills all workers and resubmits the batches still in flight."""
+        old_pool = self.pool
+        self.start()
+        for messages, future in self.inflight.values():
+            if not future.done():
+                self.apply(messages, future)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, old_pool.terminate)